@@ -31,8 +31,7 @@ for i in range(len(data)):
     data.loc[i,'DATE']=r
 # convert age groups to pd.IntervalIndex
 age_groups = data['AGE'].unique()
-for id,age_group in enumerate(age_groups):
-    data.loc[data['AGE']==age_group, 'AGE'] = desired_age_groups[id]
+data['AGE'] = data['AGE'].map(dict(zip(age_groups, desired_age_groups)))
 data = data.drop(columns=['YEAR','WEEK'])
 data = data.groupby(by=['DATE','AGE']).sum().squeeze()
 # compute weekly total per 100K
@@ -3,9 +3,14 @@
 ############################
 
 import os
+import sys
 import numpy as np
 import pandas as pd
 
+# registry of the Belgian geography
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../use_pySODM'))
+from geography import get_geography, regions
+
 ###############
 ## Load data ##
 ###############
@@ -37,23 +42,13 @@ vaccine_coverage = {
     'Brussels': [0.002, 0.003, 0.014, 0.059],
 }
 
-## Loop over municipality NIS codes, determine region, fill in vaccination coverage
-for NIS in data.index.get_level_values('NIS').unique():
-    # determine region
-    NIS = str(NIS)
-    if NIS[0] in ['1', '3', '4', '7']:
-        region = 'Flanders'
-    elif NIS[0] in ['5', '6', '8', '9']:
-        region = 'Wallonia'
-    elif NIS[0] == '2':
-        if NIS[1] == '1':
-            region = 'Brussels'
-        elif NIS[1] in ['3', '4']:
-            region = 'Flanders'
-        elif NIS[1] == '5':
-            region = 'Wallonia'
-    # fill in vaccine coverage
-    data.loc[int(NIS), slice(None)] = vaccine_coverage[region]
+## Look up the region and age group of every row, fill in vaccination coverage
+# (the age groups are not listed in the same order for every municipality)
+coverage = np.array([vaccine_coverage[region] for region in regions])
+region = get_geography().NIS2unit(data.index.get_level_values('NIS').values, 'region')
+age_groups = sorted(data.index.get_level_values('age').unique(), key=lambda age: float(age.strip('[(').split(',')[0]))
+age = data.index.get_level_values('age').map({age: i for i, age in enumerate(age_groups)}).values
+data['population'] = coverage[region, age]
 
 #################
 ## Save result ##
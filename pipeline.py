@@ -0,0 +1,221 @@
+"""
+This script (re)builds the interim datasets (`data/conversion`) and the flepiMoP model inputs (`use_flepiMoP/*/model_input`).
+
+Every step declares the files it reads and writes, which makes the steps a directed acyclic graph.
+A step is re-run only when the contents of its script or inputs changed since its last run, or when one of its outputs is missing or was altered.
+Independent steps run in parallel, and a step whose rebuilt inputs turn out byte-identical is not re-run.
+
+usage: python pipeline.py [targets ...] [-n] [-f] [-p PROCESSES]
+"""
+
+__author__      = "Tijs Alleman"
+__copyright__   = "Copyright (c) 2024 by T.W. Alleman, IDD Group, Johns Hopkins Bloomberg School of Public Health. All Rights Reserved."
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+root = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(root, 'use_pySODM'))
+from cache import hash_files, cache_dir
+
+# hashes of the inputs and outputs of every step at its last run
+manifest_path = os.path.join(cache_dir, 'pipeline.json')
+
+###########
+## Steps ##
+###########
+
+# name: script (run from its own folder), inputs and outputs, relative to the repository root
+steps = {
+    'format_cases': {
+        'script': 'data/conversion/format_cases.py',
+        'inputs': ['data/raw/cases/2017-2018/ILI_weekly_1718_raw.csv'],
+        'outputs': ['data/interim/cases/2017-2018/ILI_weekly_100K.csv', 'data/interim/cases/2017-2018/ILI_weekly_ABS.csv'],
+    },
+    'format_demography': {
+        'script': 'data/conversion/format_demography.py',
+        'inputs': ['data/raw/demography/TF_SOC_POP_STRUCT_2017.xlsx'],
+        'outputs': ['data/interim/demography/demography_municipalities_2017.csv'],
+    },
+    'make_vaccination_coverage': {
+        'script': 'data/conversion/make_vaccination_coverage.py',
+        'inputs': ['data/interim/demography/demography_municipalities_2017.csv', 'data/interim/census_2011/demography_municipalities_2011_sorted.csv',
+                   'use_pySODM/geography.py', 'use_pySODM/cache.py'],
+        'outputs': ['data/interim/vaccination/vaccination_municipalities_2010.csv'],
+    },
+}
+for variant in ['w_age_groups', 'wo_age_groups']:
+    steps.update({
+        f'{variant}/demography': {
+            'script': f'use_flepiMoP/{variant}/model_input/build-demography.py',
+            'inputs': ['data/interim/demography/demography_municipalities_2017.csv', 'use_flepiMoP/exporter.py'],
+            'outputs': [f'use_flepiMoP/{variant}/model_input/demography.csv'],
+        },
+        f'{variant}/initial_condition': {
+            'script': f'use_flepiMoP/{variant}/model_input/build-initial_condition.py',
+            'inputs': ['data/interim/demography/demography_municipalities_2017.csv', 'use_flepiMoP/exporter.py'],
+            'outputs': [f'use_flepiMoP/{variant}/model_input/initial_condition.csv'],
+        },
+        f'{variant}/mobility': {
+            'script': f'use_flepiMoP/{variant}/model_input/build-mobility.py',
+            'inputs': ['data/interim/census_2011/mobility_municipalities_2011_sorted.csv', 'use_flepiMoP/exporter.py'],
+            'outputs': [f'use_flepiMoP/{variant}/model_input/mobility.csv'],
+        },
+    })
+
+###########
+## Graph ##
+###########
+
+def upstream(steps):
+    """ Returns the steps producing the inputs of every step
+    """
+    producer = {output: name for name, step in steps.items() for output in step['outputs']}
+    return {name: sorted({producer[path] for path in step['inputs'] if path in producer}) for name, step in steps.items()}
+
+def select(steps, targets):
+    """ Returns the names of the steps needed to build `targets` (step names or output paths), in the order of `steps`. All steps if `targets` is empty.
+    """
+    if not targets:
+        return list(steps)
+    producer = {output: name for name, step in steps.items() for output in step['outputs']}
+    parents = upstream(steps)
+    needed, stack = set(), []
+    for target in targets:
+        target = os.path.relpath(os.path.abspath(target), root) if target not in steps else target
+        if target not in steps and target not in producer:
+            raise ValueError(
+                f"'{target}' is neither a step nor the output of a step. valid steps: {list(steps)}"
+            )
+        stack.append(target if target in steps else producer[target])
+    while stack:
+        name = stack.pop()
+        if name not in needed:
+            needed.add(name)
+            stack += parents[name]
+    return [name for name in steps if name in needed]
+
+def hashes(paths):
+    """ Returns the content hash of every file in `paths` (None if the file does not exist)
+    """
+    return {path: hash_files([os.path.join(root, path)]) if os.path.isfile(os.path.join(root, path)) else None for path in paths}
+
+def status(step, record, force=False):
+    """
+    Decides whether a step needs to run.
+
+    output
+    ------
+    status: str
+        'run' (inputs changed, outputs missing or altered), 'up to date' or 'unavailable' (inputs missing, existing outputs are kept).
+    """
+    inputs = hashes([step['script']] + step['inputs'])
+    outputs = hashes(step['outputs'])
+    if any(h is None for h in inputs.values()):
+        if all(h is not None for h in outputs.values()):
+            return 'unavailable'
+        missing = [path for path, h in inputs.items() if h is None]
+        raise FileNotFoundError(
+            f"inputs {missing} of '{step['script']}' do not exist and its outputs cannot be built"
+        )
+    if force or record is None or record['inputs'] != inputs or record['outputs'] != outputs:
+        return 'run'
+    return 'up to date'
+
+def run(step):
+    """ Runs the script of a step from its own folder, returns its return code and output
+    """
+    script = os.path.join(root, step['script'])
+    process = subprocess.run([sys.executable, os.path.basename(script)], cwd=os.path.dirname(script), capture_output=True, text=True)
+    return process.returncode, process.stdout + process.stderr
+
+##############
+## Pipeline ##
+##############
+
+def build(targets=(), processes=None, force=False, dry_run=False):
+    """
+    Builds the steps needed for `targets` (default: all steps), re-running only the steps whose script or inputs changed or whose outputs are missing or altered.
+
+    input
+    -----
+    targets: list of str
+        Names of steps or paths of outputs (relative to the repository root or the working directory).
+
+    processes: int or None
+        Maximum number of steps running at once. Default: number of CPUs.
+
+    force: bool
+        Re-run the selected steps regardless of their inputs.
+
+    dry_run: bool
+        Only report the steps that would run (assuming a step re-running changes its outputs).
+
+    output
+    ------
+    results: dict
+        Status of every selected step: 'run', 'up to date', 'unavailable', 'failed' or 'not run' (an upstream step failed).
+    """
+    names = select(steps, targets)
+    parents = upstream(steps)
+    manifest = {}
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    results, running = {}, {}
+    with ThreadPoolExecutor(processes or os.cpu_count()) as executor:
+        while len(results) < len(names):
+            # schedule every step whose upstream steps are finished
+            for name in names:
+                if name in results or name in running.values() or any(p in names and p not in results for p in parents[name]):
+                    continue
+                if any(results.get(p) in ('failed', 'not run') for p in parents[name]):
+                    results[name] = 'not run'
+                    continue
+                try:
+                    decision = 'run' if dry_run and any(results.get(p) == 'run' for p in parents[name]) else status(steps[name], manifest.get(name), force)
+                except FileNotFoundError as e:
+                    results[name] = 'failed'
+                    print(f"{name}: failed\n{e}")
+                    continue
+                print(f"{name}: {decision}")
+                if decision != 'run' or dry_run:
+                    results[name] = decision
+                else:
+                    running[executor.submit(run, steps[name])] = name
+            if not running:
+                continue
+
+            # record the steps that finished
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                returncode, output = future.result()
+                step = steps[name]
+                if returncode != 0 or any(h is None for h in hashes(step['outputs']).values()):
+                    results[name] = 'failed'
+                    print(f"{name}: failed\n{output}")
+                    continue
+                results[name] = 'run'
+                manifest[name] = {'inputs': hashes([step['script']] + step['inputs']), 'outputs': hashes(step['outputs'])}
+                os.makedirs(cache_dir, exist_ok=True)
+                with open(manifest_path, 'w') as f:
+                    json.dump(manifest, f, indent=1)
+    return results
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="(Re)builds the interim datasets and flepiMoP model inputs whose sources changed")
+    parser.add_argument("targets", help="Steps or outputs to build, with the steps they depend on (default: all)", nargs='*')
+    parser.add_argument("-p", "--processes", help="Maximum number of steps running at once (default: number of CPUs)", default=None, type=int)
+    parser.add_argument("-f", "--force", help="Re-run the selected steps regardless of their inputs", action='store_true')
+    parser.add_argument("-n", "--dry_run", help="Only report the steps that would run", action='store_true')
+    args = parser.parse_args()
+
+    results = build(args.targets, args.processes, args.force, args.dry_run)
+    sys.exit(1 if any(result in ('failed', 'not run') for result in results.values()) else 0)
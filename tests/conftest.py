@@ -0,0 +1,10 @@
+"""
+Makes the (flat-importing) modules of `use_pySODM` and `use_flepiMoP` importable by the tests
+"""
+
+import os
+import sys
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for folder in ['use_pySODM', 'use_flepiMoP']:
+    sys.path.insert(0, os.path.join(root, folder))
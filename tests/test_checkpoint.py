@@ -0,0 +1,25 @@
+"""
+Tests of the checkpoints (`use_pySODM/checkpoint.py`)
+"""
+
+import pytest
+import numpy as np
+from datetime import timedelta
+from scipy.sparse import csr_array
+from checkpoint import Checkpoint
+
+states = {'S': np.full((2, 3), 100.), 'I': np.ones((2, 3))}
+parameters = {'beta': 0.03, 'N': np.eye(2), 'M': csr_array(np.eye(3)), 'shift': timedelta(days=7)}
+
+def test_roundtrip(tmp_path):
+    path = Checkpoint(states, parameters, time=14).save(tmp_path / 'checkpoint.h5')
+    checkpoint = Checkpoint.load(path, allow_pickle=True)
+    np.testing.assert_array_equal(checkpoint.states['I'], states['I'])
+    np.testing.assert_array_equal(checkpoint.parameters['M'].toarray(), np.eye(3))
+    assert checkpoint.parameters['beta'] == 0.03
+    assert checkpoint.parameters['shift'] == timedelta(days=7)
+
+def test_pickled_parameters_are_not_loaded_by_default(tmp_path):
+    path = Checkpoint(states, parameters, time=14).save(tmp_path / 'checkpoint.h5')
+    with pytest.raises(ValueError, match="'shift'"):
+        Checkpoint.load(path)
@@ -0,0 +1,73 @@
+"""
+Tests of the dedicated simulation engines (`use_pySODM/engines.py`)
+"""
+
+import pytest
+import numpy as np
+from scipy.sparse import csr_array
+from engines import HybridSIR, TauLeapSIR
+from models import spatial_ODE_SIR
+
+def small_network(n_age=4, n_loc=200, seed=0):
+    """ Returns initial states, parameters and coordinates of a random network with integer populations, seeded in one patch
+    """
+    rng = np.random.default_rng(seed)
+    population = rng.integers(1000, 20000, (n_age, n_loc)).astype(float)
+    I0 = np.zeros_like(population)
+    I0[:, 0] = 10
+    M = (rng.random((n_loc, n_loc)) < 0.05) * rng.random((n_loc, n_loc)) + 5 * np.eye(n_loc)
+    M = csr_array(M / M.sum(axis=1, keepdims=True))
+    parameters = {'beta': 0.03, 'gamma': 5, 'f_v': 0.1, 'N': np.full((n_age, n_age), 4.0), 'M': M}
+    coordinates = {'age': list(range(n_age)), 'location': list(range(n_loc))}
+    return {'S': population - I0, 'I': I0}, parameters, coordinates, population
+
+def test_hybrid_epidemic_dies_out_and_conserves_population():
+    # compartments returning to the stochastic part must not keep fractional infected forever
+    states, parameters, coordinates, population = small_network()
+    out = HybridSIR(states, parameters, coordinates, threshold=50).sim(400, seed=3)
+    I = out['I'].isel(time=-1).values
+    assert I.sum() == 0
+    np.testing.assert_allclose((out['S'] + out['I'] + out['R']).values, np.broadcast_to(population, out['S'].shape), rtol=0, atol=1e-6)
+
+def test_hybrid_stochastic_states_are_integers():
+    states, parameters, coordinates, _ = small_network()
+    engine = HybridSIR(states, parameters, coordinates, threshold=50)
+    out = engine.sim(100, seed=1)
+    # after the last leap, all compartments below the threshold hold whole individuals (up to the leap that just happened deterministically)
+    engine._stochastic[...] = True
+    engine._round_stochastic(np.random.default_rng(0))
+    assert np.all(engine._y == np.floor(engine._y))
+    np.testing.assert_allclose(engine._y.sum(axis=0), (out['S'] + out['I'] + out['R']).isel(time=-1).values, atol=1e-6)
+
+def test_tau_leap_conserves_population():
+    states, parameters, coordinates, population = small_network()
+    out = TauLeapSIR(states, parameters, coordinates).sim(200, seed=2)
+    np.testing.assert_array_equal((out['S'] + out['I'] + out['R']).isel(time=-1).values, population)
+
+def ode_model(n_age=3, n_loc=6, seed=0):
+    """ Returns a spatial_ODE_SIR on a small random network (states passed positionally, the keyword differs between pySODM versions)
+    """
+    rng = np.random.default_rng(seed)
+    S0 = rng.uniform(1e3, 1e4, (n_age, n_loc))
+    I0 = np.zeros((n_age, n_loc))
+    I0[:, 0] = 10
+    M = rng.uniform(0, 1, (n_loc, n_loc))
+    parameters = {'beta': 0.3, 'gamma': 5, 'f_v': 0.2, 'N': rng.uniform(0, 1, (n_age, n_age)), 'M': M / M.sum(axis=1, keepdims=True)}
+    return spatial_ODE_SIR({'S': S0, 'I': I0}, parameters, coordinates={'age': list(range(n_age)), 'location': list(range(n_loc))})
+
+@pytest.fixture(scope='module')
+def adaptive_solution():
+    model = ode_model()
+    return model, model.sim(60, method='RK45', rtol=1e-10)['I'].values
+
+def test_rk4_matches_adaptive_solve(adaptive_solution):
+    model, reference = adaptive_solution
+    out = model.sim(60, method='rk4', dt=0.25)
+    assert out['I'].shape == reference.shape
+    assert np.abs(out['I'].values - reference).max() <= 1e-5 * np.abs(reference).max()
+
+def test_euler_converges_at_first_order(adaptive_solution):
+    model, reference = adaptive_solution
+    errors = [np.abs(model.sim(60, method='euler', dt=dt)['I'].values - reference).max() for dt in [0.1, 0.05, 0.025]]
+    # halving dt halves the error
+    np.testing.assert_allclose(np.array(errors[:-1]) / np.array(errors[1:]), 2, rtol=0.05)
@@ -0,0 +1,26 @@
+"""
+Tests of the flepiMoP input exporter (`use_flepiMoP/exporter.py`)
+"""
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_array
+from exporter import mobility_table
+
+NIS = np.array([11001, 11002, 21004, 44021])
+M = np.array([[5., 1., 0., 2.],
+              [0., 7., 3., 0.],
+              [4., 0., 0., 0.],
+              [0., 0., 6., 9.]])
+expected = pd.DataFrame({'ori': [11001, 11001, 11002, 21004, 44021],
+                         'dest': [11002, 44021, 21004, 11001, 21004],
+                         'amount': [1., 2., 3., 4., 6.]})
+
+def test_mobility_table_dense():
+    pd.testing.assert_frame_equal(mobility_table(NIS, M), expected)
+
+def test_mobility_table_sparse():
+    # explicit zeros and the diagonal are dropped
+    M_sparse = csr_array(M)
+    M_sparse.data[M_sparse.data == 7.] = 0.
+    pd.testing.assert_frame_equal(mobility_table(NIS, M_sparse), expected)
@@ -0,0 +1,58 @@
+"""
+Tests of the analytical Jacobians (`use_pySODM/kernels.py`, `use_pySODM/models_legacy.py`) against central finite differences of the models' right-hand side
+"""
+
+import pytest
+import numpy as np
+from scipy.sparse import csr_array
+from kernels import SIRJacobian
+from models import spatial_ODE_SIR
+from models_legacy import spatial_ODE_SIR as legacy_spatial_ODE_SIR, legacy_jacobian, legacy_jacobian_sparsity
+
+n_age, n_loc = 3, 7
+beta, gamma, f_v = 0.3, 5, 0.4
+
+def random_inputs(M_kind, seed=0):
+    """ Returns random states, contact matrix and mobility matrix ('2D', 'sparse' or '3D' (n_loc, n_loc, n_age)) with zeros
+    """
+    rng = np.random.default_rng(seed)
+    S, I, R = (rng.uniform(10, 1e3, (n_age, n_loc)) for _ in range(3))
+    N = rng.uniform(0, 5, (n_age, n_age))
+    N[0, 2] = 0
+    M = rng.uniform(0, 1, (n_loc, n_loc, n_age) if M_kind == '3D' else (n_loc, n_loc))
+    M[M < 0.5] = 0
+    M /= M.sum(axis=1, keepdims=True)
+    return S, I, R, N, (csr_array(M) if M_kind == 'sparse' else M)
+
+def finite_difference_jacobian(integrate, S, I, R, *params):
+    """ Central finite difference of the flattened differentials [dS, dI, dR] with respect to the flattened states [S, I, R]
+    """
+    y = np.concatenate([S.ravel(), I.ravel(), R.ravel()])
+    rhs = lambda y: np.concatenate([np.ravel(d) for d in integrate(0, *y.reshape(3, n_age, n_loc), *params)])
+    J = np.empty((len(y), len(y)))
+    for j in range(len(y)):
+        h = 1e-5 * y[j]
+        e = np.zeros(len(y))
+        e[j] = h
+        J[:, j] = (rhs(y + e) - rhs(y - e)) / (2 * h)
+    return J
+
+def assert_matches_finite_differences(J, sparsity, J_fd):
+    np.testing.assert_allclose(J.toarray(), J_fd, rtol=0, atol=1e-8 * np.abs(J_fd).max())
+    # the pattern covers every non-zero element
+    outside = sparsity.toarray() == 0
+    assert not np.any(J.toarray()[outside])
+    assert np.all(np.abs(J_fd[outside]) <= 1e-8 * np.abs(J_fd).max())
+
+@pytest.mark.parametrize('M_kind', ['2D', 'sparse'])
+def test_jacobian(M_kind):
+    S, I, R, N, M = random_inputs(M_kind)
+    jacobian = SIRJacobian()
+    J_fd = finite_difference_jacobian(spatial_ODE_SIR.integrate, S, I, R, beta, gamma, f_v, N, M)
+    assert_matches_finite_differences(jacobian(S, I, R, beta, gamma, f_v, N, M), jacobian.sparsity(N, M, n_age, n_loc), J_fd)
+
+@pytest.mark.parametrize('M_kind', ['2D', 'sparse', '3D'])
+def test_legacy_jacobian(M_kind):
+    S, I, R, N, M = random_inputs(M_kind)
+    J_fd = finite_difference_jacobian(legacy_spatial_ODE_SIR.integrate, S, I, R, beta, gamma, f_v, N, M)
+    assert_matches_finite_differences(legacy_jacobian(S, I, R, beta, gamma, f_v, N, M), legacy_jacobian_sparsity(N, M, n_age, n_loc), J_fd)
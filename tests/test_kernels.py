@@ -0,0 +1,85 @@
+"""
+Tests of the force of infection (`use_pySODM/kernels.py`, `use_pySODM/kernels_numba.py`) against the einsum formulation of the contact tensor it replaces
+"""
+
+import pytest
+import numpy as np
+from scipy.sparse import csr_array
+from kernels import ForceOfInfection
+from kernels_numba import CompiledSIR
+from models_legacy import matmul_2D_3D_matrix
+
+n_age, n_loc = 4, 30
+
+def random_inputs(M_kind, seed=0):
+    """ Returns random states, contact matrix and mobility matrix ('2D', 'sparse' or '3D' (n_loc, n_loc, n_age))
+    """
+    rng = np.random.default_rng(seed)
+    S, I, R = (rng.uniform(0, 1e4, (n_age, n_loc)) for _ in range(3))
+    N = rng.uniform(0, 5, (n_age, n_age))
+    M = rng.uniform(0, 1, (n_loc, n_loc, n_age) if M_kind == '3D' else (n_loc, n_loc))
+    M[M < 0.5] = 0
+    M /= M.sum(axis=1, keepdims=True)
+    return S, I, R, N, (csr_array(M) if M_kind == 'sparse' else M)
+
+def einsum_force_of_infection(S, I, R, beta, f_v, N, M):
+    """ Baseline: materialised contact tensor C_{abcd} = N_{ab} * [(1 - f_v) * delta_{cd} + f_v * M_{cd(a)}]
+    """
+    M = M.toarray() if hasattr(M, 'toarray') else M
+    if M.ndim == 2:
+        C = (1 - f_v) * np.einsum('ab,cd->abcd', N, np.eye(n_loc)) + f_v * np.einsum('ab,cd->abcd', N, M)
+    else:
+        C = (1 - f_v) * np.einsum('ab,cd->abcd', N, np.eye(n_loc)) + f_v * np.einsum('ab,cda->abcd', N, M)
+    return beta * np.einsum('abcd,bd->ac', C, I/(S+I+R))
+
+def matmul_force_of_infection(S, I, R, beta, f_v, N, M):
+    """ Baseline: age contraction followed by `models_legacy.matmul_2D_3D_matrix` (which computes X @ W per age group)
+    """
+    Nx = N @ (I/(S+I+R))
+    W = M.T if hasattr(M, 'toarray') or M.ndim == 2 else M.transpose(1, 0, 2)
+    return beta * ((1 - f_v) * Nx + f_v * matmul_2D_3D_matrix(Nx, W))
+
+@pytest.mark.parametrize('M_kind', ['2D', 'sparse', '3D'])
+@pytest.mark.parametrize('f_v', [0, 0.3, 1])
+def test_force_of_infection_matches_baselines(M_kind, f_v):
+    S, I, R, N, M = random_inputs(M_kind)
+    l = ForceOfInfection()(S, I, R, 0.03, f_v, N, M)
+    np.testing.assert_allclose(l, einsum_force_of_infection(S, I, R, 0.03, f_v, N, M), rtol=1e-12, atol=0)
+    np.testing.assert_allclose(l, matmul_force_of_infection(S, I, R, 0.03, f_v, N, M), rtol=1e-12, atol=0)
+
+@pytest.mark.parametrize('M_kind', ['2D', 'sparse', '3D'])
+def test_force_of_infection_batched(M_kind):
+    # a leading 'draw' axis with one beta and f_v per draw equals the single runs
+    S, I, R, N, M = random_inputs(M_kind)
+    beta, f_v = np.array([0.02, 0.03, 0.04]), np.array([0, 0.3, 1])
+    stack = lambda X: np.stack([X, 2*X, 3*X])
+    l = ForceOfInfection()(stack(S), stack(I), np.stack([R, R, R]), beta, f_v, N, M)
+    for k in range(3):
+        np.testing.assert_allclose(l[k], einsum_force_of_infection((k+1)*S, (k+1)*I, R, beta[k], f_v[k], N, M), rtol=1e-12, atol=0)
+
+def test_force_of_infection_reuses_buffers():
+    S, I, R, N, M = random_inputs('sparse')
+    foi = ForceOfInfection()
+    l = foi(S, I, R, 0.03, 0.1, N, M)
+    assert foi(S, I, R, 0.03, 0.1, N, M) is l
+
+@pytest.mark.parametrize('M_kind', ['2D', 'sparse'])
+@pytest.mark.parametrize('f_v', [0, 0.3, 1])
+def test_compiled_kernels_match_baseline(M_kind, f_v):
+    S, I, R, N, M = random_inputs(M_kind)
+    kernels = CompiledSIR()
+    l = einsum_force_of_infection(S, I, R, 0.03, f_v, N, M)
+    np.testing.assert_allclose(kernels.force_of_infection(S, I, R, 0.03, f_v, N, M), l, rtol=1e-10, atol=0)
+    dS, dI, dR = kernels.ode_rhs(S, I, R, 0.03, 5, f_v, N, M)
+    np.testing.assert_allclose(dS, -l*S, rtol=1e-10, atol=0)
+    np.testing.assert_allclose(dR, I/5, rtol=1e-10, atol=0)
+    np.testing.assert_allclose(dS + dI + dR, 0, atol=1e-9)
+
+def test_compiled_kernels_convert_operands_once():
+    S, I, R, N, M = random_inputs('sparse')
+    kernels = CompiledSIR()
+    dS = kernels.ode_rhs(S, I, R, 0.03, 5, 0.1, N, M)[0]
+    operands = kernels._get_operands(N, M)
+    # the differentials are written into the same buffer, the operands are not converted again
+    assert np.shares_memory(kernels.ode_rhs(2*S, I, R, 0.03, 5, 0.1, N, M)[0], dS)
+    assert kernels._get_operands(N, M) is operands and len(kernels._operands) == 1
@@ -0,0 +1,67 @@
+"""
+Tests of the float32 models (float32 storage, float64 accumulation, `use_pySODM/kernels_numba.py`) against their float64 counterparts
+
+Tolerances (relative to the peak or to the float64 value): 1e-6 on the force of infection (float32 rounding of the states and intermediate results),
+1e-5 on the trajectories of the infected and 1e-6 on the final size.
+"""
+
+import pytest
+import numpy as np
+from scipy.sparse import csr_array
+from kernels import ForceOfInfection
+from kernels_numba import PackedForceOfInfection
+from models import spatial_ODE_SIR, spatial_ODE_SIR_float32, spatial_ODE_SIR_ensemble, spatial_ODE_SIR_ensemble_float32
+
+n_age, n_loc, n_draw = 3, 40, 4
+
+def random_inputs(sparse, seed=0):
+    """ Returns initial states, contact matrix, mobility matrix and coordinates of a random network seeded in one patch
+    """
+    rng = np.random.default_rng(seed)
+    S0 = rng.uniform(1e3, 1e4, (n_age, n_loc))
+    I0 = np.zeros((n_age, n_loc))
+    I0[:, 0] = 10
+    N = rng.uniform(0, 1, (n_age, n_age))
+    M = rng.uniform(0, 1, (n_loc, n_loc))
+    M[M < 0.7] = 0
+    M += np.eye(n_loc)
+    M /= M.sum(axis=1, keepdims=True)
+    return {'S': S0, 'I': I0}, N, (csr_array(M) if sparse else M), {'age': list(range(n_age)), 'location': list(range(n_loc))}
+
+def assert_close_to_float64(out, reference):
+    I, I_ref = out['I'].values.astype(np.float64), reference['I'].values
+    assert np.abs(I - I_ref).max() <= 1e-5 * I_ref.max()
+    final_size, final_size_ref = out['R'].values[-1].astype(np.float64).sum(), reference['R'].values[-1].sum()
+    assert abs(final_size - final_size_ref) <= 1e-6 * final_size_ref
+
+@pytest.mark.parametrize('sparse', [False, True])
+def test_force_of_infection(sparse):
+    states, N, M, _ = random_inputs(sparse)
+    S = states['S']
+    I = np.random.default_rng(1).uniform(0, 1e3, S.shape)
+    l = ForceOfInfection()(S, I, np.zeros_like(S), 0.3, 0.2, N, M)
+    l32 = PackedForceOfInfection('float32')(*(x.astype(np.float32) for x in (S, I, np.zeros_like(S))), 0.3, 0.2, N, M)
+    assert l32.dtype == np.float32
+    assert np.abs(l32 - l).max() <= 1e-6 * np.abs(l).max()
+
+@pytest.mark.parametrize('sparse', [False, True])
+@pytest.mark.parametrize('sim_kwargs', [{'method': 'RK45'}, {'method': 'rk4', 'dt': 0.5}])
+def test_model(sparse, sim_kwargs):
+    states, N, M, coordinates = random_inputs(sparse)
+    parameters = {'beta': 0.3, 'gamma': 5, 'f_v': 0.2, 'N': N, 'M': M}
+    reference = spatial_ODE_SIR(states, parameters, coordinates=coordinates).sim(60, **sim_kwargs)
+    out = spatial_ODE_SIR_float32(states, parameters, coordinates=coordinates).sim(60, **sim_kwargs)
+    # the fixed-step methods integrate in float32
+    assert out['I'].dtype == (np.float32 if sim_kwargs['method'] == 'rk4' else np.float64)
+    assert_close_to_float64(out, reference)
+
+@pytest.mark.parametrize('sparse', [False, True])
+def test_ensemble(sparse):
+    states, N, M, coordinates = random_inputs(sparse)
+    states = {k: np.repeat(v[np.newaxis], n_draw, axis=0) for k, v in states.items()}
+    parameters = {'beta': np.linspace(0.25, 0.35, n_draw), 'gamma': np.full(n_draw, 5.0), 'f_v': np.full(n_draw, 0.2), 'N': N, 'M': M}
+    coordinates = {'draw': list(range(n_draw)), **coordinates}
+    reference = spatial_ODE_SIR_ensemble(states, parameters, coordinates=coordinates).sim(60, method='rk4', dt=0.5)
+    out = spatial_ODE_SIR_ensemble_float32(states, parameters, coordinates=coordinates).sim(60, method='rk4', dt=0.5)
+    assert out['I'].dtype == np.float32
+    assert_close_to_float64(out, reference)
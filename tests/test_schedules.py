@@ -0,0 +1,65 @@
+"""
+Tests of the precompiled contact and mobility schedules (`use_pySODM/schedules.py`)
+"""
+
+import pytest
+import numpy as np
+from scipy.sparse import csr_array
+from kernels import ForceOfInfection
+from schedules import Schedule, mobility_operator
+
+n_age, n_loc = 3, 8
+
+def random_inputs(seed=0):
+    """ Returns random states, three contact matrices and a mobility matrix
+    """
+    rng = np.random.default_rng(seed)
+    S, I, R = (rng.uniform(0, 1e4, (n_age, n_loc)) for _ in range(3))
+    N1, N2, N3 = (rng.uniform(0, 5, (n_age, n_age)) for _ in range(3))
+    M = rng.uniform(0, 1, (n_loc, n_loc))
+    M[M < 0.5] = 0
+    return S, I, R, (N1, N2, N3), M / M.sum(axis=1, keepdims=True)
+
+def schedule():
+    """ October 2017 (the 2nd is a Monday): two overlapping periods with other contacts, and other mobility on weekends
+    """
+    _, _, _, (N1, N2, N3), M = random_inputs()
+    s = Schedule('2017-10-02', '2017-10-31', N=N1, M=M, f_v=0.1)
+    s.add([('2017-10-09', '2017-10-15')], N=N2)
+    s.add([('2017-10-12', '2017-10-20')], N=N3)
+    s.add(weekdays=[5, 6], f_v=0.5)
+    return s
+
+def test_later_rules_take_precedence():
+    _, _, _, (N1, N2, N3), _ = random_inputs()
+    s = schedule()
+    for t, N in [(6, N1), (7, N2), (9, N2), (10, N3), (18, N3), (19, N1)]:
+        np.testing.assert_array_equal(s(t)[0], N)
+
+def test_weekday_masking():
+    _, _, _, (_, _, N3), M = random_inputs()
+    s = schedule()
+    weekday, weekend = mobility_operator(M, 0.1), mobility_operator(M, 0.5)
+    # Friday, Saturday, Sunday, Monday
+    for t, A in [(4, weekday), (5, weekend), (6, weekend), (7, weekday)]:
+        np.testing.assert_array_equal(s(t)[1], A)
+    # rules on other keys combine: a weekend day within the second period
+    N, A = s(12)
+    np.testing.assert_array_equal(N, N3)
+    np.testing.assert_array_equal(A, weekend)
+
+def test_times_are_clamped_to_the_schedule():
+    s = schedule()
+    # times before 0 use the first day, times past `end_date` the last day (a Tuesday), fractions of a day the day they fall in
+    for t, day in [(-3.5, 0), (0.99, 0), (5.5, 5), (29, 29), (1000, 29)]:
+        assert all(np.array_equal(x, y) for x, y in zip(s(t), s(day)))
+    assert s.to_series().index[-1] == np.datetime64('2017-10-31')
+
+@pytest.mark.parametrize('sparse', [False, True])
+def test_single_regime_matches_force_of_infection(sparse):
+    S, I, R, (N, _, _), M = random_inputs()
+    M = csr_array(M) if sparse else M
+    s = Schedule('2017-10-02', '2017-10-31', N=N, M=M, f_v=0.3)
+    assert len(s.operators) == 1
+    l = ForceOfInfection().scheduled(S, I, R, 0.03, *s(10))
+    np.testing.assert_allclose(l, ForceOfInfection()(S, I, R, 0.03, 0.3, N, M), rtol=1e-12, atol=0)
@@ -0,0 +1,168 @@
+"""
+This script contains an exporter of the flepiMoP model inputs (demography, mobility and initial condition) from NumPy arrays (the mobility matrix may be a scipy.sparse array)
+"""
+
+__author__      = "Tijs Alleman"
+__copyright__   = "Copyright (c) 2024 by T.W. Alleman, IDD Group, Johns Hopkins Bloomberg School of Public Health. All Rights Reserved."
+
+import os
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_array
+
+# paths are resolved relative to the repository, not to the working directory
+data_dir = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../data'))
+
+#############
+## Sources ##
+#############
+
+def load_demography(path=os.path.join(data_dir, 'interim/demography/demography_municipalities_2017.csv')):
+    """
+    A function loading the number of inhabitants per age group and municipality
+
+    output
+    ------
+    NIS: np.ndarray
+        NIS codes of the municipalities. Shape (n_loc,).
+
+    age_groups: list of str
+        Age groups, f.i. '[0, 5)'.
+
+    population: np.ndarray
+        Number of inhabitants. Shape (n_age, n_loc).
+    """
+    # the age groups are not listed in the same order for every municipality: pivot on their labels, sorted by lower bound
+    data = pd.read_csv(path).pivot(index='age', columns='NIS', values='population')
+    data = data.loc[sorted(data.index, key=lambda age: float(age.strip('[(').split(',')[0]))]
+    return data.columns.values, list(data.index), data.values
+
+def load_mobility(path=os.path.join(data_dir, 'interim/census_2011/mobility_municipalities_2011_sorted.csv')):
+    """
+    A function loading the origin-destination mobility matrix
+
+    output
+    ------
+    NIS: np.ndarray
+        NIS codes of the municipalities. Shape (n_loc,).
+
+    M: np.ndarray
+        Number of commuters from origin (rows) to destination (columns). Shape (n_loc, n_loc).
+    """
+    data = pd.read_csv(path, index_col=0)
+    return data.index.values, data.values
+
+############
+## Tables ##
+############
+
+def age_group_names(age_groups):
+    """ Converts age groups '[0, 5)' to the flepiMoP compartment names 'age0to5'
+    """
+    return ['age' + 'to'.join(s.strip() for s in str(a).strip('[]()').split(',')) for a in age_groups]
+
+def demography_table(NIS, population):
+    """ Builds the flepiMoP demography ('subpop', 'population'), summing `population` of shape (n_loc,) or (n_age, n_loc) over the age groups
+    """
+    population = np.asarray(population)
+    return pd.DataFrame({'subpop': NIS, 'population': population.reshape(-1, len(NIS)).sum(axis=0)})
+
+def mobility_table(NIS, M):
+    """ Builds the sparse, long-format flepiMoP mobility ('ori', 'dest', 'amount') from a dense or scipy.sparse matrix: zero flows and the diagonal (not accepted by flepiMoP) are dropped
+    """
+    M = coo_array(M)
+    M.sum_duplicates()
+    keep = (M.row != M.col) & (M.data != 0)
+    return pd.DataFrame({'ori': np.asarray(NIS)[M.row[keep]], 'dest': np.asarray(NIS)[M.col[keep]], 'amount': M.data[keep]})
+
+def initial_condition_table(NIS, initial_states, age_groups=None):
+    """
+    Builds the long-format flepiMoP initial condition
+
+    input
+    -----
+    NIS: np.ndarray
+        NIS codes of the municipalities. Shape (n_loc,).
+
+    initial_states: dict
+        Number of individuals per compartment, f.i. {'S': S0, 'I': I0, 'R': R0}. Shape (n_age, n_loc) or (n_loc,).
+
+    age_groups: list of str or None
+        Names of the age groups, f.i. ['age0to5', ...]. If provided, the columns are ('subpop', 'mc_name', 'amount') with compartments named f.i. 'S_age0to5'.
+        If None, the states are summed over the age groups and the columns are ('subpop', 'mc_infection_stage', 'amount').
+
+    output
+    ------
+    table: pd.DataFrame
+        Rows sorted by subpop, then age group, then state (in the order of `initial_states`).
+    """
+    names = list(initial_states)
+    n_loc = len(NIS)
+    # stack to shape (n_loc, n_age, n_states)
+    X = np.stack([np.asarray(initial_states[k]).reshape(-1, n_loc) for k in names], axis=-1).transpose(1, 0, 2)
+    if age_groups is None:
+        X = X.sum(axis=1)
+        return pd.DataFrame({'subpop': np.repeat(NIS, len(names)), 'mc_infection_stage': np.tile(names, n_loc), 'amount': X.ravel()})
+    if len(age_groups) != X.shape[1]:
+        raise ValueError(
+            f"'age_groups' has {len(age_groups)} names but the initial states have {X.shape[1]} age groups"
+        )
+    mc_name = [f'{k}_{a}' for a in age_groups for k in names]
+    return pd.DataFrame({'subpop': np.repeat(NIS, len(mc_name)), 'mc_name': np.tile(mc_name, n_loc), 'amount': X.ravel()})
+
+############
+## Export ##
+############
+
+def write_table(table, path):
+    """ Writes a table to a .csv or .parquet file (by extension), without index
+    """
+    extension = os.path.splitext(path)[1]
+    if extension == '.csv':
+        table.to_csv(path, index=False)
+    elif extension == '.parquet':
+        table.to_parquet(path, index=False)
+    else:
+        raise ValueError(
+            f"unsupported extension '{extension}' of '{path}'. valid extensions: '.csv', '.parquet'"
+        )
+    return path
+
+def export_model_input(directory, NIS, population, M, initial_states, age_groups=None, format='csv'):
+    """
+    Exports the flepiMoP model inputs 'demography.csv', 'mobility.{format}' and 'initial_condition.{format}' to `directory`
+
+    input
+    -----
+    directory: str
+        Output folder, f.i. 'use_flepiMoP/w_age_groups/model_input'.
+
+    NIS: np.ndarray
+        NIS codes of the municipalities. Shape (n_loc,).
+
+    population: np.ndarray
+        Number of inhabitants. Shape (n_loc,) or (n_age, n_loc).
+
+    M: np.ndarray
+        Origin-destination mobility matrix. Shape (n_loc, n_loc).
+
+    initial_states: dict
+        Initial states (see `initial_condition_table`).
+
+    age_groups: list of str or None
+        Names of the age groups (see `initial_condition_table`).
+
+    format: str
+        'csv' or 'parquet'. The demography is always written as .csv (flepiMoP's geodata). Point the configuration to the Parquet files when using 'parquet'.
+
+    output
+    ------
+    paths: dict
+        Paths of the written files.
+    """
+    os.makedirs(directory, exist_ok=True)
+    return {
+        'demography': write_table(demography_table(NIS, population), os.path.join(directory, 'demography.csv')),
+        'mobility': write_table(mobility_table(NIS, M), os.path.join(directory, f'mobility.{format}')),
+        'initial_condition': write_table(initial_condition_table(NIS, initial_states, age_groups), os.path.join(directory, f'initial_condition.{format}')),
+    }
@@ -7,21 +7,20 @@ generates a flepimop-compatible demography file
 ############################
 
 import os
-import pandas as pd
+import sys
+
+# exporter of the flepiMoP model inputs
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..'))
+from exporter import load_demography, demography_table, write_table
 
 ###############
 ## Load data ##
 ###############
 
-rel_dir = '../../../data/interim/demography/demography_municipalities_2017.csv'
-data_dir = os.path.join(os.getcwd(),rel_dir)
-data = pd.read_csv(data_dir, index_col=[0,1])
-
-data = data.groupby(by='NIS').sum()
-data.index.names = ['subpop']
+NIS, _, population = load_demography()
 
 ##########
 ## save ##
 ##########
 
-data.to_csv('demography.csv')
\ No newline at end of file
+write_table(demography_table(NIS, population), 'demography.csv')
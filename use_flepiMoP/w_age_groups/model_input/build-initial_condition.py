@@ -11,51 +11,36 @@ NIS_init = 81001
 ############################
 
 import os
+import sys
 import random
-import pandas as pd
+import numpy as np
+
+# exporter of the flepiMoP model inputs
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..'))
+from exporter import load_demography, age_group_names, initial_condition_table, write_table
 
 ###############
 ## Load data ##
 ###############
 
-rel_dir = '../../../data/interim/demography/demography_municipalities_2017.csv'
-data_dir = os.path.join(os.getcwd(),rel_dir)
-data = pd.read_csv(data_dir, index_col=[0,1])
+NIS, ages, population = load_demography()
 
 ##########################################
 ## Convert to a flepi-compatible format ##
 ##########################################
 
-# desired format: 'subpop', 'mc_age', 'mc_infection_stage' (=disease states), 'amount'
-subpops = data.index.get_level_values('NIS').unique()
-ages = data.index.get_level_values('age').unique()
-ages_desired = ['age0to5', 'age5to15', 'age15to65', 'age65to120']
-mc_infection_stages = ['S', 'I', 'R']
-idx = pd.MultiIndex.from_product([subpops, ages_desired, mc_infection_stages], names=['subpop', 'mc_age', 'mc_infection_stage'])
-new_data = pd.Series(0, index=idx, name='amount')
-
-# loop over subpop/age combinations in original dataframe and use these data to fill in the susceptibles
-for subpop in subpops:
-    for age,age_desired in zip(ages, ages_desired):
-        new_data.loc[subpop, age_desired, 'S'] = data.loc[subpop, age].values
+# desired format: 'subpop', 'mc_name' (=disease state + age group), 'amount'
+S0 = population
+I0 = np.zeros_like(population)
+R0 = np.zeros_like(population)
 
 # place the initial infected in Aarlen (random age group)
-new_data.loc[NIS_init, random.choice(ages_desired), 'I'] = 1
-
-# now make a column 'mc_name' containing the disease state and age groups linked with an underscore
-new_data = new_data.reset_index()
-new_data['mc_name'] = new_data['mc_infection_stage'] + '_' + new_data['mc_age']
-
-# pop the old 'mc_age' and 'mc_infection_stage' columns
-del new_data['mc_age']
-del new_data['mc_infection_stage']
+I0[random.randrange(len(ages)), np.flatnonzero(NIS == NIS_init)] = 1
 
-# rearrange columns
-new_data = new_data.loc[:,['subpop','mc_name','amount']]
-new_data = new_data.set_index('subpop')
+new_data = initial_condition_table(NIS, {'S': S0, 'I': I0, 'R': R0}, age_groups=age_group_names(ages))
 
 ##########
 ## save ##
 ##########
 
-new_data.to_csv('initial_condition.csv')
\ No newline at end of file
+write_table(new_data, 'initial_condition.csv')
@@ -10,40 +10,36 @@ NIS_init = 81001 # Arlon # TODO: give NIS and method as script inputs
 ############################
 
 import os
-import pandas as pd
+import sys
+import numpy as np
+
+# exporter of the flepiMoP model inputs
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..'))
+from exporter import load_demography, initial_condition_table, write_table
 
 ###############
 ## Load data ##
 ###############
 
-rel_dir = '../../../data/interim/demography/demography_municipalities_2017.csv'
-data_dir = os.path.join(os.getcwd(),rel_dir)
-data = pd.read_csv(data_dir, index_col=[0,1])
+NIS, _, population = load_demography()
 
 ##########################################
 ## Convert to a flepi-compatible format ##
 ##########################################
 
 # desired format: 'subpop', 'mc_infection_stage' (=disease states), 'amount'
-subpops = data.index.get_level_values('NIS').unique()
-ages = data.index.get_level_values('age').unique()
-mc_infection_stages = ['S', 'I', 'R']
-idx = pd.MultiIndex.from_product([subpops, ages, mc_infection_stages], names=['subpop', 'age', 'mc_infection_stage'])
-new_data = pd.Series(0, index=idx, name='amount')
-
-# loop over subpop/age combinations in original dataframe and use these data to fill in the susceptibles
-for subpop in subpops:
-    for age in ages:
-        new_data.loc[subpop, age, 'S'] = data.loc[subpop, age].values
-
 # aggregate age groups
-new_data = new_data.groupby(by=['subpop', 'mc_infection_stage']).sum()
+S0 = population.sum(axis=0)
+I0 = np.zeros_like(S0)
+R0 = np.zeros_like(S0)
 
 # place the initial infected in NIS_init
-new_data.loc[NIS_init, 'I'] = 1
+I0[NIS == NIS_init] = 1
+
+new_data = initial_condition_table(NIS, {'S': S0, 'I': I0, 'R': R0})
 
 ##########
 ## save ##
 ##########
 
-new_data.to_csv('initial_condition.csv')
\ No newline at end of file
+write_table(new_data, 'initial_condition.csv')
@@ -7,38 +7,29 @@ generates a flepimop-compatible mobility file
 ############################
 
 import os
-import pandas as pd
+import sys
+
+# exporter of the flepiMoP model inputs
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..'))
+from exporter import load_mobility, mobility_table, write_table
 
 ###############
 ## Load data ##
 ###############
 
-# mobility data
-rel_dir = '../../../data/interim/census_2011/mobility_municipalities_2011_sorted.csv'
-data_dir = os.path.join(os.getcwd(),rel_dir)
-data = pd.read_csv(data_dir, index_col=0)
+NIS, M = load_mobility()
 
 ##########################################
 ## Convert to a flepi-compatible format ##
 ##########################################
 
 # desired format: 'ori' (NIS), 'dest' (NIS), 'amount'
-spatial_units = data.index.unique()
-idx = pd.MultiIndex.from_product([spatial_units,spatial_units], names=['ori', 'dest'])
-new_data = pd.Series(0.0, index=idx, name='amount')
-
-# loop over NIS codes and fill in
-for su in spatial_units:
-    new_data.loc[su, slice(None)] = data.loc[su].values
-
-# flepimop does not accept diagonal elements in the mobility data
+# flepimop does not accept diagonal elements in the mobility data, zero flows are dropped
 # (this is why the diagonal in the pySODM version was set to 0)
-new_data = new_data.reset_index()
-for su in spatial_units:
-    new_data = new_data.drop(new_data[((new_data["ori"] == su) & (new_data["dest"] == su))].index.values)
+new_data = mobility_table(NIS, M)
 
 ##########
 ## save ##
 ##########
 
-new_data.to_csv('mobility.csv')
\ No newline at end of file
+write_table(new_data, 'mobility.csv')
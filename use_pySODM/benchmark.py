@@ -0,0 +1,365 @@
+"""
+This script benchmarks the simulation engines of the age-stratified spatially-explicit SIR model (pySODM variants, dedicated engines and, if installed, flepiMoP) on the Belgian municipalities and on synthetic networks of 1000 to 10000+ patches
+
+For every engine and number of patches, it records the time per call of the right-hand side, the wall time and peak memory of a season, the ensemble throughput and the agreement with the reference engine ('numpy').
+Results are saved as JSON for regression tracking (`--compare` reports the change with respect to a previous run). No network connection is needed.
+
+usage: python benchmark.py [-e ENGINES ...] [-n PATCHES ...] [-d DAYS] [--n_draws N] [-p PROCESSES] [-o OUTPUT] [--compare PREVIOUS]
+"""
+
+__author__      = "Tijs Alleman"
+__copyright__   = "Copyright (c) 2024 by T.W. Alleman, IDD Group, Johns Hopkins Bloomberg School of Public Health. All Rights Reserved."
+
+import os
+import sys
+import json
+import time
+import shutil
+import timeit
+import platform
+import argparse
+import resource
+import importlib
+import subprocess
+import tracemalloc
+import tempfile
+import numpy as np
+import pandas as pd
+from datetime import datetime, timedelta
+from scipy.sparse import csr_array, diags_array
+from scipy.spatial import cKDTree
+
+from utils import construct_coordinates_dictionary, get_contact_matrix, get_mobility_matrix, load_demography_2017
+from ensemble import simulate_ensemble
+from profiling import Profiler
+from engines import read_integration_config
+
+repository_dir = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+#############
+## Engines ##
+#############
+
+# kind: 'ode' (pySODM ODE), 'jump' (pySODM JumpProcess), 'engine' (dedicated tau-leap engine, see `engines.py`) or 'flepimop' (configuration file run by the flepiMoP command line interface)
+# dense: the mobility matrix is passed as a dense array instead of a sparse matrix, max_patches: larger networks are skipped (memory)
+# integration: the fixed-step engines integrate as flepiMoP's configuration does (`seir.integration`, read when the engine runs)
+engines = {
+    'numpy': {'module': 'models', 'class': 'spatial_ODE_SIR', 'kind': 'ode'},
+    'numba': {'module': 'models', 'class': 'spatial_ODE_SIR_numba', 'kind': 'ode'},
+    'numpy_fixed_step': {'module': 'models', 'class': 'spatial_ODE_SIR', 'kind': 'ode', 'integration': 'use_flepiMoP/w_age_groups/SIR_BE_w_age.yml'},
+    'numba_fixed_step': {'module': 'models', 'class': 'spatial_ODE_SIR_numba', 'kind': 'ode', 'integration': 'use_flepiMoP/w_age_groups/SIR_BE_w_age.yml'},
+    'legacy': {'module': 'models_legacy', 'class': 'spatial_ODE_SIR', 'kind': 'ode', 'max_patches': 2500},
+    'legacy_numba': {'module': 'models_legacy', 'class': 'spatial_ODE_SIR_numba', 'kind': 'ode', 'dense': True, 'max_patches': 2500},
+    'tensorflow': {'module': 'models', 'class': 'spatial_ODE_SIR_tf', 'kind': 'ode', 'dense': True, 'max_patches': 1000},
+    'stochastic': {'module': 'models', 'class': 'spatial_TL_SIR', 'kind': 'jump'},
+    'stochastic_numba': {'module': 'models', 'class': 'spatial_TL_SIR_numba', 'kind': 'jump'},
+    'tau_leap': {'module': 'engines', 'class': 'TauLeapSIR', 'kind': 'engine'},
+    'hybrid': {'module': 'engines', 'class': 'HybridSIR', 'kind': 'engine'},
+    'flepimop_w_age': {'config': 'use_flepiMoP/w_age_groups/SIR_BE_w_age.yml', 'kind': 'flepimop'},
+    'flepimop_w_age_rowsum': {'config': 'use_flepiMoP/w_age_groups/SIR_BE_w_age_rowsum.yml', 'kind': 'flepimop'},
+    'flepimop_wo_age': {'config': 'use_flepiMoP/wo_age_groups/SIR_BE_wo_age.yml', 'kind': 'flepimop'},
+}
+# the legacy models mix on the visited patches' populations instead of factorising the contact tensor, so they do not agree exactly with the reference
+reference = 'numpy'
+
+##############
+## Networks ##
+##############
+
+def belgium():
+    """ Returns the demography and (sparse) mobility matrix of the 581 Belgian municipalities
+    """
+    coordinates = construct_coordinates_dictionary()
+    return {'network': 'belgium', 'coordinates': coordinates, 'population': np.array(load_demography_2017()['population']),
+            'M': get_mobility_matrix(sparse=True)}
+
+def synthetic_network(n, seed=0, k=20, fraction_traveling=0.2):
+    """
+    Generates a synthetic network of `n` patches: patches are scattered uniformly with a constant density, have log-normally distributed populations with the Belgian age distribution,
+    and every patch sends `fraction_traveling` of its inhabitants to its `k` nearest neighbours, in proportion to their population divided by the squared distance (gravity model).
+
+    output
+    ------
+    network: dict
+        Keys: 'network', 'coordinates', 'population' (shape (4, n)) and 'M' (row-normalised `scipy.sparse.csr_array`, shape (n, n)).
+    """
+    rng = np.random.default_rng(seed)
+    xy = rng.uniform(0, np.sqrt(n), size=(n, 2))
+    age_distribution = np.array(load_demography_2017()['population']).sum(axis=1)
+    age_distribution /= age_distribution.sum()
+    population = np.round(np.outer(age_distribution, rng.lognormal(np.log(10000), 1, size=n)))
+
+    # gravity model on the k nearest neighbours
+    k = min(k, n - 1)
+    distance, neighbour = cKDTree(xy).query(xy, k=k+1)
+    distance, neighbour = distance[:, 1:], neighbour[:, 1:]
+    weight = population.sum(axis=0)[neighbour] / np.maximum(distance, 1e-3)**2
+    weight *= fraction_traveling / weight.sum(axis=1, keepdims=True)
+    M = csr_array((weight.ravel(), (np.repeat(np.arange(n), k), neighbour.ravel())), shape=(n, n))
+    M = csr_array(M + diags_array(np.full(n, 1 - fraction_traveling)))
+
+    coordinates = {'age': ['0-5', '5-15', '15-65', '65+'], 'location': list(range(n))}
+    return {'network': 'synthetic', 'coordinates': coordinates, 'population': population, 'M': M}
+
+def initial_states(population, n_seeds=5, n_infected=10):
+    """ Seeds `n_infected` infected aged 15-65 in the `n_seeds` most populous patches
+    """
+    I0 = np.zeros_like(population)
+    I0[2, np.argsort(-population.sum(axis=0), kind='stable')[:n_seeds]] = n_infected
+    return {'S': population - I0, 'I': I0}
+
+################
+## Benchmarks ##
+################
+
+def per_call(fn, repeat=5):
+    """ Returns the fastest time per call of `fn` (seconds)
+    """
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+def peak_memory(fn):
+    """ Returns the peak memory allocated while calling `fn` (MB, as traced by `tracemalloc`)
+    """
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1] / 1e6
+    finally:
+        tracemalloc.stop()
+
+def build_model(engine, network, params):
+    """ Initialises the model of a pySODM-based engine on a network
+    """
+    spec = engines[engine]
+    model_class = getattr(importlib.import_module(spec['module']), spec['class'])
+    params = dict(params, M=network['M'].toarray() if spec.get('dense') else network['M'])
+    states = initial_states(network['population'])
+    if spec['kind'] == 'engine':
+        return model_class(states, params, network['coordinates'])
+    return model_class(states=states, parameters=params, coordinates=network['coordinates'])
+
+def rhs(engine, model, tau):
+    """ Returns a function evaluating the right-hand side of a model once, at its initial state
+    """
+    kind = engines[engine]['kind']
+    if kind == 'ode':
+        fun = model._create_fun(None)
+        y0 = np.concatenate([np.ravel(model.initial_states[k]) for k in model.state_shapes])
+        return lambda: fun(0, y0, model.parameters)
+    if kind == 'jump':
+        states = [model.initial_states[k] for k in model.states_names]
+        params = [model.parameters[k] for k in model.parameters_names_modeldeclaration]
+        return lambda: model.compute_rates(0, *states, *params)
+    model._y[...] = model.initial_states
+    return lambda: model._transitioning_probabilities(tau)
+
+def sim_kwargs(engine):
+    """ Returns the arguments of `sim()` of an ODE engine (the integration method and timestep of its flepiMoP configuration for the fixed-step engines)
+    """
+    if 'integration' not in engines[engine]:
+        return {}
+    method, dt = read_integration_config(os.path.join(repository_dir, engines[engine]['integration']))
+    return {'method': method, 'dt': dt}
+
+def season(engine, model, days, tau, seed):
+    """ Returns a function simulating a season, returning the national number of infected per day
+    """
+    kind = engines[engine]['kind']
+    if kind == 'ode':
+        kwargs = sim_kwargs(engine)
+        sim = lambda: model.sim(days, **kwargs)
+    elif kind == 'jump':
+        sim = lambda: model.sim(days, tau=tau)
+    else:
+        sim = lambda: model.sim(days, tau=tau, seed=seed)
+    return lambda: sim()['I'].sum(dim=['age', 'location']).values
+
+def throughput(engine, model, network, params, days, tau, n_draws, processes, seed):
+    """ Returns the number of simulated seasons per second of an ensemble, and the national number of infected averaged over the ensemble
+    """
+    kind = engines[engine]['kind']
+    t0 = time.perf_counter()
+    if kind == 'jump':
+        out = simulate_ensemble(type(model), initial_states(network['population']), dict(params, M=network['M']), network['coordinates'],
+                                days, n_draws, seed=seed, processes=processes, tau=tau)
+        I = out['I'].sum(dim=['age', 'location']).mean(dim='draw').values
+    elif kind == 'engine':
+        # dedicated engines simulate their realisations sequentially
+        I = np.mean([model.sim(days, tau=tau, seed=ss)['I'].sum(dim=['age', 'location']).values for ss in np.random.SeedSequence(seed).spawn(n_draws)], axis=0)
+    elif engine == reference:
+        # batch of identical draws integrated at once (see `models.spatial_ODE_SIR_ensemble`)
+        from models import spatial_ODE_SIR_ensemble
+        from utils import broadcast_to_draws
+        coordinates = {'draw': list(range(n_draws)), **network['coordinates']}
+        states = {k: broadcast_to_draws(v, n_draws) for k, v in initial_states(network['population']).items()}
+        batch = spatial_ODE_SIR_ensemble(states=states, parameters=dict(params, M=network['M'], **{k: np.full(n_draws, params[k]) for k in ['beta', 'gamma', 'f_v']}), coordinates=coordinates)
+        I = batch.sim(days)['I'].sum(dim=['age', 'location']).mean(dim='draw').values
+    else:
+        return None, None
+    return n_draws / (time.perf_counter() - t0), I
+
+def flepimop_command():
+    """ Returns the command line interface of flepiMoP (None if it is not installed)
+    """
+    if shutil.which('flepimop'):
+        return ['flepimop', 'simulate']
+    if shutil.which('gempyor-simulate'):
+        return ['gempyor-simulate', '-c']
+    return None
+
+def run_flepimop(engine, network, days):
+    """ Exports the network as flepiMoP model inputs next to a copy of the engine's configuration, runs it, returns the wall time (s) and the peak memory of flepiMoP (MB, resident)
+    """
+    import yaml
+    sys.path.insert(0, os.path.join(repository_dir, 'use_flepiMoP'))
+    from exporter import export_model_input, age_group_names
+
+    with open(os.path.join(repository_dir, engines[engine]['config'])) as f:
+        config = yaml.safe_load(f)
+    config['end_date'] = (datetime.strptime(str(config['start_date']), '%Y-%m-%d') + timedelta(days=days)).strftime('%Y-%m-%d')
+    states = dict(initial_states(network['population']), R=np.zeros_like(network['population']))
+    age_groups = config['compartments'].get('age')
+    # flepiMoP takes the number of commuters, the diagonal (staying home) is dropped by the exporter
+    commuters = network['M'].multiply(network['population'].sum(axis=0)[:, np.newaxis])
+
+    with tempfile.TemporaryDirectory() as directory:
+        export_model_input(os.path.join(directory, 'model_input'), np.asarray(network['coordinates']['location']), network['population'],
+                            commuters.toarray() if len(network['coordinates']['location']) <= 2500 else commuters, states,
+                            age_groups=age_group_names(['[0, 5)', '[5, 15)', '[15, 65)', '[65, 120)']) if age_groups else None)
+        with open(os.path.join(directory, 'config.yml'), 'w') as f:
+            yaml.safe_dump(config, f, sort_keys=False)
+        t0 = time.perf_counter()
+        subprocess.run(flepimop_command() + ['config.yml'], cwd=directory, check=True, capture_output=True)
+        wall = time.perf_counter() - t0
+    # maximum resident set size of all finished child processes (kB on Linux)
+    return wall, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1e3
+
+def benchmark(engine, network, params, days=120, tau=0.5, n_draws=10, processes=None, seed=0, memory=True, I_ref=None, profile=False):
+    """
+    Benchmarks one engine on one network
+
+    output
+    ------
+    result: dict
+        Keys: 'engine', 'network', 'n_patches', 'nnz' (mobility matrix), 'rhs_us' (time per call of the right-hand side), 'season_s' (wall time of a season), 'peak_mb' (peak memory of a season),
+        'draws_per_s' (ensemble throughput), 'agreement' (maximum difference of the national number of infected with the reference engine, relative to its peak; ensemble mean for stochastic engines), 'status' and, internally, 'I' (national number of infected).
+        If `profile`, 'profile' holds the hot-path statistics of a season (see `profiling.Profiler.report`).
+    """
+    spec = engines[engine]
+    n = len(network['coordinates']['location'])
+    result = {'engine': engine, 'network': network['network'], 'n_patches': n, 'nnz': int(network['M'].nnz),
+              'rhs_us': None, 'season_s': None, 'peak_mb': None, 'draws_per_s': None, 'agreement': None, 'status': 'ok'}
+    if n > spec.get('max_patches', np.inf):
+        result['status'] = f"skipped: more than {spec['max_patches']} patches"
+        return result
+    try:
+        if spec['kind'] == 'flepimop':
+            if flepimop_command() is None:
+                result['status'] = 'skipped: flepiMoP is not installed'
+                return result
+            result['season_s'], result['peak_mb'] = run_flepimop(engine, network, days)
+            return result
+
+        if engine == 'tensorflow' and importlib.import_module('models').tf is None:
+            result['status'] = 'skipped: tensorflow is not installed'
+            return result
+        model = build_model(engine, network, params)
+        # warm up (numba compilation, caches)
+        fn = rhs(engine, model, tau)
+        fn()
+        result['rhs_us'] = per_call(fn) * 1e6
+        run = season(engine, model, days, tau, seed)
+        t0 = time.perf_counter()
+        I = run()
+        result['season_s'] = time.perf_counter() - t0
+        if memory:
+            result['peak_mb'] = peak_memory(run)
+        if profile:
+            profiler = Profiler()
+            with profiler.instrument(model):
+                run()
+            result['profile'] = profiler.report()
+        if n_draws:
+            result['draws_per_s'], I_mean = throughput(engine, model, network, params, days, tau, n_draws, processes, seed)
+            if spec['kind'] != 'ode' and I_mean is not None:
+                I = I_mean
+        result['I'] = I
+        if I_ref is not None:
+            result['agreement'] = float(np.max(np.abs(I - I_ref)) / np.max(I_ref))
+    except Exception as e:
+        result['status'] = f"failed: {type(e).__name__}: {e}"
+    return result
+
+def metadata(args):
+    """ Returns the machine, software versions and settings of a benchmark run
+    """
+    versions = {}
+    for package in ['numpy', 'scipy', 'numba', 'pySODM', 'tensorflow', 'gempyor']:
+        try:
+            versions[package] = importlib.import_module(package).__version__
+        except Exception:
+            versions[package] = None
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repository_dir, capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        commit = None
+    return {'date': datetime.now().isoformat(timespec='seconds'), 'commit': commit, 'machine': platform.platform(), 'processor': platform.processor(),
+            'cpu_count': os.cpu_count(), 'python': platform.python_version(), 'versions': versions, 'settings': vars(args)}
+
+def compare(results, previous):
+    """ Returns the ratio of the timings to those of a previous run (> 1: slower), per engine and number of patches
+    """
+    columns = ['rhs_us', 'season_s', 'peak_mb', 'draws_per_s']
+    now = pd.DataFrame(results).set_index(['engine', 'n_patches'])[columns].astype(float)
+    before = pd.DataFrame(previous['results']).set_index(['engine', 'n_patches'])[columns].astype(float)
+    return (now / before).dropna(how='all')
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmarks the engines of the age-stratified spatially-explicit SIR model")
+    parser.add_argument("-e", "--engines", help="Engines to benchmark (default: all)", nargs='+', default=list(engines), choices=list(engines))
+    parser.add_argument("-n", "--patches", help="Numbers of patches. 581 is the Belgian network, other numbers are synthetic networks", nargs='+', default=[581, 1000, 2500, 5000, 10000], type=int)
+    parser.add_argument("-d", "--days", help="Length of a season (days)", default=120, type=int)
+    parser.add_argument("--tau", help="Leap size of the stochastic engines (days)", default=0.5, type=float)
+    parser.add_argument("--n_draws", help="Number of realisations to measure the ensemble throughput (0: skip)", default=10, type=int)
+    parser.add_argument("-p", "--processes", help="Number of worker processes of the stochastic ensembles (default: sequential)", default=None, type=int)
+    parser.add_argument("--seed", help="Seed of the synthetic networks and the stochastic engines", default=0, type=int)
+    parser.add_argument("--no_memory", help="Skip the (slower, traced) measurement of the peak memory", action='store_true')
+    parser.add_argument("--profile", help="Add the hot-path statistics of a season (calls, stages of the force of infection, solver steps) to the results", action='store_true')
+    parser.add_argument("-o", "--output", help="Path of the JSON results (default: benchmark_results/benchmark_<date>.json)", default=None)
+    parser.add_argument("--compare", help="Path of previous JSON results to compare to", default=None)
+    args = parser.parse_args()
+
+    # the reference engine goes first, the agreement of the others is measured against it
+    selected = sorted(args.engines, key=lambda engine: engine != reference)
+    params = {'beta': 0.03, 'gamma': 5, 'f_v': 0.1, 'N': get_contact_matrix()}
+
+    results = []
+    for n in args.patches:
+        network = belgium() if n == 581 else synthetic_network(n, seed=args.seed)
+        I_ref = None
+        for engine in selected:
+            result = benchmark(engine, network, params, args.days, args.tau, args.n_draws, args.processes, args.seed, not args.no_memory, I_ref, args.profile)
+            I = result.pop('I', None)
+            if engine == reference:
+                I_ref = I
+            results.append(result)
+            print({k: (round(v, 4) if isinstance(v, float) else v) for k, v in result.items()}, flush=True)
+
+    #################
+    ## Save result ##
+    #################
+
+    output = args.output or os.path.join('benchmark_results', f"benchmark_{datetime.now().strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({'metadata': metadata(args), 'results': results}, f, indent=1)
+    print(pd.DataFrame(results).set_index(['n_patches', 'engine']).drop(columns=['network', 'profile'], errors='ignore').to_string())
+    print(f"results saved to {output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            print(f"ratio to {args.compare} (> 1: slower, or more memory/throughput):")
+            print(compare(results, json.load(f)).to_string())
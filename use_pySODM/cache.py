@@ -0,0 +1,94 @@
+"""
+This script contains a persistent cache for the model inputs: source files are parsed once into binary .npy artifacts, keyed by the content hash of the source files, and memory-mapped afterwards.
+"""
+
+__author__      = "Tijs Alleman"
+__copyright__   = "Copyright (c) 2024 by T.W. Alleman, IDD Group, Johns Hopkins Bloomberg School of Public Health. All Rights Reserved."
+
+import os
+import hashlib
+import shutil
+import tempfile
+import numpy as np
+
+# paths are resolved relative to the package, not to the working directory
+package_dir = os.path.dirname(os.path.abspath(__file__))
+data_dir = os.path.abspath(os.path.join(package_dir, '../data'))
+cache_dir = os.environ.get('FLEPIMOP_INFLUENZA_BE_CACHE', os.path.join(package_dir, '.cache'))
+
+def data_path(*parts):
+    """ Returns the absolute path of a file in the repository's `data` folder, f.i. `data_path('interim', 'census_2011', 'demography_municipalities_2011_sorted.csv')`
+    """
+    return os.path.join(data_dir, *parts)
+
+##################
+## Content hash ##
+##################
+
+# per-process memo of file hashes, invalidated when a file's size or modification time changes
+_hashes = {}
+
+def hash_files(paths):
+    """ Returns the sha256 hex digest of the contents of a list of files
+    """
+    h = hashlib.sha256()
+    for path in paths:
+        stat = os.stat(path)
+        key = (path, stat.st_size, stat.st_mtime_ns)
+        if key not in _hashes:
+            with open(path, 'rb') as f:
+                _hashes[key] = hashlib.file_digest(f, 'sha256').hexdigest()
+        h.update(_hashes[key].encode())
+    return h.hexdigest()
+
+###########
+## Cache ##
+###########
+
+# per-process memo of the memory-mapped artifacts
+_loaded = {}
+
+def cached_arrays(name, sources, build):
+    """
+    Returns the arrays built from a list of source files, building and saving them to the cache on first use.
+
+    input
+    -----
+    name: str
+        Name of the artifact (unique per `build` function).
+
+    sources: list of str
+        Absolute paths of the source files. The artifact is rebuilt when the contents of any of these files change.
+
+    build: callable
+        Function without arguments that parses the source files, returns a dictionary of np.ndarrays (numerical or fixed-width strings, no objects).
+
+    output
+    ------
+    arrays: dict
+        The arrays, memory-mapped read-only from the cache. Copy an array before altering it.
+    """
+    digest = hash_files(sources)[:16]
+    if (name, digest) in _loaded:
+        return _loaded[(name, digest)]
+
+    directory = os.path.join(cache_dir, f'{name}-{digest}')
+    if not os.path.isdir(directory):
+        # build in a temporary directory and move it in place atomically, so concurrent workers never see half-written artifacts
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=cache_dir, prefix=f'.{name}-')
+        try:
+            for key, X in build().items():
+                np.save(os.path.join(tmp, f'{key}.npy'), np.asarray(X), allow_pickle=False)
+            os.rename(tmp, directory)
+        except OSError:
+            # another process got there first
+            if not os.path.isdir(directory):
+                raise
+        finally:
+            if os.path.isdir(tmp):
+                shutil.rmtree(tmp)
+
+    arrays = {f[:-4]: np.load(os.path.join(directory, f), mmap_mode='r') for f in sorted(os.listdir(directory)) if f.endswith('.npy')}
+    _loaded[(name, digest)] = arrays
+    return arrays
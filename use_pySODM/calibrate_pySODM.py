@@ -0,0 +1,118 @@
+"""
+This script calibrates the age-stratified, spatially-explicit SIR model for Belgium to the weekly ILI data of the 2017-2018 season using pySODM and emcee
+"""
+
+__author__      = "Tijs Alleman"
+__copyright__   = "Copyright (c) 2024 by T.W. Alleman, IDD Group, Johns Hopkins Bloomberg School of Public Health. All Rights Reserved."
+
+import argparse
+import numpy as np
+
+from utils import construct_coordinates_dictionary, \
+                    get_contact_matrix, get_mobility_matrix, \
+                        load_demography_2017, load_ILI_2017_2018
+from calibration import log_posterior_probability, run_EnsembleSampler, ll_poisson_profiled
+from emulator import GPEmulator, emulated_log_posterior_probability, train_emulator
+from resolution import levels, coarse_model
+
+############################
+## Command-line arguments ##
+############################
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-n", "--n_iterations", help="Number of emcee iterations", default=100, type=int)
+parser.add_argument("-p", "--processes", help="Number of worker processes (default: evaluate in the current process)", default=None, type=int)
+parser.add_argument("-b", "--backend", help="Path of the HDF5 backend. An existing backend is resumed.", default='calibration_results/ILI_2017_2018.hdf5')
+parser.add_argument("-w", "--walkers_per_parameter", help="Number of emcee walkers per calibrated parameter", default=4, type=int)
+parser.add_argument("-e", "--emulator", help="Sample a Gaussian-process emulator of the model instead of the model (trained on a few hundred simulations, saved in the backend)", action='store_true')
+parser.add_argument("--n_initial", help="Emulator: number of simulations in the initial design", default=100, type=int)
+parser.add_argument("--n_rounds", help="Emulator: number of active learning rounds", default=10, type=int)
+parser.add_argument("--n_batch", help="Emulator: number of simulations added per round", default=20, type=int)
+parser.add_argument("-l", "--level", help="Spatial resolution of the calibrated model (the inputs of the municipalities are aggregated)", default='municipality', choices=levels)
+parser.add_argument("-r", "--refine", help="Coarse-to-fine: after calibrating at `--level`, continue at municipality level for this many iterations, starting from the last coarse walker positions", default=0, type=int)
+args = parser.parse_args()
+
+##############
+## Settings ##
+##############
+
+# simulation starts on the Monday before the first week of data
+start_date = '2017-10-02'
+# initial fraction of infected (in every municipality and age group)
+initial_prevalence = 1e-6
+# calibrated parameters, their bounds and the centre of the walkers' initial positions
+parameter_names = ['beta', 'gamma', 'f_v']
+bounds = [(0.001, 0.1), (0.5, 15), (0, 1)]
+theta_0 = [0.009, 6.5, 0.05]
+
+#################
+## Setup model ##
+#################
+
+# coordinates
+coordinates = construct_coordinates_dictionary()
+# parameters
+params = {'beta': theta_0[0],                           # infectivity (-)
+          'gamma': theta_0[1],                          # duration of infection (d)
+          'f_v': theta_0[2],                            # fraction of total contacts on visited patch
+          'N': get_contact_matrix(),                    # contact matrix
+          'M': get_mobility_matrix(),                   # origin-destination mobility matrix
+          }
+
+# initial states
+population = np.array(load_demography_2017()['population'])
+I0 = initial_prevalence * population
+init_states = {'S': population - I0,
+               'I': I0
+               }
+
+# initialize model (at the requested spatial resolution)
+from models import spatial_ODE_SIR as my_model
+model = my_model(states=init_states, parameters=params, coordinates=coordinates)
+coarse = coarse_model(my_model, init_states, params, coordinates, args.level) if args.level != 'municipality' else model
+
+###############
+## Calibrate ##
+###############
+
+if __name__ == '__main__':
+
+    data = load_ILI_2017_2018()
+    log_posterior = log_posterior_probability(coarse, parameter_names, bounds, data, start_date)
+    # the coarse chain gets its own backend
+    backend = args.backend if args.level == 'municipality' else args.backend.replace('.hdf5', f'_{args.level}.hdf5')
+
+    # replace the model by an emulator (rebuilt from the backend when resuming)
+    if args.emulator:
+        emulator = GPEmulator.load(backend)
+        if emulator is None:
+            log_posterior = train_emulator(log_posterior, n_initial=args.n_initial, n_rounds=args.n_rounds, n_batch=args.n_batch, processes=args.processes)
+            log_posterior.emulator.save(backend)
+        else:
+            log_posterior = emulated_log_posterior_probability(emulator, log_posterior)
+        print(f"emulator trained on {len(log_posterior.emulator.X)} simulations")
+
+    # initial positions: +/- 10% around theta_0
+    n_walkers = args.walkers_per_parameter * len(parameter_names)
+    pos = np.array(theta_0) * (1 + 0.1 * np.random.uniform(low=-1, high=1, size=(n_walkers, len(parameter_names))))
+
+    sampler = run_EnsembleSampler(log_posterior, pos, args.n_iterations, backend, processes=None if args.emulator else args.processes)
+
+    # coarse-to-fine: refine the coarse posterior with the municipality-level model
+    if args.level != 'municipality' and args.refine:
+        log_posterior = log_posterior_probability(model, parameter_names, bounds, data, start_date)
+        sampler = run_EnsembleSampler(log_posterior, sampler.get_chain()[-1], args.refine, args.backend, processes=args.processes)
+        args.emulator = False
+
+    #####################
+    ## Summarise chain ##
+    #####################
+
+    samples = sampler.get_chain(discard=sampler.iteration // 2, flat=True)
+    for name, x in zip(parameter_names, samples.T):
+        print(f"{name}: {np.median(x):.4g} (95% CI: {np.quantile(x, 0.025):.4g} - {np.quantile(x, 0.975):.4g})")
+    theta_hat = sampler.get_chain(flat=True)[np.argmax(sampler.get_log_prob(flat=True))]
+    _, rho = ll_poisson_profiled(log_posterior.simulate(theta_hat), log_posterior.ydata)
+    if args.emulator:
+        print(f"loglikelihood at the maximum a posteriori estimate: {sampler.get_log_prob(flat=True).max():.6g} (emulator), {log_posterior_probability(coarse, parameter_names, bounds, data, start_date)(theta_hat):.6g} (model)")
+    print(f"fraction of infections observed as ILI (at the maximum a posteriori estimate): {rho:.3g}")
@@ -0,0 +1,256 @@
+"""
+This script contains the building blocks to calibrate the age-stratified spatially-explicit SIR models to the weekly ILI data using emcee: the log posterior probability, a memoizing process pool and a resumable HDF5-backed ensemble sampler.
+"""
+
+__author__      = "Tijs Alleman"
+__copyright__   = "Copyright (c) 2024 by T.W. Alleman, IDD Group, Johns Hopkins Bloomberg School of Public Health. All Rights Reserved."
+
+import os
+import sys
+import time
+import h5py
+import emcee
+import numpy as np
+from collections import OrderedDict
+from multiprocessing import get_context
+from scipy.special import gammaln
+from observation import WeeklyObservation, simulate_weekly_ILI
+
+#######################
+## Observation model ##
+#######################
+
+def ll_poisson_profiled(ymodel, ydata):
+    """
+    Loglikelihood of the Poisson distribution with mean `rho * ymodel`, where the fraction of infections observed `rho` is profiled out (maximum likelihood estimate: rho = sum(ydata) / sum(ymodel)).
+
+    output
+    ------
+    ll: float
+        Loglikelihood.
+
+    rho: float
+        Fraction of infections observed.
+    """
+    ymodel = np.maximum(ymodel, 1e-12)
+    rho = np.sum(ydata) / np.sum(ymodel)
+    ll = np.sum(ydata * np.log(rho * ymodel)) - rho * np.sum(ymodel) - np.sum(gammaln(ydata + 1))
+    return ll, rho
+
+###################
+## Log posterior ##
+###################
+
+class log_posterior_probability:
+    """
+    Log posterior probability of the weekly ILI data, given values of the calibrated parameters of a pySODM model of the SIR family (uniform priors).
+
+    input
+    -----
+    model: pySODM.models.base.ODE
+        Model with a state 'S' of dimensions ['age', 'location'], f.i. `models.spatial_ODE_SIR`. Simulated from time 0 (the `start_date`).
+
+    parameter_names: list of str
+        Names of the calibrated parameters, f.i. ['beta', 'gamma', 'f_v'].
+
+    bounds: list of tuples
+        Lower and upper bound of every calibrated parameter.
+
+    data: dict
+        Keys: 'date' (midpoints of the weeks) and 'cases' (weekly cases, shape (n_weeks, n_age)), f.i. `utils.load_ILI_2017_2018()`.
+
+    start_date: str or datetime
+        Date corresponding to time 0 of the simulation.
+    """
+
+    def __init__(self, model, parameter_names, bounds, data, start_date):
+        self.model = model
+        self.parameter_names = list(parameter_names)
+        self.bounds = np.asarray(bounds, np.float64)
+        self.ydata = np.asarray(data['cases'], np.float64)
+        self.observation = WeeklyObservation(data['date'], start_date, n_age=self.ydata.shape[1])
+        self.start_date = start_date
+
+    def simulate(self, theta):
+        """ Simulates the model with the calibrated parameters set to `theta`, returns the weekly number of new infections. Shape (n_weeks, n_age)
+        """
+        self.model.parameters.update(dict(zip(self.parameter_names, theta)))
+        return simulate_weekly_ILI(self.model, self.observation).copy()
+
+    def __call__(self, theta):
+        theta = np.asarray(theta, np.float64)
+        if np.any(theta < self.bounds[:, 0]) or np.any(theta > self.bounds[:, 1]):
+            return -np.inf
+        ll, _ = ll_poisson_profiled(self.simulate(theta), self.ydata)
+        return ll if np.isfinite(ll) else -np.inf
+
+##################
+## Process pool ##
+##################
+
+# every worker inherits the log posterior probability (and its model) from the parent process once
+_worker = {}
+
+def _init_worker(log_posterior):
+    _worker['log_posterior'] = log_posterior
+
+def _evaluate(theta):
+    return _worker['log_posterior'](theta)
+
+def _simulate(theta):
+    return _worker['log_posterior'].simulate(theta)
+
+def simulate_design(log_posterior, thetas, processes=None):
+    """ Simulates the weekly number of new infections for every parameter vector in `thetas` (see `log_posterior_probability.simulate`), on a pool of `processes` worker processes. Shape (n_thetas, n_weeks, n_age)
+    """
+    _init_worker(log_posterior)
+    if processes:
+        with get_context("fork").Pool(processes, initializer=_init_worker, initargs=(log_posterior,)) as pool:
+            return np.array(pool.map(_simulate, list(thetas)))
+    return np.array([_simulate(theta) for theta in thetas])
+
+class MemoizedPool:
+    """
+    Evaluates a log posterior probability on a pool of worker processes, for use as the `pool` of an `emcee.EnsembleSampler`.
+
+    Evaluations are memoized in the parent process: a parameter vector evaluated before (or twice in the same batch) is not simulated again.
+    Tracks the wall-clock time spent on new evaluations.
+
+    input
+    -----
+    log_posterior: callable
+        Log posterior probability. The workers are forked from the parent and build nothing themselves.
+
+    processes: int or None
+        Number of worker processes. If None, evaluations run in the current process.
+
+    maxsize: int
+        Maximum number of memoized evaluations (least-recently used are discarded first).
+    """
+
+    def __init__(self, log_posterior, processes=None, maxsize=100000):
+        _init_worker(log_posterior)
+        self.processes = processes
+        self.pool = get_context("fork").Pool(processes, initializer=_init_worker, initargs=(log_posterior,)) if processes else None
+        self.maxsize = maxsize
+        self.memo = OrderedDict()
+        self.n_evaluations = 0
+        self.n_hits = 0
+        self.wall_time = 0.0
+
+    def map(self, fn, thetas):
+        """ Evaluates the log posterior probability of every parameter vector in `thetas` (`fn` is emcee's wrapper of the log posterior and is ignored: the workers evaluate their own copy)
+        """
+        keys = [np.asarray(theta, np.float64).tobytes() for theta in thetas]
+        new = list(OrderedDict.fromkeys(k for k in keys if k not in self.memo))
+        self.n_hits += len(keys) - len(new)
+        if new:
+            tic = time.perf_counter()
+            args = [np.frombuffer(k, np.float64) for k in new]
+            results = self.pool.map(_evaluate, args) if self.pool else list(map(_evaluate, args))
+            self.wall_time += time.perf_counter() - tic
+            self.n_evaluations += len(new)
+            self.memo.update(zip(new, results))
+        for k in keys:
+            self.memo.move_to_end(k)
+        while len(self.memo) > self.maxsize:
+            self.memo.popitem(last=False)
+        return [self.memo[k] for k in keys]
+
+    @property
+    def seconds_per_1000_evaluations(self):
+        return 1000 * self.wall_time / self.n_evaluations if self.n_evaluations else np.nan
+
+    def close(self):
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        if self.pool:
+            self.pool.terminate()
+
+######################
+## Ensemble sampler ##
+######################
+
+def run_EnsembleSampler(log_posterior, pos, n_iterations, backend_path, processes=None, print_n=10, moves=None):
+    """
+    Samples the log posterior probability with an `emcee.EnsembleSampler`, writing the chains to an HDF5 backend after every iteration.
+
+    If the backend already holds samples, the run resumes from its last walker positions, log posterior probabilities and random state (`pos` is then ignored), and `n_iterations` more iterations are performed.
+    The number of evaluations and the wall-clock time per 1000 evaluations are tracked (cumulative over resumed runs) in the attributes of the backend's 'mcmc' group.
+
+    input
+    -----
+    log_posterior: callable
+        Log posterior probability, f.i. `log_posterior_probability`.
+
+    pos: np.ndarray
+        Initial positions of the walkers. Shape (n_walkers, n_parameters).
+
+    n_iterations: int
+        Number of iterations.
+
+    backend_path: str
+        Path of the HDF5 backend.
+
+    processes: int or None
+        Number of worker processes. If None, the log posterior probability is evaluated in the current process.
+
+    print_n: int
+        Print progress and update the tracked metrics every `print_n` iterations.
+
+    moves: list or None
+        emcee moves (default: emcee's stretch move).
+
+    output
+    ------
+    sampler: emcee.EnsembleSampler
+        The sampler.
+    """
+
+    backend = emcee.backends.HDFBackend(backend_path, name='mcmc')
+    if os.path.exists(backend_path) and backend.initialized and backend.iteration > 0:
+        state = backend.get_last_sample()
+        print(f"Resuming '{backend_path}' after {backend.iteration} iterations")
+    else:
+        os.makedirs(os.path.dirname(os.path.abspath(backend_path)), exist_ok=True)
+        backend.reset(*np.shape(pos))
+        state = np.asarray(pos, np.float64)
+        print(f"Created new backend '{backend_path}'")
+    n_walkers, n_parameters = backend.shape
+    metrics = read_metrics(backend_path)
+    sys.stdout.flush()
+
+    with MemoizedPool(log_posterior, processes) as pool:
+        sampler = emcee.EnsembleSampler(n_walkers, n_parameters, log_posterior, pool=pool, backend=backend, moves=moves)
+        for i, _ in enumerate(sampler.sample(state, iterations=n_iterations, store=True), start=1):
+            if i % print_n == 0 or i == n_iterations:
+                write_metrics(backend_path, metrics, pool)
+                print(f"iteration {backend.iteration}: acceptance fraction {np.mean(sampler.acceptance_fraction):.2f}, "
+                      f"{pool.n_evaluations} evaluations ({pool.n_hits} memoized), {pool.seconds_per_1000_evaluations:.1f} s per 1000 evaluations")
+                sys.stdout.flush()
+        pool.close()
+
+    return sampler
+
+def read_metrics(backend_path):
+    """ Returns the evaluation metrics of previous runs stored in the attributes of the backend's 'mcmc' group
+    """
+    with h5py.File(backend_path, 'r') as f:
+        attrs = f['mcmc'].attrs
+        return {k: float(attrs.get(k, 0)) for k in ['n_evaluations', 'wall_time']}
+
+def write_metrics(backend_path, previous, pool):
+    """ Writes the evaluation metrics, cumulative over resumed runs, to the attributes of the backend's 'mcmc' group
+    """
+    n_evaluations = previous['n_evaluations'] + pool.n_evaluations
+    wall_time = previous['wall_time'] + pool.wall_time
+    with h5py.File(backend_path, 'a') as f:
+        f['mcmc'].attrs['n_evaluations'] = n_evaluations
+        f['mcmc'].attrs['wall_time'] = wall_time
+        f['mcmc'].attrs['seconds_per_1000_evaluations'] = 1000 * wall_time / n_evaluations if n_evaluations else np.nan
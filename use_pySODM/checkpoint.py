@@ -0,0 +1,323 @@
+"""
+This script contains checkpointing of the age-stratified spatially-explicit SIR models: the states at a given time, the parameters, the state of the random number generators and the simulation time
+are saved to a compact (compressed HDF5) file, from which later runs resume with updated parameters, f.i. to integrate only the forward horizon of a weekly in-season forecast,
+or from which many scenarios are branched.
+
+usage:
+    out = model.sim(['2017-10-02', '2017-12-04'])
+    Checkpoint.from_output(model, out).save('week_49.h5')
+    ...
+    checkpoint = Checkpoint.load('week_49.h5')
+    forecast = checkpoint.resume(spatial_ODE_SIR, '2018-01-15', parameters={'beta': 0.028})
+    scenarios = checkpoint.branch(spatial_ODE_SIR, '2018-01-15', {'low': {'beta': 0.025}, 'high': {'beta': 0.035}})
+"""
+
+__author__      = "Tijs Alleman"
+__copyright__   = "Copyright (c) 2024 by T.W. Alleman, IDD Group, Johns Hopkins Bloomberg School of Public Health. All Rights Reserved."
+
+import json
+import pickle
+import random
+import h5py
+import numpy as np
+import pandas as pd
+from scipy.sparse import issparse, csr_array
+
+################
+## Checkpoint ##
+################
+
+class Checkpoint:
+    """
+    Snapshot of a simulation: states, parameters, random number generators and time.
+
+    input
+    -----
+    states: dict
+        States at the time of the checkpoint, f.i. {'S': S, 'I': I, 'R': R}. Shape (n_age, n_loc) (or as declared by the model).
+
+    parameters: dict
+        Parameters of the model. Arrays and scipy.sparse arrays are stored natively, other objects (f.i. a `schedules.Schedule`) are pickled (see `load`).
+
+    time: int/float
+        Simulation time of the checkpoint (days since the start of the simulation that produced it).
+
+    date: str, datetime or None
+        Date of the checkpoint, if the simulation was run with dates.
+
+    coordinates: dict or None
+        Model coordinates.
+
+    model: str or None
+        Name of the model class that produced the checkpoint (informative).
+
+    rng: dict or None
+        State of the random number generators (see `capture_rng`). Default: captured at construction.
+    """
+
+    def __init__(self, states, parameters, time, date=None, coordinates=None, model=None, rng=None):
+        self.states = {k: np.asarray(v) for k, v in states.items()}
+        self.parameters = dict(parameters)
+        self.time = time
+        self.date = None if date is None else pd.Timestamp(date)
+        self.coordinates = coordinates
+        self.model = model
+        self.rng = capture_rng() if rng is None else rng
+
+    @classmethod
+    def from_output(cls, model, out, time=None, draw=None, generator=None):
+        """
+        Captures a checkpoint from a simulation output. Call it right after `sim()`: the random number generators are captured in their current state.
+
+        input
+        -----
+        model: pySODM.models.base.ODE or JumpProcess
+            The simulated model (provides the parameters and coordinates).
+
+        out: xarray.Dataset
+            Output of `model.sim()`.
+
+        time: int/float, str, datetime or None
+            Time (or date) of the checkpoint, must be an output timestep. Default: the last timestep.
+
+        draw: int or None
+            Realisation to checkpoint if the output has a 'draws' dimension (`sim(N=...)`).
+
+        generator: np.random.Generator or None
+            Generator of a dedicated engine (f.i. the `seed` passed to `engines.TauLeapSIR.sim`), captured alongside the global random state.
+
+        output
+        ------
+        checkpoint: Checkpoint
+        """
+        if 'draws' in out.dims:
+            if draw is None:
+                raise ValueError(
+                    f"the output has {out.sizes['draws']} realisations ('draws'), select the one to checkpoint with 'draw'"
+                )
+            out = out.isel(draws=draw)
+        time_dim = 'date' if 'date' in out.dims else 'time'
+        snapshot = out.isel({time_dim: -1}) if time is None else out.sel({time_dim: pd.Timestamp(time) if time_dim == 'date' else time})
+        if time_dim == 'date':
+            date = pd.Timestamp(snapshot['date'].values)
+            # days since the start of the output (pySODM's time axis of a simulation with dates)
+            t = (date - pd.Timestamp(out['date'].values[0])) / pd.Timedelta(days=1)
+        else:
+            date, t = None, float(snapshot['time'].values)
+        return cls(states={k: snapshot[k].values for k in out.data_vars}, parameters=model.parameters, time=t, date=date,
+                   coordinates=getattr(model, 'coordinates', None), model=type(model).__name__, rng=capture_rng(generator))
+
+    ##########
+    ## File ##
+    ##########
+
+    def save(self, path):
+        """
+        Writes the checkpoint to a compressed HDF5 file (overwritten).
+
+        Layout: '/states/<name>' and '/parameters/<name>' datasets (sparse parameters as a group with 'data', 'indices' and 'indptr'), '/rng' with the state of the generators,
+        and the time, date, coordinates and model as attributes of the root.
+        """
+        with h5py.File(path, 'w') as f:
+            f.attrs['time'] = self.time
+            f.attrs['date'] = '' if self.date is None else self.date.isoformat()
+            f.attrs['model'] = self.model or ''
+            f.attrs['coordinates'] = json.dumps(self.coordinates, default=_to_builtin)
+            for k, v in self.states.items():
+                f.create_dataset(f'states/{k}', data=v, compression='gzip')
+            for k, v in self.parameters.items():
+                _write_parameter(f, f'parameters/{k}', v)
+            _write_rng(f.create_group('rng'), self.rng)
+        return path
+
+    @classmethod
+    def load(cls, path, allow_pickle=False):
+        """
+        Reads a checkpoint written by `save`.
+
+        Parameters other than numbers and (sparse) arrays are pickled in the checkpoint. Unpickling can execute arbitrary code, so only load them from checkpoints you trust.
+
+        input
+        -----
+        path: str
+            Checkpoint file.
+
+        allow_pickle: bool
+            Unpickle the parameters stored as pickled objects. If False (default), a checkpoint containing such a parameter raises a ValueError.
+
+        output
+        ------
+        checkpoint: Checkpoint
+        """
+        with h5py.File(path, 'r') as f:
+            return cls(states={k: v[...] for k, v in f['states'].items()},
+                       parameters={k: _read_parameter(v, allow_pickle) for k, v in f['parameters'].items()},
+                       time=float(f.attrs['time']), date=f.attrs['date'] or None,
+                       coordinates=json.loads(f.attrs['coordinates']), model=f.attrs['model'] or None,
+                       rng=_read_rng(f['rng']))
+
+    ############
+    ## Resume ##
+    ############
+
+    def simulation_time(self, stop):
+        """ Returns the pySODM simulation time from the checkpoint to `stop` (a date if the checkpoint has one, else a time)
+        """
+        if self.date is not None:
+            return [self.date, pd.Timestamp(stop)]
+        return [self.time, stop]
+
+    def restore_rng(self):
+        """ Restores the global random number generators (`np.random` and `random`, used by pySODM's stochastic solvers) to their state at the checkpoint
+        """
+        restore_rng(self.rng)
+
+    def generator(self):
+        """ Returns a `np.random.Generator` in the captured state of the generator of a dedicated engine (see `from_output`)
+        """
+        if self.rng.get('generator') is None:
+            raise ValueError(
+                "no generator was captured in the checkpoint, pass it to `Checkpoint.from_output(..., generator=...)`"
+            )
+        bit_generator = getattr(np.random, self.rng['generator']['bit_generator'])()
+        bit_generator.state = self.rng['generator']
+        return np.random.Generator(bit_generator)
+
+    def resume(self, model_class, stop, parameters=None, coordinates=None, time_dependent_parameters=None, restore_rng=True, **sim_kwargs):
+        """
+        Simulates a model from the checkpoint to `stop`.
+
+        A resumed simulation is reproducible: resuming twice from the same checkpoint (with `restore_rng=True`) gives the same realisation.
+        pySODM reseeds its stochastic solvers from the global random state at the start of every `sim()`, so a resumed realisation is not the continuation of the random stream of the uninterrupted run.
+
+        input
+        -----
+        model_class: class
+            pySODM model, f.i. `models.spatial_ODE_SIR` or `models.spatial_TL_SIR`.
+
+        stop: int/float, str or datetime
+            End of the simulation (a date if the checkpoint has one).
+
+        parameters: dict or None
+            Parameters overriding those of the checkpoint, f.i. {'beta': 0.028}.
+
+        coordinates: dict or None
+            Model coordinates. Default: those of the checkpoint.
+
+        time_dependent_parameters: dict or None
+            Time-dependent parameter functions of the model (functions are not saved in the checkpoint).
+
+        restore_rng: bool
+            Restore the random number generators to their state at the checkpoint before simulating. Default: True.
+
+        sim_kwargs:
+            Passed on to `sim()`, f.i. `method`, `tau` or `N`.
+
+        output
+        ------
+        out: xarray.Dataset
+            Simulation output, starting at the checkpoint.
+        """
+        model = model_class(states=self.states, parameters={**self.parameters, **(parameters or {})},
+                            coordinates=self.coordinates if coordinates is None else coordinates, time_dependent_parameters=time_dependent_parameters)
+        if restore_rng:
+            self.restore_rng()
+        return model.sim(self.simulation_time(stop), **sim_kwargs)
+
+    def branch(self, model_class, stop, scenarios, **resume_kwargs):
+        """
+        Simulates several scenarios from the checkpoint. Every scenario starts from the same random state (common random numbers), so the differences between stochastic scenarios are due to their parameters rather than to sampling noise.
+
+        input
+        -----
+        scenarios: dict
+            Parameters of every scenario, {name: {parameter: value}}.
+
+        resume_kwargs:
+            See `resume`.
+
+        output
+        ------
+        out: dict
+            Simulation output of every scenario, {name: xarray.Dataset}.
+        """
+        return {name: self.resume(model_class, stop, parameters=parameters, **resume_kwargs) for name, parameters in scenarios.items()}
+
+####################
+## Random numbers ##
+####################
+
+def capture_rng(generator=None):
+    """ Returns the state of the global random number generators (`np.random`, `random`) and, optionally, of a `np.random.Generator`
+    """
+    _, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    version, internal, gauss_next = random.getstate()
+    return {'numpy': {'keys': np.asarray(keys, np.uint32), 'pos': int(pos), 'has_gauss': int(has_gauss), 'cached_gaussian': float(cached_gaussian)},
+            'random': {'version': version, 'internal': np.asarray(internal, np.int64), 'gauss_next': gauss_next},
+            'generator': None if generator is None else generator.bit_generator.state}
+
+def restore_rng(rng):
+    """ Restores the global random number generators to a state returned by `capture_rng`
+    """
+    n = rng['numpy']
+    np.random.set_state(('MT19937', n['keys'], n['pos'], n['has_gauss'], n['cached_gaussian']))
+    r = rng['random']
+    random.setstate((r['version'], tuple(int(x) for x in r['internal']), r['gauss_next']))
+
+def _write_rng(group, rng):
+    group.create_dataset('numpy_keys', data=rng['numpy']['keys'])
+    group.create_dataset('random_internal', data=rng['random']['internal'])
+    group.attrs['numpy'] = json.dumps({k: v for k, v in rng['numpy'].items() if k != 'keys'})
+    group.attrs['random'] = json.dumps({k: v for k, v in rng['random'].items() if k != 'internal'})
+    group.attrs['generator'] = json.dumps(rng['generator'], default=_to_builtin)
+
+def _read_rng(group):
+    numpy_state = {**json.loads(group.attrs['numpy']), 'keys': group['numpy_keys'][...]}
+    random_state = {**json.loads(group.attrs['random']), 'internal': group['random_internal'][...]}
+    return {'numpy': numpy_state, 'random': random_state, 'generator': json.loads(group.attrs['generator'])}
+
+################
+## Parameters ##
+################
+
+def _write_parameter(f, name, value):
+    """ Writes a parameter as a dataset (numbers and arrays), a group 'data'/'indices'/'indptr' (sparse arrays) or a pickled byte string (other objects)
+    """
+    if issparse(value):
+        value = csr_array(value)
+        group = f.create_group(name)
+        group.attrs['kind'] = 'sparse'
+        group.attrs['shape'] = value.shape
+        for k in ['data', 'indices', 'indptr']:
+            group.create_dataset(k, data=getattr(value, k), compression='gzip')
+    elif isinstance(value, (int, float, np.number, np.ndarray)) or (isinstance(value, list) and np.asarray(value).dtype.kind in 'biuf'):
+        dataset = f.create_dataset(name, data=np.asarray(value), compression='gzip' if np.ndim(value) else None)
+        dataset.attrs['kind'] = 'array' if np.ndim(value) else 'scalar'
+    else:
+        dataset = f.create_dataset(name, data=np.void(pickle.dumps(value)))
+        dataset.attrs['kind'] = 'pickle'
+
+def _read_parameter(node, allow_pickle=False):
+    kind = node.attrs['kind']
+    if kind == 'sparse':
+        return csr_array((node['data'][...], node['indices'][...], node['indptr'][...]), shape=tuple(node.attrs['shape']))
+    if kind == 'scalar':
+        return node[()].item()
+    if kind == 'array':
+        return node[...]
+    if not allow_pickle:
+        raise ValueError(
+            f"parameter '{node.name.split('/')[-1]}' of the checkpoint is a pickled object and unpickling can execute arbitrary code, load checkpoints you trust with `Checkpoint.load(..., allow_pickle=True)`"
+        )
+    return pickle.loads(node[()].tobytes())
+
+def _to_builtin(x):
+    """ JSON serialisation of numpy scalars and arrays
+    """
+    if isinstance(x, np.ndarray):
+        return x.tolist()
+    if isinstance(x, np.generic):
+        return x.item()
+    raise TypeError(
+        f"object of type {type(x).__name__} is not JSON serializable"
+    )
@@ -0,0 +1,332 @@
+"""
+This script contains a Gaussian-process emulator of the weekly national incidence per age group simulated by the age-stratified spatially-explicit SIR models, and its use as a cheap surrogate of the calibration's log posterior probability.
+"""
+
+__author__      = "Tijs Alleman"
+__copyright__   = "Copyright (c) 2024 by T.W. Alleman, IDD Group, Johns Hopkins Bloomberg School of Public Health. All Rights Reserved."
+
+import sys
+import h5py
+import numpy as np
+from scipy.linalg import cho_factor, cho_solve
+from scipy.optimize import minimize
+from scipy.stats import qmc
+from calibration import log_posterior_probability, simulate_design, ll_poisson_profiled
+
+############
+## Design ##
+############
+
+def latin_hypercube(bounds, n, seed=None):
+    """ Returns a space-filling (Latin hypercube) design of `n` parameter vectors within `bounds`. Shape (n, n_parameters)
+    """
+    bounds = np.asarray(bounds, np.float64)
+    return qmc.scale(qmc.LatinHypercube(d=len(bounds), seed=seed).random(n), bounds[:, 0], bounds[:, 1])
+
+######################
+## Gaussian process ##
+######################
+
+def _squared_distances(A, B, lengthscales):
+    """ Squared distances between the rows of A and B, scaled by `lengthscales`
+    """
+    A, B = A / lengthscales, B / lengthscales
+    return np.maximum(np.sum(A**2, axis=1)[:, None] + np.sum(B**2, axis=1)[None, :] - 2 * A @ B.T, 0)
+
+class GaussianProcess:
+    """
+    Gaussian process with a squared exponential kernel with one lengthscale per input (ARD), fitted by maximising the log marginal likelihood.
+
+    input
+    -----
+    n_restarts: int
+        Number of additional (random) starting points of the hyperparameter optimisation.
+    """
+
+    def __init__(self, n_restarts=2):
+        self.n_restarts = n_restarts
+        self.log_hyperparameters = None
+
+    def _neg_log_marginal_likelihood(self, log_hyperparameters, X, y):
+        lengthscales, signal, noise = np.exp(log_hyperparameters[:-2]), np.exp(log_hyperparameters[-2]), np.exp(log_hyperparameters[-1])
+        K = signal * np.exp(-0.5 * _squared_distances(X, X, lengthscales)) + (noise + 1e-10) * np.eye(len(X))
+        try:
+            c = cho_factor(K, lower=True)
+        except np.linalg.LinAlgError:
+            return np.inf
+        return 0.5 * y @ cho_solve(c, y) + np.sum(np.log(np.diag(c[0]))) + 0.5 * len(X) * np.log(2 * np.pi)
+
+    def fit(self, X, y, rng=None):
+        """ Fits the hyperparameters to inputs X (shape (n, n_inputs), scaled to the unit cube) and standardised outputs y (shape (n,))
+        """
+        rng = np.random.default_rng(rng)
+        d = X.shape[1]
+        bounds = [(np.log(1e-2), np.log(10))] * d + [(np.log(1e-2), np.log(1e2)), (np.log(1e-8), np.log(1e-1))]
+        starts = [self.log_hyperparameters if self.log_hyperparameters is not None else np.array([np.log(0.3)] * d + [0, np.log(1e-4)])]
+        starts += [rng.uniform(*np.transpose(bounds)) for _ in range(self.n_restarts)]
+        best = min((minimize(self._neg_log_marginal_likelihood, x0, args=(X, y), method='L-BFGS-B', bounds=bounds) for x0 in starts), key=lambda r: r.fun)
+        self.log_hyperparameters = best.x
+        # precompute the quantities needed for prediction
+        self.X = X
+        self.lengthscales, self.signal, self.noise = np.exp(best.x[:-2]), np.exp(best.x[-2]), np.exp(best.x[-1])
+        K = self.signal * np.exp(-0.5 * _squared_distances(X, X, self.lengthscales)) + (self.noise + 1e-10) * np.eye(len(X))
+        self._c = cho_factor(K, lower=True)
+        self._alpha = cho_solve(self._c, y)
+        return self
+
+    def predict(self, X):
+        """ Returns the predictive mean and variance at the inputs X. Shape (n,)
+        """
+        K_s = self.signal * np.exp(-0.5 * _squared_distances(X, self.X, self.lengthscales))
+        mean = K_s @ self._alpha
+        var = self.signal - np.sum(K_s * cho_solve(self._c, K_s.T).T, axis=1)
+        return mean, np.maximum(var, 0)
+
+##############
+## Emulator ##
+##############
+
+class GPEmulator:
+    """
+    Emulator of the weekly number of new infections per age group, as a function of the calibrated parameters.
+
+    The outputs are log-transformed (log(1 + incidence)) and reduced to their principal components, every principal component is emulated by an independent Gaussian process over the parameters scaled to the unit cube.
+    The variance of the discarded components is added to the predictive variance.
+
+    input
+    -----
+    bounds: list of tuples
+        Lower and upper bound of every parameter.
+
+    explained_variance: float
+        Fraction of the variance of the (transformed) outputs retained by the principal components.
+
+    max_components: int
+        Maximum number of principal components (and Gaussian processes).
+
+    log_scale: list of bool or None
+        Emulate on the logarithm of these parameters. Default: all parameters with a strictly positive lower bound (f.i. beta and gamma, whose product sets the reproduction number).
+    """
+
+    def __init__(self, bounds, explained_variance=0.9999, max_components=12, log_scale=None):
+        self.bounds = np.asarray(bounds, np.float64)
+        self.log_scale = self.bounds[:, 0] > 0 if log_scale is None else np.asarray(log_scale, bool)
+        self.explained_variance = explained_variance
+        self.max_components = max_components
+        self.X = np.empty((0, len(self.bounds)))
+        self.Y = None
+        self.processes = []
+
+    def _to_unit(self, X):
+        X, bounds = np.array(np.atleast_2d(X), np.float64), self.bounds.copy()
+        X[:, self.log_scale], bounds[self.log_scale] = np.log(X[:, self.log_scale]), np.log(bounds[self.log_scale])
+        return (X - bounds[:, 0]) / (bounds[:, 1] - bounds[:, 0])
+
+    def fit(self, X, Y, rng=None):
+        """
+        Fits the emulator to simulated outputs, previous training points are retained.
+
+        input
+        -----
+        X: np.ndarray
+            Parameters. Shape (n, n_parameters).
+
+        Y: np.ndarray
+            Weekly number of new infections. Shape (n, n_weeks, n_age).
+        """
+        X, Y = np.atleast_2d(X), np.asarray(Y, np.float64)
+        self.X = np.concatenate([self.X, X])
+        self.Y = Y if self.Y is None else np.concatenate([self.Y, Y])
+        self.output_shape = self.Y.shape[1:]
+        # principal components of the log-transformed outputs
+        Z = np.log1p(np.maximum(self.Y, 0)).reshape(len(self.Y), -1)
+        self.mean = Z.mean(axis=0)
+        _, s, vt = np.linalg.svd(Z - self.mean, full_matrices=False)
+        explained = np.cumsum(s**2) / np.sum(s**2)
+        k = min(int(np.searchsorted(explained, self.explained_variance)) + 1, self.max_components, len(s))
+        self.components = vt[:k]
+        scores = (Z - self.mean) @ self.components.T
+        self.residual_variance = np.mean(((Z - self.mean) - scores @ self.components)**2, axis=0)
+        # one (standardised) Gaussian process per component, hyperparameters warm-started from the previous fit
+        self.scale = np.maximum(scores.std(axis=0), 1e-12)
+        self.processes = (self.processes + [GaussianProcess() for _ in range(k)])[:k]
+        U = self._to_unit(self.X)
+        for gp, y in zip(self.processes, np.transpose(scores / self.scale)):
+            gp.fit(U, y, rng)
+        return self
+
+    def predict_transformed(self, X):
+        """ Returns the predictive mean and variance of log(1 + incidence). Shape (n, n_weeks * n_age)
+        """
+        U = self._to_unit(X)
+        mean, var = np.transpose([gp.predict(U) for gp in self.processes], (1, 0, 2))
+        mean = self.mean + (mean.T * self.scale) @ self.components
+        var = (var.T * self.scale**2) @ self.components**2 + self.residual_variance
+        return mean, var
+
+    def predict(self, X, return_std=False):
+        """
+        Predicts the weekly number of new infections per age group.
+
+        output
+        ------
+        incidence: np.ndarray
+            Predicted weekly number of new infections (median). Shape (n, n_weeks, n_age).
+
+        std: np.ndarray
+            Predictive standard deviation of log(1 + incidence), only if `return_std`. Shape (n, n_weeks, n_age).
+        """
+        mean, var = self.predict_transformed(X)
+        incidence = np.expm1(mean).reshape((-1,) + self.output_shape)
+        if return_std:
+            return incidence, np.sqrt(var).reshape((-1,) + self.output_shape)
+        return incidence
+
+    def save(self, path, name='emulator'):
+        """ Saves the training set to group `name` of an HDF5 file (f.i. the calibration's backend)
+        """
+        with h5py.File(path, 'a') as f:
+            if name in f:
+                del f[name]
+            group = f.create_group(name)
+            group.create_dataset('X', data=self.X)
+            group.create_dataset('Y', data=self.Y)
+            group.create_dataset('bounds', data=self.bounds)
+
+    @classmethod
+    def load(cls, path, name='emulator', rng=None, **kwargs):
+        """ Rebuilds an emulator from the training set saved in group `name` of an HDF5 file (without simulating), returns None if there is none
+        """
+        try:
+            with h5py.File(path, 'r') as f:
+                X, Y, bounds = f[name]['X'][...], f[name]['Y'][...], f[name]['bounds'][...]
+        except (FileNotFoundError, KeyError):
+            return None
+        return cls(bounds, **kwargs).fit(X, Y, rng)
+
+###############
+## Surrogate ##
+###############
+
+class emulated_log_posterior_probability(log_posterior_probability):
+    """
+    Log posterior probability of the weekly ILI data with the simulations replaced by the emulator's predictions.
+
+    input
+    -----
+    emulator: GPEmulator
+        Trained emulator.
+
+    log_posterior: calibration.log_posterior_probability
+        Log posterior probability being emulated (provides the parameter names, bounds and data).
+    """
+
+    def __init__(self, emulator, log_posterior):
+        self.emulator = emulator
+        self.model = None
+        self.parameter_names = log_posterior.parameter_names
+        self.bounds = log_posterior.bounds
+        self.ydata = log_posterior.ydata
+        self.observation = log_posterior.observation
+        self.start_date = log_posterior.start_date
+
+    def simulate(self, theta):
+        return self.emulator.predict(theta)[0]
+
+    def loglikelihood_std(self, thetas):
+        """
+        Approximates the standard deviation of the loglikelihood caused by the emulator's uncertainty (first order: d ll / d log(1 + incidence) = (ydata / incidence - rho) * (1 + incidence), with incidence floored at one).
+
+        output
+        ------
+        ll: np.ndarray
+            Surrogate loglikelihood. Shape (n,).
+
+        std: np.ndarray
+            Standard deviation of the surrogate loglikelihood. Shape (n,).
+        """
+        incidence, std = self.emulator.predict(thetas, return_std=True)
+        ll = np.full(len(incidence), -np.inf)
+        ll_std = np.zeros(len(incidence))
+        for i, y in enumerate(incidence):
+            ll[i], rho = ll_poisson_profiled(y, self.ydata)
+            ll_std[i] = np.sqrt(np.sum(((self.ydata / np.maximum(y, 1) - rho) * (1 + y) * std[i])**2))
+        return ll, ll_std
+
+#####################
+## Active learning ##
+#####################
+
+def train_emulator(log_posterior, n_initial=50, n_rounds=10, n_batch=20, n_candidates=5000, tolerance=None, kappa=2.0, processes=None, seed=None):
+    """
+    Trains an emulator of `log_posterior.simulate` on a Latin hypercube design and refines it where the surrogate posterior is high and the emulator is uncertain.
+
+    Every round, candidates are drawn from a Latin hypercube over the bounds and from Gaussians around the best training points so far, and the `n_batch` candidates with the highest upper confidence bound (ll + kappa * std of ll) are simulated and added to the training set.
+    Training stops after `n_rounds` rounds, or when the loglikelihood's standard deviation at every selected candidate drops below `tolerance` (if provided).
+
+    input
+    -----
+    log_posterior: calibration.log_posterior_probability
+        Log posterior probability being emulated.
+
+    n_initial: int
+        Number of simulations in the initial design.
+
+    n_rounds, n_batch: int
+        Maximum number of refinement rounds, number of simulations added per round.
+
+    n_candidates: int
+        Number of candidates evaluated on the emulator per round.
+
+    tolerance: float or None
+        Stop refining when the standard deviation of the surrogate loglikelihood of every selected candidate is below `tolerance`. Default: None (always perform `n_rounds` rounds).
+        The Poisson loglikelihood of the ILI counts is very sharp, so reaching a tolerance of order one may require many more simulations than the intended few hundred.
+
+    kappa: float
+        Weight of the uncertainty in the acquisition function.
+
+    processes: int or None
+        Number of worker processes simulating the design. If None, simulations run in the current process.
+
+    seed: int or None
+        Seed of the design and candidates.
+
+    output
+    ------
+    surrogate: emulated_log_posterior_probability
+        Surrogate log posterior probability. Its `emulator` holds the training set (`emulator.X`, `emulator.Y`).
+    """
+
+    rng = np.random.default_rng(seed)
+    bounds = log_posterior.bounds
+    emulator = GPEmulator(bounds)
+    surrogate = emulated_log_posterior_probability(emulator, log_posterior)
+
+    # initial space-filling design
+    X = latin_hypercube(bounds, n_initial, seed=rng)
+    emulator.fit(X, simulate_design(log_posterior, X, processes), rng)
+
+    for i in range(n_rounds):
+        # candidates: global and around the best training points
+        ll_train = np.array([ll_poisson_profiled(y, log_posterior.ydata)[0] for y in emulator.Y])
+        best = emulator.X[np.argsort(ll_train)[::-1][:n_batch]]
+        width = 0.05 * (bounds[:, 1] - bounds[:, 0])
+        local = best[rng.integers(len(best), size=n_candidates // 2)] + width * rng.standard_normal((n_candidates // 2, len(bounds)))
+        candidates = np.concatenate([latin_hypercube(bounds, n_candidates - len(local), seed=rng), np.clip(local, bounds[:, 0], bounds[:, 1])])
+        # upper confidence bound, batch of distinct candidates
+        ll, ll_std = surrogate.loglikelihood_std(candidates)
+        order = np.argsort(ll + kappa * ll_std)[::-1]
+        selected = []
+        for j in order:
+            if all(np.max(np.abs(emulator._to_unit(candidates[j]) - emulator._to_unit(candidates[k]))) > 1e-3 for k in selected):
+                selected.append(j)
+            if len(selected) == n_batch:
+                break
+        print(f"round {i+1}: {len(emulator.X)} simulations, max std of the surrogate loglikelihood in batch: {np.max(ll_std[selected]):.3g}")
+        sys.stdout.flush()
+        if tolerance is not None and np.max(ll_std[selected]) < tolerance:
+            break
+        X = candidates[selected]
+        emulator.fit(X, simulate_design(log_posterior, X, processes), rng)
+
+    return surrogate
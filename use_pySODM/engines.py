@@ -0,0 +1,411 @@
+"""
+This script contains dedicated simulation engines for the age-stratified spatially-explicit SIR models, bypassing pySODM's general-purpose (per-step Python) solvers.
+"""
+
+__author__      = "Tijs Alleman"
+__copyright__   = "Copyright (c) 2024 by T.W. Alleman, IDD Group, Johns Hopkins Bloomberg School of Public Health. All Rights Reserved."
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from datetime import timedelta
+from pySODM.models.validation import validate_simulation_time
+from kernels import ForceOfInfection
+
+states = ['S', 'I', 'R']
+dimensions = ['age', 'location']
+
+#############
+## Helpers ##
+#############
+
+def build_time_axis(time, output_timestep=1):
+    """ Converts pySODM-style simulation `time` (int/float, [start, stop] or ['YYYY-MM-DD', 'YYYY-MM-DD']) into the output timesteps
+
+    output
+    ------
+    t_eval: np.ndarray
+        Output timesteps (relative to the start date if dates were provided).
+
+    actual_start_date: datetime or None
+        Start date if the simulation time was given as dates.
+    """
+    time, actual_start_date = validate_simulation_time(time)
+    t_eval = np.arange(start=time[0], stop=time[1] + output_timestep, step=output_timestep)
+    return t_eval, actual_start_date
+
+def states_to_dataset(y, t_eval, coordinates, actual_start_date=None, state_names=states, dimensions=dimensions):
+    """ Converts an array of stacked model states into an xarray Dataset in the same format as pySODM's `sim()`
+
+    input
+    -----
+    y: np.ndarray
+        Stacked model states. Shape (n_time, n_states, n_age, n_loc), or (n_time, n_states, ...) with one axis per entry of `dimensions`.
+
+    t_eval: np.ndarray
+        Output timesteps.
+
+    coordinates: dict
+        Model coordinates, with keys 'age' and 'location' (and any other entry of `dimensions`).
+
+    actual_start_date: datetime or None
+        If provided, the time axis is named 'date' and contains dates.
+
+    dimensions: list of str
+        Dimensions of the states. Default: ['age', 'location'].
+
+    output
+    ------
+    out: xarray.Dataset
+        Simulation output.
+    """
+    if actual_start_date is not None:
+        time_dim, time_coord = 'date', [actual_start_date + timedelta(days=x) for x in t_eval]
+    else:
+        time_dim, time_coord = 'time', t_eval
+    coords = {time_dim: time_coord, **{dim: coordinates[dim] for dim in dimensions}}
+    return xr.Dataset({X: xr.DataArray(y[:, i, ...], dims=[time_dim,] + dimensions, coords=coords) for i, X in enumerate(state_names)})
+
+def initial_states_to_array(initial_states, shape):
+    """ Stacks a pySODM-style dictionary of initial states (missing states are zero) into an array of shape (3, n_age, n_loc)
+    """
+    y0 = np.zeros((len(states),) + tuple(shape), np.float64)
+    for i, X in enumerate(states):
+        if X in initial_states:
+            y0[i] = initial_states[X]
+    return y0
+
+################
+## Fixed step ##
+################
+
+# fixed-step integrators of flepiMoP's `seir.integration` block
+fixed_step_methods = ['euler', 'rk4']
+
+def read_integration_config(path):
+    """ Returns the integration method and timestep of a flepiMoP configuration file, f.i. ('rk4', 1.0) for `use_flepiMoP/w_age_groups/SIR_BE_w_age.yml`
+    """
+    try:
+        import yaml
+    except ImportError:
+        raise ImportError(
+            "reading a flepiMoP configuration file requires pyyaml (`conda install pyyaml` or `pip install pyyaml`)"
+        )
+    with open(path) as f:
+        integration = yaml.safe_load(f)['seir'].get('integration', {})
+    return integration.get('method', 'rk4'), float(integration.get('dt', 1.0))
+
+def integrate_fixed_step(model, time, method='rk4', dt=1.0, output_timestep=1, out=None, dtype=np.float64):
+    """
+    Integrates a pySODM ODE model with a fixed-step explicit Runge-Kutta scheme, with the semantics of flepiMoP's `seir.integration` block (`method: rk4`, `dt: 1.0`).
+
+    The states are stacked into one array and the stages are written into buffers allocated once per simulation, the model's `integrate` is called on views of them (4 calls per step for 'rk4', 1 for 'euler').
+    The cost is predictable: (t1 - t0) / dt steps, independent of the dynamics. Time-dependent parameters are evaluated by pySODM's wrapper (`model._create_fun`).
+
+    input
+    -----
+    model: pySODM.models.base.ODE
+        Model whose states all have the same shape, f.i. `models.spatial_ODE_SIR` or `models.spatial_ODE_SIR_ensemble`.
+
+    time: int/float, list of int/float or list of str/datetime
+        Start and stop of the simulation, as in pySODM's `sim()`.
+
+    method: str
+        'rk4' (classical fourth-order Runge-Kutta) or 'euler'.
+
+    dt: float
+        Integration timestep. `output_timestep` must be a multiple of `dt`.
+
+    output_timestep: int/float
+        Output the states every `output_timestep` (default: 1).
+
+    out: np.ndarray or None
+        Preallocated output array, written in place (f.i. reused over an ensemble). Shape (n_time, n_states, *state_shape).
+
+    dtype: np.dtype
+        Precision of the states, the stages and the output (f.i. np.float32 for the models of reduced precision, see `kernels_numba.precisions`). Default: np.float64.
+
+    output
+    ------
+    out: xarray.Dataset
+        Simulation output, in the same format as pySODM's `sim()` (a view on `out` if provided).
+    """
+    if method not in fixed_step_methods:
+        raise ValueError(
+            f"invalid fixed-step method '{method}'. valid methods are: {fixed_step_methods}"
+        )
+    steps_per_output = int(round(output_timestep / dt))
+    if steps_per_output < 1 or not np.isclose(steps_per_output * dt, output_timestep):
+        raise ValueError(
+            f"'output_timestep' ({output_timestep}) must be a multiple of the integration timestep 'dt' ({dt})"
+        )
+    t_eval, actual_start_date = build_time_axis(time, output_timestep)
+
+    # stacked states and stage buffers
+    names = list(model.state_shapes.keys())
+    shape = (len(names),) + tuple(model.state_shapes[names[0]])
+    if any(tuple(s) != shape[1:] for s in model.state_shapes.values()):
+        raise ValueError(
+            "fixed-step integration requires all states to have the same shape"
+        )
+    if out is None:
+        out = np.empty((len(t_eval),) + shape, dtype)
+    elif out.shape != (len(t_eval),) + shape or out.dtype != dtype:
+        raise ValueError(
+            f"'out' has shape {out.shape} and dtype {out.dtype}, expected {(len(t_eval),) + shape} and {np.dtype(dtype)}"
+        )
+    y = np.empty(shape, dtype)
+    for i, X in enumerate(names):
+        y[i] = model.initial_states[X]
+    k = np.empty((4 if method == 'rk4' else 1,) + shape, dtype)
+    y_stage = np.empty(shape, dtype)
+
+    # right-hand side written into a stage buffer
+    if model.time_dependent_parameters:
+        fun = model._create_fun(actual_start_date)
+        def rhs(t, y, k):
+            k.reshape(-1)[:] = fun(t, y.reshape(-1), model.parameters)
+    else:
+        params = {p: model.parameters[p] for p in model.parameters_names_modeldeclaration}
+        def rhs(t, y, k):
+            for i, d in enumerate(model.integrate(t, **dict(zip(names, y)), **params)):
+                k[i] = d
+
+    out[0] = y
+    for i in range(1, len(t_eval)):
+        for j in range(steps_per_output):
+            # time from the step count (no drift)
+            t = t_eval[0] + ((i - 1) * steps_per_output + j) * dt
+            rhs(t, y, k[0])
+            if method == 'euler':
+                y += dt * k[0]
+                continue
+            np.multiply(k[0], dt/2, out=y_stage)
+            y_stage += y
+            rhs(t + dt/2, y_stage, k[1])
+            np.multiply(k[1], dt/2, out=y_stage)
+            y_stage += y
+            rhs(t + dt/2, y_stage, k[2])
+            np.multiply(k[2], dt, out=y_stage)
+            y_stage += y
+            rhs(t + dt, y_stage, k[3])
+            # y += dt/6 * (k1 + 2 k2 + 2 k3 + k4)
+            k[1] += k[2]
+            k[1] *= 2
+            k[1] += k[0]
+            k[1] += k[3]
+            k[1] *= dt/6
+            y += k[1]
+        out[i] = y
+
+    return states_to_dataset(out, t_eval, model.coordinates, actual_start_date, state_names=names, dimensions=model.dimensions_per_state[names[0]])
+
+#################
+## Tau-leaping ##
+#################
+
+class TauLeapSIR:
+    """
+    Tau-leaping engine for the stochastic SIR model with age and spatial stratification (`models.spatial_TL_SIR`)
+
+    Draws the same transitionings as pySODM's tau-leaping with `spatial_TL_SIR`: per leap of size tau,
+
+        S -> I ~ Binomial(S, 1 - exp(-tau * l)),    I -> R ~ Binomial(I, 1 - exp(-tau / gamma)),
+
+    but updates the states in place in preallocated buffers and draws both transitionings in a single vectorised binomial call per leap (the array of draws is the only allocation of a leap).
+    Random numbers are drawn from a `np.random.Generator`, so realisations are independent of the global random state.
+
+    input
+    -----
+    initial_states: dict
+        Initial states, f.i. {'S': S0, 'I': I0}. Shape (n_age, n_loc). States not provided are zero.
+
+    parameters: dict
+        Values of 'beta', 'gamma', 'f_v', 'N' and 'M' (see `models.spatial_TL_SIR`).
+
+    coordinates: dict
+        Model coordinates, with keys 'age' and 'location'.
+    """
+
+    def __init__(self, initial_states, parameters, coordinates):
+        self.coordinates = coordinates
+        self.parameters = dict(parameters)
+        self.shape = (len(coordinates['age']), len(coordinates['location']))
+        self.initial_states = initial_states_to_array(initial_states, self.shape)
+        # preallocate buffers
+        self._y = np.empty_like(self.initial_states)             # states S, I, R
+        self._y_prev = np.empty_like(self.initial_states)        # states at the previous leap (for interpolation)
+        self._n = np.empty((2,) + self.shape, np.int64)          # number of individuals able to transition (S, I)
+        self._p = np.empty((2,) + self.shape, np.float64)        # transitioning probabilities (S -> I, I -> R)
+        self._foi = ForceOfInfection()
+
+    def _transitioning_probabilities(self, tau):
+        """ Computes the probabilities of transitioning S -> I and I -> R during a leap of size tau, written into `self._p`
+        """
+        S, I, R = self._y
+        p = self.parameters
+        l = self._foi(S, I, R, p['beta'], p['f_v'], p['N'], p['M'])
+        np.multiply(l, -tau, out=self._p[0])
+        np.expm1(self._p[0], out=self._p[0])
+        np.negative(self._p[0], out=self._p[0])
+        self._p[1] = -np.expm1(-tau/p['gamma'])
+
+    def _apply_transitionings(self, T):
+        """ Applies the transitionings T (S -> I, I -> R) to the states in place
+        """
+        S, I, R = self._y
+        S -= T[0]
+        I += T[0]
+        I -= T[1]
+        R += T[1]
+
+    def _leap(self, rng, tau):
+        """ Performs one leap of size tau, updates the states in place
+        """
+        self._transitioning_probabilities(tau)
+        # draw all transitionings at once (`Generator.binomial` has no `out` argument: the draws are the only allocation of a leap, negligible next to the cost of drawing them)
+        np.copyto(self._n, self._y[:2], casting='unsafe')
+        self._apply_transitionings(rng.binomial(self._n, self._p))
+
+    def sim(self, time, tau=1, output_timestep=1, seed=None, sink=None, observation=None):
+        """
+        Simulates the model using tau-leaping.
+
+        input
+        -----
+        time: int/float, list of int/float or list of str/datetime
+            Start and stop of the simulation, as in pySODM's `sim()`.
+
+        tau: int/float
+            Leap size (default: 1).
+
+        output_timestep: int/float
+            Interpolate model output to every `output_timestep` time (default: 1).
+
+        seed: None, int, np.random.SeedSequence or np.random.Generator
+            Seed of the random number generator (see `np.random.default_rng`).
+
+        sink: output.OutputSink or None
+            If provided, the output timesteps are streamed to the sink instead of being kept in memory.
+
+        observation: observation.WeeklyObservation or None
+            If provided, the new infections (S -> I) of every leap are accumulated into the weekly, national incidence per age group.
+            Without a sink, only the observation is kept and returned.
+
+        output
+        ------
+        out: xarray.Dataset, output.OutputSink or observation.WeeklyObservation
+            Simulation output, in the same format as pySODM's `sim()`. The sink (not closed) if provided, else the observation if provided.
+        """
+
+        rng = np.random.default_rng(seed)
+        t_eval, actual_start_date = build_time_axis(time, output_timestep)
+        # output timesteps are written in a buffer of one timestep when streaming or observing
+        out = np.empty((1 if (sink or observation) else len(t_eval),) + self.initial_states.shape)
+        if observation:
+            observation.reset()
+            # simulation time on the time axis of the observation
+            offset = 0 if actual_start_date is None else (pd.Timestamp(actual_start_date) - observation.start_date) / pd.Timedelta(days=1)
+
+        # initialise
+        self._y[...] = self.initial_states
+        out[0] = self._y
+        if sink:
+            sink.append(t_eval[0], out[0])
+        t, i = t_eval[0], 1
+
+        # leap and linearly interpolate the output timesteps passed (as pySODM does)
+        while i < len(t_eval):
+            self._y_prev[...] = self._y
+            self._leap(rng, tau)
+            t_next = t + tau
+            if observation:
+                observation.accumulate(t + offset, t_next + offset, (self._y_prev[0] - self._y[0]).sum(axis=-1))
+            while i < len(t_eval) and t_eval[i] <= t_next:
+                w = (t_eval[i] - t) / tau
+                row = out[0] if (sink or observation) else out[i]
+                np.multiply(self._y_prev, 1 - w, out=row)
+                row += w * self._y
+                if sink:
+                    sink.append(t_eval[i], row)
+                i += 1
+            t = t_next
+
+        if sink:
+            return sink
+        if observation:
+            return observation
+        return states_to_dataset(out, t_eval, self.coordinates, actual_start_date)
+
+############
+## Hybrid ##
+############
+
+class HybridSIR(TauLeapSIR):
+    """
+    Hybrid stochastic/deterministic engine for the SIR model with age and spatial stratification (`models.spatial_TL_SIR` / `models.spatial_ODE_SIR`)
+
+    Every leap, the (age, location) compartments are partitioned on their number of infected:
+
+        - I < threshold: the compartment is simulated stochastically, transitionings are drawn as in `TauLeapSIR`,
+        - I >= threshold: the compartment is simulated deterministically, it receives the expected transitionings,
+
+            S -> I = S * (1 - exp(-tau * l)),    I -> R = I * (1 - exp(-tau / gamma)),
+
+          which is the deterministic limit of the tau-leap and converges to `spatial_ODE_SIR` as tau -> 0.
+
+    The partition is recomputed every leap, so compartments join the deterministic part as the epidemic takes off locally and return to the stochastic part as it dies out.
+    Seeding, stochastic extinction and the chance arrival of the epidemic in untouched patches are thus retained, while random numbers are only drawn for the stochastic compartments with a non-zero expected number of transitionings.
+
+    input
+    -----
+    initial_states: dict
+        Initial states, f.i. {'S': S0, 'I': I0}. Shape (n_age, n_loc). States not provided are zero.
+
+    parameters: dict
+        Values of 'beta', 'gamma', 'f_v', 'N' and 'M' (see `models.spatial_TL_SIR`).
+
+    coordinates: dict
+        Model coordinates, with keys 'age' and 'location'.
+
+    threshold: int/float
+        Number of infected above which a compartment is simulated deterministically (default: 100). 0 gives a deterministic model, np.inf gives `TauLeapSIR`.
+    """
+
+    def __init__(self, initial_states, parameters, coordinates, threshold=100):
+        super().__init__(initial_states, parameters, coordinates)
+        self.threshold = threshold
+        self._T = np.empty((2,) + self.shape, np.float64)        # transitionings (S -> I, I -> R)
+        self._stochastic = np.empty(self.shape, bool)            # partition of the compartments
+
+    def _round_stochastic(self, rng):
+        """
+        Rounds the states of the stochastic compartments carrying fractional individuals (left by their deterministic leaps) to integers, in place.
+
+        The cumulative sums S, S + I and S + I + R of every compartment are rounded with one shared uniform number u, C = floor(c + u),
+        which is unbiased (E[C] = c), keeps the states non-negative and conserves the (integer) population of the compartment.
+        """
+        y = self._y.reshape(3, -1)
+        idx = np.flatnonzero(self._stochastic.ravel() & np.any(y != np.floor(y), axis=0))
+        if idx.size:
+            c = np.cumsum(y[:, idx], axis=0)
+            C = np.floor(c + rng.random(idx.size))
+            C[-1] = np.round(c[-1])
+            y[:, idx] = np.diff(C, axis=0, prepend=0)
+
+    def _leap(self, rng, tau):
+        """ Performs one hybrid leap of size tau, updates the states in place
+        """
+        # partition the compartments, compartments returning to the stochastic part are rounded to integers
+        np.less(self._y[1], self.threshold, out=self._stochastic)
+        self._round_stochastic(rng)
+        self._transitioning_probabilities(tau)
+        # expected transitionings
+        np.multiply(self._y[:2], self._p, out=self._T)
+        # draw the transitionings of the stochastic compartments
+        T = self._T.reshape(2, -1)
+        for k in range(2):
+            idx = np.flatnonzero(self._stochastic.ravel() & (T[k] > 0))
+            if idx.size:
+                T[k, idx] = rng.binomial(self._y[k].ravel()[idx].astype(np.int64), self._p[k].ravel()[idx])
+        self._apply_transitionings(self._T)
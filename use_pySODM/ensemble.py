@@ -0,0 +1,225 @@
+"""
+This script contains a process-pool ensemble runner for the stochastic age-stratified spatially-explicit SIR models for use with pySODM.
+"""
+
+__author__      = "Tijs Alleman"
+__copyright__   = "Copyright (c) 2024 by T.W. Alleman, IDD Group, Johns Hopkins Bloomberg School of Public Health. All Rights Reserved."
+
+import copy
+import random
+import numpy as np
+import xarray as xr
+from multiprocessing import get_context, shared_memory
+
+#####################
+## Shared matrices ##
+#####################
+
+def share_array(X):
+    """ Copies an array into a new block of shared memory
+
+    output
+    ------
+    shm: multiprocessing.shared_memory.SharedMemory
+        The shared memory block. Must be closed and unlinked by the owner.
+
+    spec: dict
+        Name, shape and dtype needed to attach to the array from another process (see `attach_array`).
+    """
+    X = np.ascontiguousarray(X)
+    shm = shared_memory.SharedMemory(create=True, size=max(X.nbytes, 1))
+    np.ndarray(X.shape, X.dtype, buffer=shm.buf)[...] = X
+    return shm, {'name': shm.name, 'shape': X.shape, 'dtype': X.dtype.str}
+
+def attach_array(spec):
+    """ Attaches to an array placed in shared memory by `share_array`, without copying it
+
+    output
+    ------
+    shm: multiprocessing.shared_memory.SharedMemory
+        The shared memory block. Must be kept alive as long as the array is used.
+
+    X: np.ndarray
+        View on the shared array (read-only).
+    """
+    shm = shared_memory.SharedMemory(name=spec['name'])
+    X = np.ndarray(spec['shape'], np.dtype(spec['dtype']), buffer=shm.buf)
+    X.flags.writeable = False
+    return shm, X
+
+####################
+## Seeding / RNGs ##
+####################
+
+def seed_realisation(seed_sequence):
+    """ Seeds the global random number generators used by pySODM's stochastic solvers (`np.random` and `random`) from a `np.random.SeedSequence`
+    """
+    np.random.set_state(np.random.RandomState(np.random.MT19937(seed_sequence)).get_state())
+    random.seed(int(seed_sequence.generate_state(1, np.uint64)[0]))
+
+##################
+## Worker state ##
+##################
+
+_worker = {}
+
+def _init_worker(model_class, initial_states, parameters, shared_specs, coordinates):
+    """ Attaches every worker to the shared matrices and builds its model once
+    """
+    _worker['shm'] = []
+    parameters = dict(parameters)
+    for name, spec in shared_specs.items():
+        shm, X = attach_array(spec)
+        _worker['shm'].append(shm)
+        parameters[name] = X
+    _worker['model'] = model_class(states=initial_states, parameters=parameters, coordinates=coordinates)
+    _worker['parameters'] = copy.deepcopy({k: v for k, v in _worker['model'].parameters.items() if k not in shared_specs})
+
+def _simulate_draw(draw, seed_sequence, drawn_parameters, sim_kwargs):
+    """ Simulates one realisation in a worker process
+    """
+    model = _worker['model']
+    # reset the parameters the previous realisation may have altered
+    model.parameters.update(copy.deepcopy(_worker['parameters']))
+    model.parameters.update(drawn_parameters)
+    # seed and simulate
+    seed_realisation(seed_sequence)
+    return draw, model.sim(**sim_kwargs)
+
+def _simulate_draw_star(args):
+    return _simulate_draw(*args)
+
+#####################
+## Ensemble runner ##
+#####################
+
+def simulate_ensemble(model_class, initial_states, parameters, coordinates, time, n_draws, seed=None, processes=None,
+                        draw_function=None, draw_function_kwargs={}, shared_parameters=['N', 'M'], chunksize=None, sink=None, **sim_kwargs):
+    """
+    Simulates `n_draws` independent realisations of a stochastic pySODM model (f.i. `spatial_TL_SIR`) on a process pool.
+
+    Every realisation gets its own child of `np.random.SeedSequence(seed)`, so a fixed `seed` gives bit-identical results regardless of the number of processes.
+    The (large) parameters listed in `shared_parameters` are placed in shared memory once and attached to by every worker, instead of being pickled per task.
+    Every worker builds its model once and reuses it for all the realisations it is handed.
+
+    input
+    -----
+    model_class: pySODM.models.base.JumpProcess
+        Model class, f.i. `models.spatial_TL_SIR`.
+
+    initial_states: dict
+        Initial states of the model.
+
+    parameters: dict
+        Model parameters.
+
+    coordinates: dict
+        Model coordinates.
+
+    time: int/float or list
+        Simulation time, as passed to `model.sim()`.
+
+    n_draws: int
+        Number of realisations.
+
+    seed: int or None
+        Entropy of the root `np.random.SeedSequence`. If None, fresh entropy is drawn from the OS (the ensemble is then not reproducible).
+
+    processes: int or None
+        Number of worker processes. If None, the realisations are simulated sequentially in the current process.
+
+    draw_function: function or None
+        Alters the model parameters between realisations, has the dictionary of model parameters as its first input (see pySODM's `sim()`).
+        Evaluated in the parent process with the realisation's own seed, so drawn parameters are reproducible as well.
+        Must not alter the parameters listed in `shared_parameters`.
+
+    draw_function_kwargs: dict
+        Additional input arguments of `draw_function`.
+
+    shared_parameters: list
+        Names of the (array) parameters placed in shared memory. Default: ['N', 'M']. Sparse matrices are sent once per worker instead.
+
+    chunksize: int or None
+        Number of realisations handed to a worker at once. Default: n_draws // (4 * processes).
+
+    sink: output.OutputSink or None
+        If provided (with `n_draws` realisations), every realisation is written to the sink as it streams in, instead of being collected in memory.
+
+    sim_kwargs:
+        Passed on to `model.sim()`, f.i. `tau` or `output_timestep`.
+
+    output
+    ------
+    out: xarray.Dataset or output.OutputSink
+        Simulation output with a leading 'draw' dimension. The sink (not closed) if provided.
+    """
+
+    # spawn one independent seed sequence per realisation
+    seed_sequences = np.random.SeedSequence(seed).spawn(n_draws)
+
+    # draw the parameters of every realisation
+    tasks = []
+    for draw, ss in enumerate(seed_sequences):
+        if draw_function:
+            seed_realisation(ss.spawn(1)[0])
+            drawn = draw_function(copy.deepcopy(parameters), **draw_function_kwargs)
+            drawn = {k: v for k, v in drawn.items() if k not in shared_parameters}
+        else:
+            drawn = {}
+        tasks.append((draw, ss, drawn, {'time': time, **sim_kwargs}))
+
+    # place the large matrices in shared memory
+    shms, shared_specs = [], {}
+    for name in shared_parameters:
+        if isinstance(parameters.get(name), np.ndarray):
+            shm, shared_specs[name] = share_array(parameters[name])
+            shms.append(shm)
+    initargs = (model_class, initial_states, {k: v for k, v in parameters.items() if k not in shared_specs}, shared_specs, coordinates)
+
+    # simulate and collect results as they stream in
+    data = {'sink': sink} if sink else {}
+    try:
+        if processes:
+            if not chunksize:
+                chunksize = max(1, n_draws // (4 * processes))
+            with get_context("fork").Pool(processes, initializer=_init_worker, initargs=initargs) as p:
+                for draw, out in p.imap_unordered(_simulate_draw_star, tasks, chunksize=chunksize):
+                    _collect(data, draw, out, n_draws)
+        else:
+            _init_worker(*initargs)
+            for task in tasks:
+                draw, out = _simulate_draw(*task)
+                _collect(data, draw, out, n_draws)
+    finally:
+        for shm in _worker.pop('shm', []):
+            shm.close()
+        _worker.clear()
+        for shm in shms:
+            shm.close()
+            shm.unlink()
+
+    if sink:
+        return sink
+
+    # build the output dataset
+    template = data.pop('template')
+    return xr.Dataset({k: (('draw',) + template[k].dims, v) for k, v in data.items()},
+                        coords={'draw': np.arange(n_draws), **template.coords})
+
+def _collect(data, draw, out, n_draws):
+    """ Copies a realisation in the preallocated output arrays, or writes it to the output sink
+    """
+    if 'sink' in data:
+        sink = data['sink']
+        time_dim = out[sink.states[0]].dims[0]
+        t = out[time_dim].values
+        if time_dim == 'date':
+            t = (t - t[0]) / np.timedelta64(1, 'D')
+        sink.write_draw(draw, t, np.stack([out[X].values for X in sink.states], axis=1))
+        return
+    if not data:
+        data['template'] = out
+        for k in out.data_vars:
+            data[k] = np.empty((n_draws,) + out[k].shape, out[k].dtype)
+    for k in out.data_vars:
+        data[k][draw] = out[k].values
@@ -0,0 +1,226 @@
+"""
+This script contains a registry of the Belgian geography: the 581 municipalities of the 2011 census, indexed on NIS code and name, with their arrondissement, province and region.
+"""
+
+__author__      = "Tijs Alleman"
+__copyright__   = "Copyright (c) 2024 by T.W. Alleman, IDD Group, Johns Hopkins Bloomberg School of Public Health. All Rights Reserved."
+
+import numpy as np
+import pandas as pd
+import xarray as xr
+from functools import lru_cache
+from scipy.sparse import csr_array, issparse
+from cache import cached_arrays, data_path
+
+##########################
+## Administrative units ##
+##########################
+
+# regions (NIS codes 2000, 3000 and 4000)
+regions = ['Flanders', 'Wallonia', 'Brussels']
+
+# provinces by NIS code (the Brussels-Capital Region belongs to no province and is treated as one)
+provinces = {10000: 'Antwerpen', 20001: 'Vlaams-Brabant', 20002: 'Brabant wallon', 21000: 'Brussels', 30000: 'West-Vlaanderen',
+             40000: 'Oost-Vlaanderen', 50000: 'Hainaut', 60000: 'Liège', 70000: 'Limburg', 80000: 'Luxembourg', 90000: 'Namur'}
+
+def NIS2arrondissement(NIS):
+    """ Returns the NIS code of the arrondissement of a (vector of) municipality NIS code(s): the first two digits, f.i. 11002 --> 11000
+    """
+    return np.asarray(NIS) // 1000 * 1000
+
+def NIS2province(NIS):
+    """ Returns the NIS code of the province of a (vector of) municipality NIS code(s): the first digit, except for Brabant (2x000)
+    """
+    NIS = np.asarray(NIS)
+    return np.where(NIS // 10000 == 2, np.select([NIS // 1000 == 21, NIS // 1000 <= 24], [21000, 20001], 20002), NIS // 10000 * 10000)
+
+def NIS2region(NIS):
+    """ Returns the position in `regions` of the region of a (vector of) municipality NIS code(s)
+    """
+    province = NIS2province(NIS)
+    return np.select([province == 21000, np.isin(province, [20002, 50000, 60000, 80000, 90000])], [2, 1], 0)
+
+##############
+## Registry ##
+##############
+
+class Geography:
+    """
+    Registry of the Belgian municipalities, built once from their NIS codes and names.
+
+    Holds hash indexes name --> NIS and NIS --> position in the model's 'location' axis, and the position of every municipality's arrondissement, province and region in `self.units[level]`.
+    Lookups accept a single value or a vector of values.
+
+    input
+    -----
+    NIS: np.ndarray
+        NIS codes of the municipalities, in the order of the model's 'location' axis. Shape (n_loc,).
+
+    name: np.ndarray
+        Names of the municipalities. Shape (n_loc,).
+    """
+
+    levels = ['arrondissement', 'province', 'region']
+
+    def __init__(self, NIS, name):
+        self.NIS = np.asarray(NIS, np.int64)
+        self.name = np.asarray(name, str)
+        # hash indexes
+        self._name2NIS = dict(zip(self.name.tolist(), self.NIS.tolist()))
+        self._NIS2index = {int(x): i for i, x in enumerate(self.NIS)}
+        self._sorter = np.argsort(self.NIS, kind='stable')
+        # administrative units (labels) and the position of every municipality's unit
+        arrondissement_codes, arrondissement = np.unique(NIS2arrondissement(self.NIS), return_inverse=True)
+        province_codes, province = np.unique(NIS2province(self.NIS), return_inverse=True)
+        self.units = {'arrondissement': arrondissement_codes.tolist(),
+                      'province': [provinces[x] for x in province_codes],
+                      'region': regions}
+        self.index = {'arrondissement': arrondissement, 'province': province, 'region': NIS2region(self.NIS)}
+        self._membership = {}
+
+    def __len__(self):
+        return len(self.NIS)
+
+    def name2NIS(self, name):
+        """ Converts a (list of) Belgian municipality name(s) into NIS code(s)
+        """
+        if isinstance(name, str):
+            if name not in self._name2NIS:
+                raise ValueError(
+                    f"name '{name}' is not a valid Belgian municipality name"
+                )
+            return self._name2NIS[name]
+        return np.array([self.name2NIS(x) for x in name], np.int64)
+
+    def NIS2index(self, NIS):
+        """ Converts a (vector of) NIS code(s) into position(s) on the model's 'location' axis
+        """
+        if np.ndim(NIS) == 0:
+            if int(NIS) not in self._NIS2index:
+                raise ValueError(
+                    f"NIS code '{NIS}' is not a valid Belgian municipality NIS code"
+                )
+            return self._NIS2index[int(NIS)]
+        # vectorised: binary search
+        NIS = np.asarray(NIS, np.int64)
+        idx = self._sorter[np.minimum(np.searchsorted(self.NIS, NIS, sorter=self._sorter), len(self) - 1)]
+        invalid = self.NIS[idx] != NIS
+        if np.any(invalid):
+            raise ValueError(
+                f"NIS codes {NIS[invalid].tolist()} are not valid Belgian municipality NIS codes"
+            )
+        return idx
+
+    def NIS2unit(self, NIS, level):
+        """ Returns the position in `self.units[level]` of the arrondissement, province or region of a (vector of) NIS code(s)
+        """
+        return self.index[self._validate_level(level)][self.NIS2index(NIS)]
+
+    def membership(self, level):
+        """ Returns the (sparse) membership matrix of the municipalities in the arrondissements, provinces or regions. Shape (n_units, n_loc).
+        """
+        level = self._validate_level(level)
+        if level not in self._membership:
+            n = len(self)
+            self._membership[level] = csr_array((np.ones(n), (self.index[level], np.arange(n))), shape=(len(self.units[level]), n))
+        return self._membership[level]
+
+    def aggregate(self, X, level, axis=-1, dim='location'):
+        """
+        Sums the values of the municipalities over their arrondissement, province or region.
+
+        input
+        -----
+        X: np.ndarray or xarray.DataArray/Dataset
+            Values per municipality. For arrays, `axis` is the spatial axis (length n_loc). For xarray objects, `dim` is the spatial dimension.
+
+        level: str
+            'arrondissement', 'province' or 'region'.
+
+        output
+        ------
+        X: np.ndarray or xarray.DataArray/Dataset
+            Values per unit. The spatial axis has length `len(self.units[level])`; for xarray objects, the spatial dimension is renamed `level`.
+        """
+        if isinstance(X, xr.Dataset):
+            return X.map(self.aggregate, level=level, dim=dim)
+        if isinstance(X, xr.DataArray):
+            axis = X.dims.index(dim)
+            dims = X.dims[:axis] + (level,) + X.dims[axis+1:]
+            coords = {k: v for k, v in X.coords.items() if dim not in v.dims}
+            return xr.DataArray(self.aggregate(X.values, level, axis=axis), dims=dims, coords={**coords, level: self.units[level]})
+        # group-by as a sparse product over the spatial axis
+        X = np.moveaxis(np.asarray(X), axis, -1)
+        out = (self.membership(level) @ X.reshape(-1, X.shape[-1]).T).T
+        return np.moveaxis(out.reshape(X.shape[:-1] + (-1,)), -1, axis)
+
+    def aggregate_mobility(self, M, population, level):
+        """
+        Aggregates an origin-destination mobility matrix over the arrondissements, provinces or regions, conserving the number of travelers.
+
+        The number of travelers between two units is the sum of the travelers between their municipalities (travelers within a unit stay on its diagonal),
+        and is normalised with the population of the unit of origin.
+
+        input
+        -----
+        M: np.ndarray or scipy.sparse array
+            Fraction of the inhabitants of every municipality (rows) visiting every municipality (columns). Shape (n_loc, n_loc).
+
+        population: np.ndarray
+            Number of inhabitants of every municipality, f.i. summed over the age groups. Shape (n_loc,).
+
+        output
+        ------
+        M: np.ndarray or scipy.sparse.csr_array
+            Fraction of the inhabitants of every unit visiting every unit. Shape (n_units, n_units). Sparse if `M` is sparse.
+        """
+        P = self.membership(level)
+        population = np.asarray(population, np.float64)
+        if issparse(M):
+            flows = P @ csr_array(M).multiply(population[:, np.newaxis]).tocsr() @ P.T
+            return csr_array(flows.multiply(1 / (P @ population)[:, np.newaxis]))
+        flows = P @ (np.asarray(M) * population[:, np.newaxis]) @ P.T
+        return flows / (P @ population)[:, np.newaxis]
+
+    def disaggregate(self, X, level, weights, axis=-1):
+        """
+        Distributes the values of the arrondissements, provinces or regions over their municipalities, in proportion to `weights` (inverse of `aggregate`).
+
+        input
+        -----
+        X: np.ndarray
+            Values per unit. The spatial axis `axis` has length `len(self.units[level])`.
+
+        weights: np.ndarray
+            Weights of the municipalities, f.i. their number of inhabitants per age group. Broadcast against `X` with a spatial axis of length n_loc.
+
+        output
+        ------
+        X: np.ndarray
+            Values per municipality. Summing them over the units with `aggregate` returns `X` (for units with non-zero total weight).
+        """
+        X = np.moveaxis(np.asarray(X, np.float64), axis, -1)
+        weights = np.moveaxis(np.broadcast_to(np.asarray(weights, np.float64), X.shape[:-1] + (len(self),)), -1, 0)
+        index = self.index[self._validate_level(level)]
+        # share of every municipality in its unit's total weight
+        total = np.moveaxis(self.aggregate(weights, level, axis=0), 0, -1)
+        share = np.moveaxis(weights, 0, -1) / np.where(total == 0, 1, total)[..., index]
+        return np.moveaxis(X[..., index] * share, -1, axis)
+
+    def _validate_level(self, level):
+        if level not in self.levels:
+            raise ValueError(
+                f"invalid level '{level}'. valid levels are: {self.levels}"
+            )
+        return level
+
+@lru_cache(maxsize=None)
+def get_geography():
+    """ A function returning the registry of the 581 Belgian municipalities of the 2011 census (built once per process, source parsed once and cached)
+    """
+    source = data_path('interim', 'census_2011', 'demography_municipalities_2011_sorted.csv')
+    def build():
+        data = pd.read_csv(source)
+        return {'NIS': data['NIS'].values.astype(np.int64), 'name': np.asarray(data['name'], dtype=str)}
+    data = cached_arrays('geography_2011', [source], build)
+    return Geography(data['NIS'], data['name'])
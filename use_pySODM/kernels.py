@@ -0,0 +1,254 @@
+"""
+This script contains the computational kernels shared by the age-stratified spatially-explicit SIR models for use with pySODM.
+"""
+
+__author__      = "Tijs Alleman"
+__copyright__   = "Copyright (c) 2024 by T.W. Alleman, IDD Group, Johns Hopkins Bloomberg School of Public Health. All Rights Reserved."
+
+import numpy as np
+from scipy.sparse import issparse, coo_array, csr_array
+
+########################
+## Force of infection ##
+########################
+
+class ForceOfInfection:
+    """
+    Computes the force of infection of the age-stratified spatially-explicit SIR model without materialising the 4D contact tensor.
+
+    The contact tensor used in the models is C_{abcd} = N_{ab} * [(1 - f_v) * delta_{cd} + f_v * M_{cd}] and the force of infection reads,
+
+        l_{ac} = beta * sum_{b,d} C_{abcd} * I_{bd} / T_{bd},
+
+    which factorises into an age contraction followed by a spatial contraction,
+
+        l = beta * [(1 - f_v) * (N @ x) + f_v * (N @ x) @ M^T],    with x = I / (S + I + R).
+
+    This reduces the cost from O(n_age^2 * n_loc^2) in time and memory to O(n_age^2 * n_loc + n_age * n_loc^2) in time and O(n_age * n_loc) in memory.
+    If the mobility matrix is sparse, the spatial contraction costs O(n_age * nnz(M)).
+    All intermediate results are written into buffers that are allocated once per state shape and reused on every call.
+    States may carry leading batch dimensions (f.i. a 'draw' axis, shape (n_draw, n_age, n_loc)), in which case beta and f_v can be arrays with one value per batch element.
+
+    Note
+    ----
+    The returned array is an internal buffer, it is overwritten on the next call. Copy it if it must outlive the call.
+    """
+
+    def __init__(self):
+        self._buffers = {}
+
+    def _get_buffers(self, shape):
+        """ Returns (and allocates on first use) the work arrays associated with a state shape
+        """
+        try:
+            return self._buffers[shape]
+        except KeyError:
+            buffers = {k: np.empty(shape, np.float64) for k in ['T', 'x', 'Nx', 'NxM', 'l']}
+            self._buffers[shape] = buffers
+            return buffers
+
+    def __call__(self, S, I, R, beta, f_v, N, M):
+        """
+        input
+        -----
+        S, I, R: np.ndarray
+            Model states. Shape (n_age, n_loc) or (..., n_age, n_loc).
+
+        beta: float or np.ndarray
+            Infectivity. Float or array matching the leading dimensions of the states.
+
+        f_v: float or np.ndarray
+            Fraction of the total contacts made on the visited patch. Float or array matching the leading dimensions of the states.
+
+        N: np.ndarray
+            Contact matrix. Shape (n_age, n_age).
+
+        M: np.ndarray or scipy.sparse array
+            Origin-destination mobility matrix. Shape (n_loc, n_loc). Sparse matrices (f.i. `get_mobility_matrix(sparse=True)`) are contracted in O(n_age * nnz(M)).
+            A dense array of shape (n_loc, n_loc, n_age) holds one mobility matrix per age group (of the susceptibles, as in `models_legacy.matmul_2D_3D_matrix`).
+
+        output
+        ------
+        l: np.ndarray
+            Force of infection. Same shape as the states.
+        """
+
+        b = self._get_buffers(np.shape(S))
+        self._prevalence(b, S, I, R)
+        self._contract_age(b, N)
+        self._contract_space(b, M)
+        return self._mix(b, beta, f_v)
+
+    def scheduled(self, S, I, R, beta, N, A):
+        """
+        Force of infection with a pre-factorised mobility operator A = (1 - f_v) * Id + f_v * M (see `schedules.Schedule`), l = beta * (N @ x) @ A^T.
+
+        input
+        -----
+        S, I, R: np.ndarray
+            Model states. Shape (n_age, n_loc) or (..., n_age, n_loc).
+
+        beta: float or np.ndarray
+            Infectivity. Float or array matching the leading dimensions of the states.
+
+        N: np.ndarray
+            Contact matrix. Shape (n_age, n_age).
+
+        A: np.ndarray or scipy.sparse array
+            Mobility operator. Shape (n_loc, n_loc).
+
+        output
+        ------
+        l: np.ndarray
+            Force of infection. Same shape as the states.
+        """
+
+        b = self._get_buffers(np.shape(S))
+        self._prevalence(b, S, I, R)
+        self._contract_age(b, N)
+        self._contract_space(b, A)
+        return np.multiply(b['NxM'], broadcast_over_states(beta), out=b['l'])
+
+    # stages of the computation (timed separately by `profiling.ProfiledForceOfInfection`)
+    @staticmethod
+    def _prevalence(b, S, I, R):
+        """ x = I / (S + I + R)
+        """
+        np.add(S, I, out=b['T'])
+        np.add(b['T'], R, out=b['T'])
+        np.divide(I, b['T'], out=b['x'])
+
+    @staticmethod
+    def _contract_age(b, N):
+        """ Nx = N @ x
+        """
+        np.matmul(N, b['x'], out=b['Nx'])
+
+    @staticmethod
+    def _contract_space(b, M):
+        """ NxM = Nx @ M^T (batch dimensions are folded into one matrix product), or NxM_{ac} = sum_d Nx_{ad} * M_{cda} for age-specific mobility
+        """
+        if np.ndim(M) == 3:
+            np.einsum('...ad,cda->...ac', b['Nx'], M, out=b['NxM'])
+            return
+        n_loc = M.shape[0]
+        Nx, NxM = b['Nx'].reshape(-1, n_loc), b['NxM'].reshape(-1, n_loc)
+        if issparse(M):
+            NxM[...] = (M @ Nx.T).T
+        else:
+            np.matmul(Nx, M.T, out=NxM)
+
+    @staticmethod
+    def _mix(b, beta, f_v):
+        """ l = beta * [(1 - f_v) * Nx + f_v * NxM] (mix home and visited contacts)
+        """
+        beta = broadcast_over_states(beta)
+        f_v = broadcast_over_states(f_v)
+        np.multiply(b['Nx'], beta * (1 - f_v), out=b['l'])
+        np.multiply(b['NxM'], beta * f_v, out=b['NxM'])
+        np.add(b['l'], b['NxM'], out=b['l'])
+        return b['l']
+
+def broadcast_over_states(x):
+    """ Appends two trailing axes to a (batched) parameter so it broadcasts against states of shape (..., n_age, n_loc)
+    """
+    return np.reshape(x, np.shape(x) + (1, 1))
+
+# module-level engine shared by the models
+compute_force_of_infection = ForceOfInfection()
+
+##############
+## Jacobian ##
+##############
+
+class SIRJacobian:
+    """
+    Computes the analytical Jacobian of the age-stratified spatially-explicit SIR model (`models.spatial_ODE_SIR`) as a sparse matrix, with respect to the flattened states [S, I, R].
+
+    With K = beta * kron(N, (1 - f_v) * Id + f_v * M) the force of infection reads l = K @ x, with x = I / T and T = S + I + R, so that
+
+        d(dS)/dS = -diag(l) - diag(S) K diag(-I/T^2),    d(dS)/dI = -diag(S) K diag((S+R)/T^2),    d(dS)/dR = -diag(S) K diag(-I/T^2),
+        d(dI)/dZ = -d(dS)/dZ - delta_{ZI} / gamma,        d(dR)/dI = Id / gamma.
+
+    The sparsity pattern follows from the non-zero elements of N and M: every block but the diagonal ones of R has the pattern of K (nnz(N) * (nnz(M) + n_loc) at most).
+    The pattern and the position of every element of K in the Jacobian are computed once per contact and mobility matrix, every call only fills in the values.
+    """
+
+    def __init__(self):
+        self._structures = {}
+
+    def _get_structure(self, N, M, n_age, n_loc):
+        """ Returns (and computes on first use) the pattern of the Jacobian and the map of its elements, for a contact and mobility matrix (objects must not be modified in place)
+        """
+        key = (id(N), id(M), n_age, n_loc)
+        structure = self._structures.get(key)
+        if structure is not None and structure['N'] is N and structure['M'] is M:
+            return structure
+
+        # elements of K = kron(N, Id + M): rows (a, c), columns (b, d), with the values of N, Id and M
+        A = coo_array(csr_array(M) if issparse(M) else np.asarray(M))
+        A = coo_array((np.concatenate([np.zeros(A.nnz), np.ones(n_loc)]), (np.concatenate([A.row, np.arange(n_loc)]), np.concatenate([A.col, np.arange(n_loc)]))), shape=(n_loc, n_loc))
+        A.sum_duplicates()
+        M_values = csr_array(M)[A.row, A.col] if issparse(M) else np.asarray(M)[A.row, A.col]
+        a, b = np.nonzero(np.asarray(N))
+        row = (a[:, None] * n_loc + A.row[None, :]).ravel()
+        col = (b[:, None] * n_loc + A.col[None, :]).ravel()
+        kN = np.repeat(np.asarray(N)[a, b], A.nnz)
+        kD = np.tile(A.data, len(a))
+        kM = np.tile(M_values, len(a))
+
+        # all elements of the Jacobian (blocks SS, SI, SR, IS, II, IR from K and diagonals SS, IS, II, RI), duplicates are summed into a CSR template
+        n = n_age * n_loc
+        diag = np.arange(n)
+        rows = np.concatenate([row + i*n for i in [0, 0, 0, 1, 1, 1]] + [diag, diag + n, diag + n, diag + 2*n])
+        cols = np.concatenate([col + j*n for j in [0, 1, 2, 0, 1, 2]] + [diag, diag, diag + n, diag + n])
+        position, inverse = np.unique(rows * 3 * n + cols, return_inverse=True)
+        indptr = np.searchsorted(position // (3 * n), np.arange(3 * n + 1))
+        structure = {'N': N, 'M': M, 'row': row, 'col': col, 'kN': kN, 'kD': kD, 'kM': kM,
+                     'inverse': inverse.ravel(), 'indices': position % (3 * n), 'indptr': indptr, 'shape': (3 * n, 3 * n)}
+        self._structures[key] = structure
+        return structure
+
+    def sparsity(self, N, M, n_age, n_loc):
+        """ Returns the sparsity pattern of the Jacobian (ones on the structurally non-zero elements). Shape (3 * n_age * n_loc, 3 * n_age * n_loc).
+        """
+        s = self._get_structure(N, M, n_age, n_loc)
+        return csr_array((np.ones(len(s['indices'])), s['indices'], s['indptr']), shape=s['shape'])
+
+    def __call__(self, S, I, R, beta, gamma, f_v, N, M):
+        """
+        input
+        -----
+        S, I, R: np.ndarray
+            Model states. Shape (n_age, n_loc).
+
+        beta, gamma, f_v: float
+            Infectivity, duration of infection and fraction of the total contacts made on the visited patch.
+
+        N, M: np.ndarray or scipy.sparse array
+            Contact matrix (shape (n_age, n_age)) and origin-destination mobility matrix (shape (n_loc, n_loc)).
+
+        output
+        ------
+        J: scipy.sparse.csr_array
+            Jacobian of [dS, dI, dR] with respect to [S, I, R]. Shape (3 * n_age * n_loc, 3 * n_age * n_loc).
+        """
+        n_age, n_loc = np.shape(S)
+        s = self._get_structure(N, M, n_age, n_loc)
+        S, I, R = (np.ravel(x) for x in (S, I, R))
+        T = S + I + R
+
+        # values of K, force of infection, derivatives of the prevalence
+        K = beta * s['kN'] * ((1 - f_v) * s['kD'] + f_v * s['kM'])
+        l = np.bincount(s['row'], weights=K * (I / T)[s['col']], minlength=len(S))
+        SK = S[s['row']] * K
+        dx_dS = (-I / T**2)[s['col']]
+        dx_dI = ((S + R) / T**2)[s['col']]
+        SK_dS, SK_dI = SK * dx_dS, SK * dx_dI
+
+        data = np.concatenate([-SK_dS, -SK_dI, -SK_dS, SK_dS, SK_dI, SK_dS,
+                               -l, l, np.full(len(S), -1/gamma), np.full(len(S), 1/gamma)])
+        return csr_array((np.bincount(s['inverse'], weights=data, minlength=len(s['indices'])), s['indices'], s['indptr']), shape=s['shape'])
+
+# module-level Jacobian shared by the models
+compute_jacobian = SIRJacobian()
@@ -0,0 +1,441 @@
+"""
+This script contains numba-compiled kernels for the age-stratified spatially-explicit SIR models for use with pySODM.
+Every kernel fuses the contractions with the contact and mobility matrices, the division by the total population and the differentials/transitionings in one pass over the states.
+Compilation is cached on disk (`cache=True`), so only the first process ever started pays the JIT cost.
+"""
+
+__author__      = "Tijs Alleman"
+__copyright__   = "Copyright (c) 2024 by T.W. Alleman, IDD Group, Johns Hopkins Bloomberg School of Public Health. All Rights Reserved."
+
+import numpy as np
+from numba import njit
+from scipy.sparse import issparse, csr_array
+
+#################################
+## Force of infection (models) ##
+#################################
+
+@njit(cache=True, fastmath=True)
+def _contract_age(S, I, R, N, y):
+    """ Computes y_{ad} = sum_b N_{ab} * I_{bd} / T_{bd}, written into `y`
+    """
+    n_age, n_loc = S.shape
+    y[:] = 0.0
+    for b in range(n_age):
+        for d in range(n_loc):
+            x = I[b,d] / (S[b,d] + I[b,d] + R[b,d])
+            for a in range(n_age):
+                y[a,d] += N[a,b] * x
+
+@njit(cache=True, fastmath=True)
+def _foi_dense(S, I, R, beta, f_v, N, M, y, l):
+    """ Force of infection with a dense mobility matrix, written into `l` (`y` is a work array of the states' shape)
+    """
+    n_age, n_loc = S.shape
+    _contract_age(S, I, R, N, y)
+    for c in range(n_loc):
+        for a in range(n_age):
+            acc = 0.0
+            for d in range(n_loc):
+                acc += M[c,d] * y[a,d]
+            l[a,c] = beta * ((1 - f_v) * y[a,c] + f_v * acc)
+
+@njit(cache=True, fastmath=True)
+def _foi_csr(S, I, R, beta, f_v, N, indptr, indices, data, y, l):
+    """ Force of infection with a mobility matrix in compressed sparse row format, written into `l` (`y` is a work array of the states' shape)
+    """
+    n_age, n_loc = S.shape
+    _contract_age(S, I, R, N, y)
+    for c in range(n_loc):
+        for a in range(n_age):
+            acc = 0.0
+            for k in range(indptr[c], indptr[c+1]):
+                acc += data[k] * y[a,indices[k]]
+            l[a,c] = beta * ((1 - f_v) * y[a,c] + f_v * acc)
+
+def _as_operands(S, I, R, *args):
+    """ Casts the states and parameters to C-contiguous float64 so every kernel is compiled for exactly one signature (and served from the on-disk cache afterwards)
+    """
+    return tuple(np.ascontiguousarray(x, np.float64) for x in (S, I, R)) + tuple(float(x) for x in args)
+
+@njit(cache=True)
+def _sir_differentials(S, I, R, gamma, l, out):
+    """ Fuses the differentials of the SIR model into one pass, written into the stacked (3, n_age, n_loc) array `out`
+    """
+    n_age, n_loc = S.shape
+    for a in range(n_age):
+        for c in range(n_loc):
+            infections = l[a,c] * S[a,c]
+            recoveries = I[a,c] / gamma
+            out[0,a,c] = - infections
+            out[1,a,c] = infections - recoveries
+            out[2,a,c] = recoveries
+
+@njit(cache=True)
+def _ode_rhs_dense(S, I, R, beta, gamma, f_v, N, M, y, l, out):
+    _foi_dense(S, I, R, beta, f_v, N, M, y, l)
+    _sir_differentials(S, I, R, gamma, l, out)
+
+@njit(cache=True)
+def _ode_rhs_csr(S, I, R, beta, gamma, f_v, N, indptr, indices, data, y, l, out):
+    _foi_csr(S, I, R, beta, f_v, N, indptr, indices, data, y, l)
+    _sir_differentials(S, I, R, gamma, l, out)
+
+class CompiledSIR:
+    """
+    Compiled force of infection and right-hand side of the SIR models (`models.spatial_TL_SIR_numba`, `models.spatial_ODE_SIR_numba`), with a dense or a sparse mobility matrix.
+
+    The contact and mobility matrices are converted once (sparse mobility matrices to CSR with int64 indices) and cached, the work arrays are allocated once per state shape,
+    so a call of the right-hand side only casts the states (a no-op for pySODM's float64 states) and runs the kernel.
+
+    Note
+    ----
+    The differentials returned by `ode_rhs` are views on an internal buffer, they are overwritten on the next call. The converted operands are cached per contact and mobility matrix (objects must not be modified in place).
+    """
+
+    def __init__(self):
+        self._operands = {}
+        self._buffers = {}
+
+    def _get_operands(self, N, M):
+        """ Returns (and converts on first use) the contact matrix and the mobility matrix in the layout of the kernels
+        """
+        key = (id(N), id(M))
+        operands = self._operands.get(key)
+        if operands is not None and operands['N_ref'] is N and operands['M_ref'] is M:
+            return operands
+        operands = {'N_ref': N, 'M_ref': M, 'N': np.ascontiguousarray(N, np.float64)}
+        if issparse(M):
+            M = csr_array(M)
+            operands['M'] = (M.indptr.astype(np.int64), M.indices.astype(np.int64), np.ascontiguousarray(M.data, np.float64))
+        else:
+            operands['M'] = np.ascontiguousarray(M, np.float64)
+        self._operands[key] = operands
+        return operands
+
+    def _get_buffers(self, shape):
+        """ Returns (and allocates on first use) the work array of the age contraction, the force of infection and the stacked differentials associated with a (n_age, n_loc) state shape
+        """
+        try:
+            return self._buffers[shape]
+        except KeyError:
+            buffers = {'y': np.empty(shape), 'l': np.empty(shape), 'out': np.empty((3,) + shape)}
+            self._buffers[shape] = buffers
+            return buffers
+
+    def force_of_infection(self, S, I, R, beta, f_v, N, M):
+        """
+        Compiled equivalent of `kernels.compute_force_of_infection`.
+
+        output
+        ------
+        l: np.ndarray
+            Force of infection (a new array). Shape (n_age, n_loc).
+        """
+        S, I, R, beta, f_v = _as_operands(S, I, R, beta, f_v)
+        operands = self._get_operands(N, M)
+        y = self._get_buffers(S.shape)['y']
+        l = np.empty(S.shape)
+        if isinstance(operands['M'], tuple):
+            _foi_csr(S, I, R, beta, f_v, operands['N'], *operands['M'], y, l)
+        else:
+            _foi_dense(S, I, R, beta, f_v, operands['N'], operands['M'], y, l)
+        return l
+
+    def ode_rhs(self, S, I, R, beta, gamma, f_v, N, M):
+        """
+        Compiled right-hand side of `models.spatial_ODE_SIR`.
+
+        output
+        ------
+        dS, dI, dR: np.ndarray
+            Differentials (views on an internal buffer). Shape (n_age, n_loc).
+        """
+        S, I, R, beta, gamma, f_v = _as_operands(S, I, R, beta, gamma, f_v)
+        operands = self._get_operands(N, M)
+        b = self._get_buffers(S.shape)
+        if isinstance(operands['M'], tuple):
+            _ode_rhs_csr(S, I, R, beta, gamma, f_v, operands['N'], *operands['M'], b['y'], b['l'], b['out'])
+        else:
+            _ode_rhs_dense(S, I, R, beta, gamma, f_v, operands['N'], operands['M'], b['y'], b['l'], b['out'])
+        return tuple(b['out'])
+
+# module-level engine shared by the models
+compiled_sir = CompiledSIR()
+force_of_infection = compiled_sir.force_of_infection
+ode_rhs = compiled_sir.ode_rhs
+
+def apply_sir_transitionings(S, I, R, T_SI, T_IR):
+    """
+    Compiled `apply_transitionings` of the stochastic SIR models: S -> I (T_SI) and I -> R (T_IR).
+
+    output
+    ------
+    S_new, I_new, R_new: np.ndarray
+        Stacked as a (3, n_age, n_loc) array.
+    """
+    S, I, R = _as_operands(S, I, R)
+    return _apply_sir_transitionings(S, I, R, np.ascontiguousarray(T_SI, np.float64), np.ascontiguousarray(T_IR, np.float64))
+
+@njit(cache=True)
+def _apply_sir_transitionings(S, I, R, T_SI, T_IR):
+    n_age, n_loc = S.shape
+    out = np.empty((3, n_age, n_loc))
+    for a in range(n_age):
+        for c in range(n_loc):
+            out[0,a,c] = S[a,c] - T_SI[a,c]
+            out[1,a,c] = I[a,c] + T_SI[a,c] - T_IR[a,c]
+            out[2,a,c] = R[a,c] + T_IR[a,c]
+    return out
+
+#######################
+## Reduced precision ##
+#######################
+
+# storage precisions of the states and operands (reductions are always accumulated in float64)
+precisions = {'float64': np.float64, 'float32': np.float32}
+
+@njit(cache=True, fastmath=True)
+def _contract_age_lm(S, I, R, N, y):
+    """ Computes y_{d,(b,a)} = sum_e N_{ae} * I_{bed} / T_{bed} for states of shape (n_batch, n_age, n_loc), written into `y` in location-major layout (n_loc, n_batch * n_age)
+    """
+    n_batch, n_age, n_loc = S.shape
+    x = np.empty(n_age)
+    for b in range(n_batch):
+        for d in range(n_loc):
+            for e in range(n_age):
+                x[e] = np.float64(I[b,e,d]) / (np.float64(S[b,e,d]) + np.float64(I[b,e,d]) + np.float64(R[b,e,d]))
+            for a in range(n_age):
+                acc = 0.0
+                for e in range(n_age):
+                    acc += N[a,e] * x[e]
+                y[d, b*n_age + a] = acc
+
+@njit(cache=True, fastmath=True)
+def _mix_lm(y, acc, c, beta, f_v, l):
+    """ Writes l_{bac} = beta_b * [(1 - f_v_b) * y_{c,(b,a)} + f_v_b * acc_{(b,a)}]
+    """
+    n_batch, n_age = l.shape[0], l.shape[1]
+    for b in range(n_batch):
+        for a in range(n_age):
+            j = b*n_age + a
+            l[b,a,c] = beta[b] * ((1 - f_v[b]) * np.float64(y[c,j]) + f_v[b] * acc[j])
+
+@njit(cache=True, fastmath=True)
+def _foi_lm_csr(S, I, R, beta, f_v, N, indptr, indices, data, y, l):
+    """ Force of infection with a mobility matrix in compressed sparse row format: every non-zero element of M is read once and applied to all (batch, age) columns of `y`
+    """
+    _contract_age_lm(S, I, R, N, y)
+    n_loc, n_col = y.shape
+    acc = np.empty(n_col)
+    for c in range(n_loc):
+        acc[:] = 0.0
+        for k in range(indptr[c], indptr[c+1]):
+            w = np.float64(data[k])
+            d = indices[k]
+            for j in range(n_col):
+                acc[j] += w * y[d,j]
+        _mix_lm(y, acc, c, beta, f_v, l)
+
+@njit(cache=True, fastmath=True)
+def _mix_lm_dense(y, acc, beta, f_v, l):
+    """ Mixes the home contacts `y` and the visited contacts `acc` (both location-major) of all locations
+    """
+    for c in range(y.shape[0]):
+        _mix_lm(y, acc[c], c, beta, f_v, l)
+
+class PackedForceOfInfection:
+    """
+    Compiled force of infection with reduced-precision storage and float64 accumulation, for the models and ensembles limited by memory bandwidth.
+
+    The states, the intermediate results and the mobility matrix are stored in `precision`, all reductions (over the age groups and the visited patches) are accumulated in float64.
+    The layout follows the order of the contractions instead of the order of the model's dimensions:
+
+        - the mobility matrix is packed once into CSR with int32 indices,
+        - the age contraction N @ x is written in location-major layout (n_loc, n_batch * n_age), so the spatial contraction reads every element of M once
+          and applies it to a contiguous row of n_batch * n_age values (instead of once per age group and draw).
+
+    Dense mobility matrices are kept in float64 and contracted with BLAS (the contraction is compute-bound, a matrix-matrix product beats any bandwidth saving).
+
+    States may carry leading batch dimensions (f.i. a 'draw' axis), in which case beta and f_v can be arrays with one value per batch element.
+
+    input
+    -----
+    precision: str
+        Storage precision, 'float32' or 'float64' (see `precisions`).
+
+    Note
+    ----
+    The returned array is an internal buffer, it is overwritten on the next call. The packed operands are cached per contact and mobility matrix (objects must not be modified in place).
+    """
+
+    def __init__(self, precision='float32'):
+        if precision not in precisions:
+            raise ValueError(
+                f"invalid precision '{precision}'. valid precisions are: {list(precisions.keys())}"
+            )
+        self.precision = precision
+        self.dtype = precisions[precision]
+        self._operands = {}
+        self._buffers = {}
+
+    def _get_operands(self, N, M):
+        """ Returns (and packs on first use) the contact matrix (float64, it is tiny) and the mobility matrix in storage precision
+        """
+        key = (id(N), id(M))
+        operands = self._operands.get(key)
+        if operands is not None and operands['N_ref'] is N and operands['M_ref'] is M:
+            return operands
+        operands = {'N_ref': N, 'M_ref': M, 'N': np.ascontiguousarray(N, np.float64)}
+        if issparse(M):
+            M = csr_array(M)
+            M.sum_duplicates()
+            operands['M'] = (M.indptr.astype(np.int32), M.indices.astype(np.int32), np.ascontiguousarray(M.data, self.dtype))
+        else:
+            operands['M'] = np.ascontiguousarray(M, np.float64)
+        self._operands[key] = operands
+        return operands
+
+    def _get_buffers(self, shape):
+        """ Returns (and allocates on first use) the location-major intermediate, the output and the float64 work arrays of the dense contraction associated with a (batch, n_age, n_loc) state shape
+        """
+        try:
+            return self._buffers[shape]
+        except KeyError:
+            n_batch, n_age, n_loc = shape
+            buffers = {'y': np.empty((n_loc, n_batch * n_age), self.dtype), 'l': np.empty(shape, self.dtype)}
+            self._buffers[shape] = buffers
+            return buffers
+
+    def __call__(self, S, I, R, beta, f_v, N, M):
+        """
+        input
+        -----
+        S, I, R: np.ndarray
+            Model states. Shape (n_age, n_loc) or (..., n_age, n_loc). Float32 or float64.
+
+        beta, f_v: float or np.ndarray
+            Infectivity and fraction of the total contacts made on the visited patch. Float or array matching the leading dimensions of the states.
+
+        N, M: np.ndarray or scipy.sparse array
+            Contact matrix (shape (n_age, n_age)) and origin-destination mobility matrix (shape (n_loc, n_loc)).
+
+        output
+        ------
+        l: np.ndarray
+            Force of infection in storage precision. Same shape as the states.
+        """
+        shape = np.shape(S)
+        batched = (int(np.prod(shape[:-2])),) + shape[-2:]
+        # one compiled signature per state precision
+        dtype = precisions['float32'] if np.result_type(S, I, R) == np.float32 else np.float64
+        S, I, R = (np.ascontiguousarray(x, dtype).reshape(batched) for x in (S, I, R))
+        beta, f_v = (np.ascontiguousarray(np.broadcast_to(np.ravel(np.asarray(x, np.float64)), batched[:1])) for x in (beta, f_v))
+        operands = self._get_operands(N, M)
+        b = self._get_buffers(batched)
+        if isinstance(operands['M'], tuple):
+            _foi_lm_csr(S, I, R, beta, f_v, operands['N'], *operands['M'], b['y'], b['l'])
+        else:
+            if 'acc' not in b:
+                b['y64'] = b['y'] if self.dtype == np.float64 else np.empty(b['y'].shape)
+                b['acc'] = np.empty(b['y'].shape)
+            _contract_age_lm(S, I, R, operands['N'], b['y'])
+            np.copyto(b['y64'], b['y'])
+            np.matmul(operands['M'], b['y64'], out=b['acc'])
+            _mix_lm_dense(b['y'], b['acc'], beta, f_v, b['l'])
+        return b['l'].reshape(shape)
+
+# module-level float32 engine shared by the models
+force_of_infection_float32 = PackedForceOfInfection('float32')
+
+########################################
+## Force of infection (models_legacy) ##
+########################################
+
+@njit(cache=True, fastmath=True)
+def _legacy_foi(S, I, R, beta, f_v, N, M, l):
+    """
+    Force of infection of the legacy models, written into `l`.
+    N has shape (n_age, n_age, 1) or (n_age, n_age, n_loc), M has shape (n_loc, n_loc, 1) or (n_loc, n_loc, n_age) (see `models_legacy.matmul_2D_3D_matrix`).
+    """
+    n_age, n_loc = S.shape
+    age_specific_M = M.shape[2] > 1
+    loc_specific_N = N.shape[2] > 1
+
+    # compute visiting populations
+    T_v = np.zeros((n_age, n_loc))
+    I_v = np.zeros((n_age, n_loc))
+    for i in range(n_age):
+        mi = i if age_specific_M else 0
+        for k in range(n_loc):
+            T_ik = S[i,k] + I[i,k] + R[i,k]
+            I_ik = I[i,k]
+            for j in range(n_loc):
+                T_v[i,j] += T_ik * M[k,j,mi]
+                I_v[i,j] += I_ik * M[k,j,mi]
+
+    # contract age groups on the home and visited patches
+    home = np.zeros((n_age, n_loc))
+    visited = np.zeros((n_age, n_loc))
+    for k in range(n_loc):
+        nk = k if loc_specific_N else 0
+        for b in range(n_age):
+            x = I[b,k] / (S[b,k] + I[b,k] + R[b,k])
+            x_v = I_v[b,k] / T_v[b,k]
+            for a in range(n_age):
+                home[a,k] += N[a,b,nk] * x
+                visited[a,k] += N[a,b,nk] * x_v
+
+    # contract locations on the visited patches
+    for a in range(n_age):
+        mi = a if age_specific_M else 0
+        for j in range(n_loc):
+            acc = 0.0
+            for k in range(n_loc):
+                acc += M[j,k,mi] * visited[a,k]
+            l[a,j] = beta * ((1 - f_v) * home[a,j] + f_v * acc)
+
+@njit(cache=True)
+def _legacy_ode_rhs(S, I, R, beta, gamma, f_v, N, M):
+    l = np.empty(S.shape)
+    _legacy_foi(S, I, R, beta, f_v, N, M, l)
+    out = np.empty((3,) + S.shape)
+    _sir_differentials(S, I, R, gamma, l, out)
+    return out
+
+def _as_legacy_operands(N, M):
+    """ Brings the contact and mobility matrices of the legacy models in the 3D layout expected by the compiled kernels
+    """
+    if issparse(M):
+        raise ValueError(
+            "the compiled kernels of the legacy models require a dense (2D or 3D) mobility matrix"
+        )
+    return np.ascontiguousarray(np.atleast_3d(N), np.float64), np.ascontiguousarray(np.atleast_3d(M), np.float64)
+
+def legacy_force_of_infection(S, I, R, beta, f_v, N, M):
+    """
+    Compiled force of infection of the models in `models_legacy.py`.
+
+    output
+    ------
+    l: np.ndarray
+        Force of infection. Shape (n_age, n_loc).
+    """
+    S, I, R, beta, f_v = _as_operands(S, I, R, beta, f_v)
+    N, M = _as_legacy_operands(N, M)
+    l = np.empty(S.shape)
+    _legacy_foi(S, I, R, beta, f_v, N, M, l)
+    return l
+
+def legacy_ode_rhs(S, I, R, beta, gamma, f_v, N, M):
+    """
+    Compiled right-hand side of `models_legacy.spatial_ODE_SIR`.
+
+    output
+    ------
+    dS, dI, dR: np.ndarray
+        Differentials. Shape (n_age, n_loc).
+    """
+    S, I, R, beta, gamma, f_v = _as_operands(S, I, R, beta, gamma, f_v)
+    N, M = _as_legacy_operands(N, M)
+    return tuple(_legacy_ode_rhs(S, I, R, beta, gamma, f_v, N, M))
@@ -7,12 +7,15 @@ __copyright__   = "Copyright (c) 2024 by T.W. Alleman, IDD Group, Johns Hopkins
 
 import numpy as np
 from pySODM.models.base import ODE, JumpProcess
+from kernels import compute_force_of_infection, broadcast_over_states, compute_jacobian
+from kernels_numba import ode_rhs, force_of_infection, apply_sir_transitionings, force_of_infection_float32
+from solvers import FixedStepODE, JacobianODE
 
 ###################
 ## Deterministic ##
 ###################
 
-class spatial_ODE_SIR(ODE):
+class spatial_ODE_SIR(JacobianODE):
     """
     SIR model with age and spatial stratification
     """
@@ -24,21 +27,178 @@ class spatial_ODE_SIR(ODE):
     @staticmethod
     def integrate(t, S, I, R, beta, gamma, f_v, N, M):
 
-        # compute contact tensor with different home vs. visited contacts
-        C =  ((1 - f_v) * np.einsum('ab,cd->abcd', N, np.eye(M.shape[0])) + f_v * np.einsum('ab,cd->abcd', N, M))
+        # compute force of infection (factorised contact tensor with different home vs. visited contacts)
+        l = compute_force_of_infection(S, I, R, beta, f_v, N, M)
 
-        # compute force of infection
-        l = beta * np.einsum ('abcd,bd->ac', C, I/(S+I+R))
+        # calculate differentials
+        dS = - l * S
+        dI = l * S - 1/gamma*I
+        dR = 1/gamma*I
+
+        return dS, dI, dR
+
+    @staticmethod
+    def jacobian(t, S, I, R, beta, gamma, f_v, N, M):
+        return compute_jacobian(S, I, R, beta, gamma, f_v, N, M)
+
+    def jacobian_sparsity(self):
+        # age-specific mobility (3D M): finite differences
+        if np.ndim(self.parameters['M']) == 3:
+            return None
+        return compute_jacobian.sparsity(self.parameters['N'], self.parameters['M'], *self.state_shapes['S'])
+
+# numba variant --> compiled kernel fusing the contractions and differentials, compilation is cached on disk
+class spatial_ODE_SIR_numba(spatial_ODE_SIR):
+    """
+    SIR model with age and spatial stratification (numba-compiled integrate)
+    """
+
+    @staticmethod
+    def integrate(t, S, I, R, beta, gamma, f_v, N, M):
+        return ode_rhs(S, I, R, beta, gamma, f_v, N, M)
+
+# float32 variant --> reduced-precision storage with float64 accumulation, layout following the contraction order
+class spatial_ODE_SIR_float32(spatial_ODE_SIR):
+    """
+    SIR model with age and spatial stratification (float32 storage, float64 accumulation, see `kernels_numba.PackedForceOfInfection`)
+
+    The fixed-step methods (`sim(..., method='rk4')`) integrate and return the states in float32. scipy's solvers integrate in float64, only the force of infection is computed in float32.
+    """
+
+    precision = 'float32'
+
+    @staticmethod
+    def integrate(t, S, I, R, beta, gamma, f_v, N, M):
+
+        # compute force of infection (float32 storage, float64 reductions)
+        l = force_of_infection_float32(S, I, R, beta, f_v, N, M)
+
+        # calculate differentials
+        dS = - l * S
+        dI = l * S - 1/gamma*I
+        dR = 1/gamma*I
+
+        return dS, dI, dR
+
+# scheduled variant --> contacts and mobility looked up per day in a compiled table of regimes (school holidays, weekends, ...)
+class spatial_ODE_SIR_scheduled(JacobianODE):
+    """
+    SIR model with age and spatial stratification, with contacts and mobility following a schedule
+
+    `schedule` is a `schedules.Schedule` whose start date corresponds to time 0 of the simulation. Every call looks up the contact matrix N and the
+    pre-factorised mobility operator (1 - f_v) * Id + f_v * M of the current day, so that the cost per call equals that of `spatial_ODE_SIR`.
+    Adaptive solvers take extra steps at the changes of regime (discontinuities of the right-hand side), the fixed-step methods (`sim(..., method='rk4', dt=...)` with 1/dt an integer) do not.
+    """
+
+    states = ['S','I','R']
+    parameters = ['beta','gamma', 'schedule']
+    dimensions = ['age', 'location']
+
+    @staticmethod
+    def integrate(t, S, I, R, beta, gamma, schedule):
+
+        # compute force of infection (contacts and mobility operator of the current day)
+        N, A = schedule(t)
+        l = compute_force_of_infection.scheduled(S, I, R, beta, N, A)
+
+        # calculate differentials
+        dS = - l * S
+        dI = l * S - 1/gamma*I
+        dR = 1/gamma*I
+
+        return dS, dI, dR
+
+    @staticmethod
+    def jacobian(t, S, I, R, beta, gamma, schedule):
+        # the operator A = (1 - f_v) * Id + f_v * M takes the place of M with f_v = 1
+        N, A = schedule(t)
+        return compute_jacobian(S, I, R, beta, gamma, 1, N, A)
+
+    def jacobian_sparsity(self):
+        # union of the patterns of all regimes
+        pattern = sum(compute_jacobian.sparsity(N, A, *self.state_shapes['S']) for N, A in self.parameters['schedule'].operators)
+        pattern.data[:] = 1
+        return pattern
+
+# ensemble variant --> integrates a batch of parameter draws in a single solver run
+class spatial_ODE_SIR_ensemble(FixedStepODE):
+    """
+    SIR model with age and spatial stratification, integrating n_draw parameter sets at once
+
+    beta, gamma and f_v are arrays of shape (n_draw,), the states have shape (n_draw, n_age, n_loc).
+    All draws share the solver's step size, so draws that are very different in speed are best grouped in separate batches.
+    """
+
+    states = ['S','I','R']
+    parameters = ['beta','gamma', 'f_v', 'N', 'M']
+    dimensions = ['draw', 'age', 'location']
+
+    @staticmethod
+    def integrate(t, S, I, R, beta, gamma, f_v, N, M):
+
+        # compute force of infection (batched over the leading 'draw' axis)
+        l = compute_force_of_infection(S, I, R, beta, f_v, N, M)
 
         # calculate differentials
+        gamma = broadcast_over_states(gamma)
         dS = - l * S
         dI = l * S - 1/gamma*I
         dR = 1/gamma*I
 
         return dS, dI, dR
 
-# tensorflow variant --> can utilise the GPU but setup for macOS is a pain
-import tensorflow as tf
+    def _create_fun(self, actual_start_date):
+        """
+        Array-based replacement of pySODM's scipy wrapper. The states are passed to `integrate` as views on the flat solver vector and
+        the differentials are written into one flat array, instead of being flattened through Python lists (which dominates for large batches).
+        Falls back to pySODM's wrapper if time-dependent parameters are used.
+        """
+
+        if self.time_dependent_parameters:
+            return super()._create_fun(actual_start_date)
+
+        names = list(self.state_shapes.keys())
+        shapes = list(self.state_shapes.values())
+        offsets = np.cumsum([0,] + [int(np.prod(s)) for s in shapes])
+
+        def func(t, y, pars={}):
+            states = {k: y[o0:o1].reshape(s) for k, s, o0, o1 in zip(names, shapes, offsets[:-1], offsets[1:])}
+            params = {k: pars[k] for k in self.parameters_names_modeldeclaration}
+            dy = np.empty(offsets[-1])
+            for d, o0, o1 in zip(self.integrate(t, **states, **params), offsets[:-1], offsets[1:]):
+                dy[o0:o1] = np.ravel(d)
+            return dy
+
+        return func
+
+# float32 variant --> states of the ensemble in float32 with the fixed-step methods (halves the memory footprint of large ensembles)
+class spatial_ODE_SIR_ensemble_float32(spatial_ODE_SIR_ensemble):
+    """
+    SIR model with age and spatial stratification, integrating n_draw parameter sets at once (float32 storage, float64 accumulation, see `kernels_numba.PackedForceOfInfection`)
+    """
+
+    precision = 'float32'
+
+    @staticmethod
+    def integrate(t, S, I, R, beta, gamma, f_v, N, M):
+
+        # compute force of infection (batched over the leading 'draw' axis, float32 storage, float64 reductions)
+        l = force_of_infection_float32(S, I, R, beta, f_v, N, M)
+
+        # calculate differentials
+        gamma = broadcast_over_states(gamma)
+        dS = - l * S
+        dI = l * S - 1/gamma*I
+        dR = 1/gamma*I
+
+        return dS, dI, dR
+
+# tensorflow variant --> can utilise the GPU but setup for macOS is a pain (optional dependency)
+try:
+    import tensorflow as tf
+except ImportError:
+    tf = None
+
 class spatial_ODE_SIR_tf(ODE):
     """
     SIR model with age and spatial stratification
@@ -84,11 +244,8 @@ class spatial_TL_SIR(JumpProcess):
     @staticmethod
     def compute_rates(t, S, I, R, beta, gamma, f_v, N, M):
 
-        # compute contact tensor with different home vs. visited contacts
-        C =  ((1 - f_v) * np.einsum('ab,cd->abcd', N, np.eye(M.shape[0])) + f_v * np.einsum('ab,cd->abcd', N, M))
-
-        # compute force of infection
-        l = beta * np.einsum('abcd,bd->ac', C, I/(S+I+R))
+        # compute force of infection (factorised contact tensor with different home vs. visited contacts)
+        l = compute_force_of_infection(S, I, R, beta, f_v, N, M).copy()
 
         rates = {
             'S': [l], 
@@ -104,4 +261,77 @@ class spatial_TL_SIR(JumpProcess):
         I_new = I + transitionings['S'][0] - transitionings['I'][0]
         R_new = R + transitionings['I'][0]
         
-        return(S_new, I_new, R_new)
\ No newline at end of file
+        return(S_new, I_new, R_new)
+
+# numba variant --> compiled kernels fusing the contractions and transitionings, compilation is cached on disk
+class spatial_TL_SIR_numba(spatial_TL_SIR):
+    """
+    Stochastic SIR model with age and spatial stratification (numba-compiled compute_rates and apply_transitionings)
+    """
+
+    @staticmethod
+    def compute_rates(t, S, I, R, beta, gamma, f_v, N, M):
+
+        rates = {
+            'S': [force_of_infection(S, I, R, beta, f_v, N, M)],
+            'I': [np.full(S.shape, 1/gamma)],
+            }
+
+        return rates
+
+    @staticmethod
+    def apply_transitionings(t, tau, transitionings, S, I, R, beta, f_v, gamma, N, M):
+        return tuple(apply_sir_transitionings(S, I, R, transitionings['S'][0], transitionings['I'][0]))
+
+# float32 variant --> reduced-precision storage with float64 accumulation (see `spatial_ODE_SIR_float32`)
+class spatial_TL_SIR_float32(spatial_TL_SIR):
+    """
+    Stochastic SIR model with age and spatial stratification (force of infection with float32 storage and float64 accumulation)
+    """
+
+    precision = 'float32'
+
+    @staticmethod
+    def compute_rates(t, S, I, R, beta, gamma, f_v, N, M):
+
+        # compute force of infection (float32 storage, float64 reductions)
+        l = force_of_infection_float32(S, I, R, beta, f_v, N, M).copy()
+
+        rates = {
+            'S': [l],
+            'I': [np.full(S.shape, 1/gamma, np.float32)],
+            }
+
+        return rates
+
+# scheduled variant --> contacts and mobility looked up per day in a compiled table of regimes (see `spatial_ODE_SIR_scheduled`)
+class spatial_TL_SIR_scheduled(JumpProcess):
+    """
+    Stochastic SIR model with age and spatial stratification, with contacts and mobility following a schedule
+    """
+    states = ['S', 'I','R']
+    parameters = ['beta','gamma', 'schedule']
+    dimensions = ['age', 'location']
+
+    @staticmethod
+    def compute_rates(t, S, I, R, beta, gamma, schedule):
+
+        # compute force of infection (contacts and mobility operator of the current day)
+        N, A = schedule(t)
+        l = compute_force_of_infection.scheduled(S, I, R, beta, N, A).copy()
+
+        rates = {
+            'S': [l],
+            'I': [np.ones(S.shape, np.float64)*(1/gamma)],
+            }
+
+        return rates
+
+    @staticmethod
+    def apply_transitionings(t, tau, transitionings, S, I, R, beta, gamma, schedule):
+
+        S_new = S - transitionings['S'][0]
+        I_new = I + transitionings['S'][0] - transitionings['I'][0]
+        R_new = R + transitionings['I'][0]
+
+        return(S_new, I_new, R_new)
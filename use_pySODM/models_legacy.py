@@ -6,13 +6,16 @@ __author__      = "Tijs Alleman"
 __copyright__   = "Copyright (c) 2024 by T.W. Alleman, IDD Group, Johns Hopkins Bloomberg School of Public Health. All Rights Reserved."
 
 import numpy as np
+from scipy.sparse import issparse, csr_array, diags_array, block_array, eye_array
 from pySODM.models.base import ODE, JumpProcess
+from solvers import JacobianODE
+from kernels_numba import legacy_ode_rhs, legacy_force_of_infection, apply_sir_transitionings
 
 ###################
 ## Deterministic ##
 ###################
 
-class spatial_ODE_SIR(ODE):
+class spatial_ODE_SIR(JacobianODE):
     """
     Stochastic SIR model with age and spatial stratification
     """
@@ -32,7 +35,7 @@ class spatial_ODE_SIR(ODE):
         I_v = matmul_2D_3D_matrix(I, M)
 
         # compute force of infection
-        l = beta * (1 - f_v) * np.einsum('kj,ikj->ij', I/T, np.atleast_3d(N)) + beta * f_v * np.einsum('jki,lk,ilk->ij', np.atleast_3d(M), I_v/T_v, np.atleast_3d(N))
+        l = beta * (1 - f_v) * np.einsum('kj,ikj->ij', I/T, np.atleast_3d(N)) + beta * f_v * visited_force_of_infection(I_v/T_v, N, M)
 
         # compute differentials
         dS = - l * S
@@ -41,6 +44,23 @@ class spatial_ODE_SIR(ODE):
 
         return dS, dI, dR
 
+    @staticmethod
+    def jacobian(t, S, I, R, beta, gamma, f_v, N, M):
+        return legacy_jacobian(S, I, R, beta, gamma, f_v, N, M)
+
+    def jacobian_sparsity(self):
+        return legacy_jacobian_sparsity(self.parameters['N'], self.parameters['M'], *self.state_shapes['S'])
+
+# numba variant --> compiled kernel fusing the contractions and differentials, compilation is cached on disk
+class spatial_ODE_SIR_numba(spatial_ODE_SIR):
+    """
+    SIR model with age and spatial stratification (numba-compiled integrate)
+    """
+
+    @staticmethod
+    def integrate(t, S, I, R, beta, gamma, f_v, N, M):
+        return legacy_ode_rhs(S, I, R, beta, gamma, f_v, N, M)
+
 ###################
 ### Stochastic ###
 ###################
@@ -71,7 +91,7 @@ class spatial_TL_SIR(JumpProcess):
         size_dummy = np.ones([G,H], np.float64)
 
         # compute force of infection
-        l = beta * (1 - f_v) * np.einsum('kj,ikj->ij', I/T, np.atleast_3d(N)) + beta * f_v * np.einsum('jki,lk,ilk->ij', np.atleast_3d(M), I_v/T_v, np.atleast_3d(N))
+        l = beta * (1 - f_v) * np.einsum('kj,ikj->ij', I/T, np.atleast_3d(N)) + beta * f_v * visited_force_of_infection(I_v/T_v, N, M)
 
         rates = {
             'S': [l],
@@ -91,6 +111,28 @@ class spatial_TL_SIR(JumpProcess):
         R_new = R + transitionings['I'][0]
         
         return(S_new, I_new, R_new)
+
+# numba variant --> compiled kernels fusing the contractions and transitionings, compilation is cached on disk
+class spatial_TL_SIR_numba(spatial_TL_SIR):
+    """
+    Stochastic SIR model with age and spatial stratification (numba-compiled compute_rates and apply_transitionings)
+    """
+
+    @staticmethod
+    def compute_rates(t, S, I, R, beta, gamma, f_v, N, M):
+
+        rates = {
+            'S': [legacy_force_of_infection(S, I, R, beta, f_v, N, M)],
+            'I': [np.full(S.shape, 1/gamma)],
+            }
+
+        return rates
+
+    @staticmethod
+    def apply_transitionings(t, tau, transitionings, S, I, R,
+                             beta, f_v, gamma,
+                             N, M):
+        return tuple(apply_sir_transitionings(S, I, R, transitionings['S'][0], transitionings['I'][0]))
     
 # helper function
 def matmul_2D_3D_matrix(X, W):
@@ -101,8 +143,9 @@ def matmul_2D_3D_matrix(X, W):
     =====
     X: np.ndarray
         Matrix of size (n,m).
-    W : np.ndarray
+    W : np.ndarray or scipy.sparse array
         2D or 3D matrix:
+        - If sparse: Shape (m, m).
         - If 2D: Shape (m, m). Expanded to size (m, m, n).
         - If 3D: Shape (m, m, n).
           Represents n stacked (m x m) matrices.
@@ -113,5 +156,101 @@ def matmul_2D_3D_matrix(X, W):
         Matrix product of size (n, m). 
         Element-wise equivalent operation: O_{ij} = \sum_{l} [ s_{il} * w_{lji} ]
     """
+    if issparse(W):
+        return (W.T @ X.T).T
     W = np.atleast_3d(W)
     return np.einsum('ik,kji->ij', X, np.broadcast_to(W, (W.shape[0], W.shape[0], X.shape[0])))
+
+def visited_force_of_infection(X, N, M):
+    """
+    Computes the (unscaled) force of infection exerted on the inhabitants of every patch by the infected they meet on the visited patches.
+
+    input
+    =====
+    X: np.ndarray
+        Fraction of infected on the visited patches (I_v/T_v). Size (n,m).
+    N: np.ndarray
+        Contact matrix of size (n, n) or (n, n, m).
+    M: np.ndarray or scipy.sparse array
+        2D or 3D origin-destination matrix:
+        - If 2D: Shape (m, m). Can be sparse.
+        - If 3D: Shape (m, m, n). Represents n stacked (m x m) matrices.
+
+    output
+    ======
+    X_out : np.ndarray
+        Force of infection of size (n, m).
+        Element-wise equivalent operation: O_{ij} = \sum_{k,l} [ m_{jki} * x_{lk} * n_{ilk} ]
+    """
+    if issparse(M):
+        return (M @ np.einsum('ilk,lk->ik', np.atleast_3d(N), X).T).T
+    return np.einsum('jki,lk,ilk->ij', np.atleast_3d(M), X, np.atleast_3d(N))
+
+##############
+## Jacobian ##
+##############
+
+def _per_age(X, n_age):
+    """ Returns the (n_loc, n_loc) slices of a 2D (dense or sparse) or 3D (n_loc, n_loc, n_age) origin-destination matrix, one per age group, as sparse matrices
+    """
+    if issparse(X) or np.ndim(X) == 2:
+        return [csr_array(X)] * n_age
+    return [csr_array(X[:, :, a]) for a in range(n_age)]
+
+def _force_of_infection_derivative(N, M, w_home, w_visited, beta, f_v):
+    """
+    Derivative of the force of infection l_{ac} with respect to a state Z_{be}, given the derivatives of the prevalences x = I/T (`w_home`, shape (n_age, n_loc)) and X = I_v/T_v (`w_visited`, per unit of M) with respect to Z,
+
+        dl_{ac}/dZ_{be} = beta * (1 - f_v) * N_{abc} * w_home_{bc} * delta_{ce} + beta * f_v * sum_d M_{cda} * N_{abd} * w_visited_{bd} * M_{edb}
+
+    output
+    ------
+    dl: scipy.sparse.csr_array
+        Shape (n_age * n_loc, n_age * n_loc).
+    """
+    n_age, n_loc = w_home.shape
+    N = np.broadcast_to(np.atleast_3d(N), (n_age, n_age, n_loc))
+    M = _per_age(M, n_age)
+    blocks = [[diags_array(beta * (1 - f_v) * N[a, b] * w_home[b]) + beta * f_v * (M[a] @ diags_array(N[a, b] * w_visited[b]) @ M[b].T)
+               for b in range(n_age)] for a in range(n_age)]
+    return csr_array(block_array(blocks))
+
+def legacy_jacobian(S, I, R, beta, gamma, f_v, N, M):
+    """
+    Analytical Jacobian of `spatial_ODE_SIR` (legacy) with respect to the flattened states [S, I, R], for age-specific (3D) or shared (2D, dense or sparse) origin-destination matrices.
+
+    The prevalence on the home patch x = I/T and on the visited patch X = I_v/T_v (with I_v, T_v the visiting populations) depend on the states through
+
+        dx/dS = dx/dR = -I/T^2,    dx/dI = (T-I)/T^2,    dX_{bd}/dS_{be} = dX_{bd}/dR_{be} = -M_{edb} I_v/T_v^2,    dX_{bd}/dI_{be} = M_{edb} (T_v-I_v)/T_v^2.
+
+    output
+    ------
+    J: scipy.sparse.csr_array
+        Jacobian of [dS, dI, dR]. Shape (3 * n_age * n_loc, 3 * n_age * n_loc). Its pattern is that of M @ M^T per pair of age groups (denser than M).
+    """
+    n_age, n_loc = S.shape
+    T = S + I + R
+    T_v = matmul_2D_3D_matrix(T, M)
+    I_v = matmul_2D_3D_matrix(I, M)
+    l = beta * (1 - f_v) * np.einsum('kj,ikj->ij', I/T, np.atleast_3d(N)) + beta * f_v * visited_force_of_infection(I_v/T_v, N, M)
+
+    # derivatives of the force of infection (S and R enter the prevalences in the same way)
+    dl_dS = _force_of_infection_derivative(N, M, -I/T**2, -I_v/T_v**2, beta, f_v)
+    dl_dI = _force_of_infection_derivative(N, M, (T-I)/T**2, (T_v-I_v)/T_v**2, beta, f_v)
+
+    n = n_age * n_loc
+    D_S, D_l, Id = diags_array(S.ravel()), diags_array(l.ravel()), eye_array(n)
+    S_dl_dS, S_dl_dI = D_S @ dl_dS, D_S @ dl_dI
+    return csr_array(block_array([[-D_l - S_dl_dS, -S_dl_dI, -S_dl_dS],
+                                  [D_l + S_dl_dS, S_dl_dI - Id/gamma, S_dl_dS],
+                                  [None, Id/gamma, None]], format='csr'))
+
+def legacy_jacobian_sparsity(N, M, n_age, n_loc):
+    """ Returns the sparsity pattern of `legacy_jacobian` (ones on the structurally non-zero elements). Shape (3 * n_age * n_loc, 3 * n_age * n_loc).
+    """
+    M = abs(csr_array(M)) if issparse(M) else np.abs(M)
+    pattern = _force_of_infection_derivative(np.abs(N), M, np.ones((n_age, n_loc)), np.ones((n_age, n_loc)), 1, 0.5)
+    pattern = pattern + eye_array(n_age * n_loc)
+    pattern = block_array([[pattern, pattern, pattern], [pattern, pattern, pattern], [None, eye_array(n_age * n_loc), None]], format='csr')
+    pattern.data[:] = 1
+    return pattern
@@ -0,0 +1,157 @@
+"""
+This script contains an observation operator accumulating the new infections (S -> I) of the age-stratified spatially-explicit SIR models into weekly, national, age-stratified incidence during the simulation, in the format of the ILI data (`data/conversion/format_cases.py`).
+"""
+
+__author__      = "Tijs Alleman"
+__copyright__   = "Copyright (c) 2024 by T.W. Alleman, IDD Group, Johns Hopkins Bloomberg School of Public Health. All Rights Reserved."
+
+import numpy as np
+import pandas as pd
+from scipy.integrate import RK23, RK45, DOP853, Radau, BDF, LSODA
+from pySODM.models.validation import validate_simulation_time
+
+# age groups of the ILI data (see `data/conversion/format_cases.py`)
+age_groups = pd.IntervalIndex.from_tuples([(0,5),(5,15),(15,65),(65,120)], closed='left')
+
+# integrators of `scipy.integrate.solve_ivp`
+methods = {'RK23': RK23, 'RK45': RK45, 'DOP853': DOP853, 'Radau': Radau, 'BDF': BDF, 'LSODA': LSODA}
+
+def week_boundaries(dates, start_date):
+    """ Returns the start and end of the weeks centered on `dates`, in days since `start_date`. Shape (n_weeks + 1,)
+    """
+    dates = np.asarray(dates, dtype='datetime64[s]')
+    midpoints = (dates - np.datetime64(pd.Timestamp(start_date).to_datetime64(), 's')) / np.timedelta64(1, 'D')
+    return np.append(midpoints - 3.5, midpoints[-1] + 3.5)
+
+def week_midpoints(start, stop):
+    """ Returns the midpoints (Thursday, 12:00) of the weeks between the dates `start` and `stop`, as in `data/conversion/format_cases.py`
+    """
+    return pd.date_range(pd.Timestamp(start) - pd.Timedelta(days=6), stop, freq='W-MON', normalize=True) + pd.Timedelta(days=3.5)
+
+######################
+## Weekly incidence ##
+######################
+
+class WeeklyObservation:
+    """
+    Accumulates the number of new infections per age group into the weeks centered on `dates`.
+
+    input
+    -----
+    dates: list of datetime
+        Midpoints of the weeks, f.i. `utils.load_ILI_2017_2018()['date']` or `week_midpoints(start, stop)`.
+
+    start_date: str or datetime
+        Date corresponding to time 0 of the simulation.
+
+    n_age: int
+        Number of age groups. Default: 4 (see `age_groups`).
+    """
+
+    def __init__(self, dates, start_date, n_age=len(age_groups)):
+        self.dates = pd.DatetimeIndex(dates)
+        self.start_date = pd.Timestamp(start_date)
+        self.boundaries = week_boundaries(self.dates, self.start_date)
+        self.incidence = np.zeros((len(self.dates), n_age))
+
+    def reset(self):
+        self.incidence[...] = 0
+        return self
+
+    def accumulate(self, t0, t1, new_infections):
+        """
+        Adds the new infections per age group during [t0, t1], spread uniformly over the interval (and hence over the weeks it overlaps).
+
+        input
+        -----
+        t0, t1: float
+            Start and end of the interval, in days since `start_date`.
+
+        new_infections: np.ndarray
+            New infections per age group during the interval. Shape (n_age,).
+        """
+        if t1 <= self.boundaries[0] or t0 >= self.boundaries[-1]:
+            return
+        overlap = np.clip(np.minimum(self.boundaries[1:], t1) - np.maximum(self.boundaries[:-1], t0), 0, None)
+        self.incidence += np.outer(overlap / (t1 - t0), new_infections)
+
+    def to_dataframe(self):
+        """ Returns the weekly incidence in the long format of `data/interim/cases/2017-2018/ILI_weekly_ABS.csv`
+        """
+        index = pd.MultiIndex.from_product([self.dates, age_groups[:self.incidence.shape[1]]], names=['DATE', 'AGE'])
+        return pd.Series(self.incidence.ravel(), index=index, name='CASES')
+
+#########
+## ODE ##
+#########
+
+def simulate_weekly_ILI(model, observation, time=None, method='RK45', rtol=1e-4):
+    """
+    Integrates a pySODM ODE model of the SIR family and returns only the weekly number of new infections per age group, without storing the trajectory.
+
+    The solver is stepped manually (as `scipy.integrate.solve_ivp` does) and the national number of susceptibles per age group is evaluated at every week boundary from the solver's dense output.
+    New infections are the decrease of the susceptibles, the only outflow of 'S' in the models of this repository.
+
+    input
+    -----
+    model: pySODM.models.base.ODE
+        Model with a state 'S' of dimensions ['age', 'location'], f.i. `models.spatial_ODE_SIR`.
+
+    observation: WeeklyObservation
+        Observation operator (reset before use).
+
+    time: int/float, list of int/float or list of str/datetime or None
+        Start and stop of the simulation, as in pySODM's `sim()`. Default: from time 0 to the end of the last week.
+
+    method, rtol:
+        Integrator of `scipy.integrate.solve_ivp` and its relative tolerance (defaults of pySODM's `sim()`).
+
+    output
+    ------
+    incidence: np.ndarray
+        Weekly number of new infections (`observation.incidence`). Shape (n_weeks, n_age).
+    """
+    if time is None:
+        time = [0, max(np.ceil(observation.boundaries[-1]), 1)]
+    (t0, t1), actual_start_date = validate_simulation_time(time)
+    # week boundaries on the model's time axis
+    boundaries = observation.boundaries
+    if actual_start_date is not None:
+        boundaries = boundaries - (pd.Timestamp(actual_start_date) - observation.start_date) / pd.Timedelta(days=1)
+
+    # flatten the states (in the order of pySODM's `_create_fun`)
+    fun = model._create_fun(actual_start_date)
+    y0 = np.concatenate([np.ravel(model.initial_states[k]) for k in model.state_shapes])
+    offset = 0
+    for k, shape in model.state_shapes.items():
+        if k == 'S':
+            S_slice, S_shape = slice(offset, offset + int(np.prod(shape))), shape
+        offset += int(np.prod(shape))
+    national_S = lambda y: np.reshape(y[S_slice], S_shape).sum(axis=-1)
+
+    # step the solver, record the susceptibles at every week boundary passed
+    S_boundaries = np.empty((len(boundaries), S_shape[0]))
+    inside = np.flatnonzero((boundaries >= t0) & (boundaries <= t1))
+    S_boundaries[boundaries < t0] = national_S(y0)
+    params = model.parameters
+    # implicit solvers of models with an analytical Jacobian receive it (see `solvers.JacobianODE`)
+    solver = (model.jacobian_solver(method) if hasattr(model, 'jacobian_solver') else None) or methods[method]
+    solver = solver(lambda t, y: fun(t, y, params), t0, y0, t1, rtol=rtol)
+    k = 0
+    while k < len(inside) and boundaries[inside[k]] <= t0:
+        S_boundaries[inside[k]] = national_S(y0)
+        k += 1
+    while solver.status == 'running' and k < len(inside):
+        message = solver.step()
+        if solver.status == 'failed':
+            raise RuntimeError(f"integration failed: {message}")
+        if boundaries[inside[k]] <= solver.t:
+            dense = solver.dense_output()
+            while k < len(inside) and boundaries[inside[k]] <= solver.t:
+                S_boundaries[inside[k]] = national_S(dense(boundaries[inside[k]]))
+                k += 1
+    # weeks ending after the end of the simulation are truncated
+    S_boundaries[boundaries > t1] = national_S(solver.y)
+
+    observation.incidence[...] = -np.diff(S_boundaries, axis=0)
+    return observation.incidence
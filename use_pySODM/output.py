@@ -0,0 +1,387 @@
+"""
+This script contains an output sink streaming the states of the age-stratified spatially-explicit SIR models to chunked, compressed HDF5 storage, time block by time block, instead of keeping the full trajectory in memory.
+"""
+
+__author__      = "Tijs Alleman"
+__copyright__   = "Copyright (c) 2024 by T.W. Alleman, IDD Group, Johns Hopkins Bloomberg School of Public Health. All Rights Reserved."
+
+import h5py
+import numpy as np
+import pandas as pd
+import xarray as xr
+from datetime import timedelta
+from pySODM.models.base import ODE
+from pySODM.models.validation import validate_simulation_time
+from geography import get_geography
+from engines import fixed_step_methods
+from observation import methods
+
+dimensions = ['age', 'location']
+spatial_levels = ['arrondissement', 'province', 'region']
+
+##################
+## Aggregations ##
+##################
+
+def aggregate_states(X, dims):
+    """
+    Sums states of shape (..., n_age, n_loc) over the dimensions not in `dims`.
+
+    input
+    -----
+    X: np.ndarray
+        States. Shape (..., n_age, n_loc).
+
+    dims: tuple of str
+        Dimensions retained: 'age' and at most one of 'location', 'arrondissement', 'province' or 'region'. An empty tuple gives national totals.
+
+    output
+    ------
+    X: np.ndarray
+        Aggregated states. Shape (..., [n_age,] [n_units]).
+    """
+    spatial = [d for d in dims if d != 'age']
+    if len(spatial) > 1 or any(d not in ['location',] + spatial_levels for d in spatial):
+        raise ValueError(
+            f"invalid aggregation dimensions {dims}. retain 'age' and at most one of {['location',] + spatial_levels}"
+        )
+    if not spatial:
+        X = X.sum(axis=-1)
+    elif spatial[0] != 'location':
+        X = get_geography().aggregate(X, spatial[0], axis=-1)
+    if 'age' not in dims:
+        X = X.sum(axis=-2 if spatial else -1)
+    return X
+
+def _aggregation_coordinates(coordinates, dims):
+    return {d: coordinates[d] if d in coordinates else get_geography().units[d] for d in dims}
+
+##########
+## Sink ##
+##########
+
+class OutputSink:
+    """
+    Streams the states of a model to a chunked, compressed HDF5 file.
+
+    Every state is stored in dataset '/states/<name>' of dimensions ([draw,] time, age, location), chunked per `time_chunk` timesteps (and per draw).
+    Aggregations of the states (f.i. national totals per age group, or totals per region) are stored in datasets '/aggregations/<name>'.
+    Only `time_chunk` timesteps are kept in memory. Read the results back, or slices of them, with `read_output`.
+
+    input
+    -----
+    path: str
+        Path of the HDF5 file (overwritten).
+
+    coordinates: dict
+        Model coordinates, with keys 'age' and 'location'.
+
+    states: list of str
+        Names of the states, in the order they are passed to `append`/`write_draw`. Default: ['S', 'I', 'R'].
+
+    aggregations: dict or None
+        Aggregations to store, {name: (state, dims)}, f.i. {'I_region': ('I', ('region',)), 'S_age': ('S', ('age',))}. See `aggregate_states` for valid `dims`.
+
+    store_states: bool or list of str
+        Store the full states (True), none of them (False, reduced mode: only the aggregations) or a selection. Default: True.
+
+    n_draws: int or None
+        Number of realisations of an ensemble (see `write_draw`). Default: None (a single simulation, see `append`).
+
+    start_date: datetime or None
+        Date corresponding to time 0, if the simulation time was given as dates.
+
+    time_chunk: int
+        Number of timesteps per chunk. Default: 32.
+
+    compression: str or None
+        HDF5 compression filter. Default: 'gzip' (level 4).
+    """
+
+    def __init__(self, path, coordinates, states=['S', 'I', 'R'], aggregations=None, store_states=True,
+                    n_draws=None, start_date=None, time_chunk=32, compression='gzip', compression_opts=4):
+        self.path = path
+        self.coordinates = {d: coordinates[d] for d in dimensions}
+        self.states = list(states)
+        self.aggregations = dict(aggregations or {})
+        self.stored_states = self.states if store_states is True else (list(store_states) if store_states else [])
+        self.n_draws = n_draws
+        self.time_chunk = time_chunk
+        self.shape = tuple(len(coordinates[d]) for d in dimensions)
+        for state, dims in self.aggregations.values():
+            if state not in self.states:
+                raise ValueError(
+                    f"aggregated state '{state}' is not one of the states {self.states}"
+                )
+        # datasets
+        self.file = h5py.File(path, 'w')
+        if start_date is not None:
+            self.file.attrs['start_date'] = pd.Timestamp(start_date).isoformat()
+        self.file.create_dataset('coordinates/time', shape=(0,), maxshape=(None,), dtype=np.float64, chunks=(max(time_chunk, 1),))
+        self.datasets = {}
+        leading = (n_draws,) if n_draws else ()
+        for name, (dims, coords) in self._layout().items():
+            shape = tuple(len(c) for c in coords.values())
+            dset = self.file.create_dataset(name, shape=leading + (0,) + shape, maxshape=leading + (None,) + shape, dtype=np.float64,
+                                            chunks=(1,)*len(leading) + (time_chunk,) + shape, compression=compression,
+                                            compression_opts=compression_opts if compression == 'gzip' else None, shuffle=compression is not None)
+            dset.attrs['dims'] = (['draw'] if n_draws else []) + ['time',] + list(dims)
+            for d, c in coords.items():
+                if f'coordinates/{d}' not in self.file:
+                    c = np.asarray(c)
+                    self.file.create_dataset(f'coordinates/{d}', data=c.astype(object) if c.dtype.kind == 'U' else c, dtype=h5py.string_dtype() if c.dtype.kind == 'U' else None)
+            self.datasets[name] = dset
+        if n_draws:
+            self.file.create_dataset('coordinates/draw', data=np.arange(n_draws))
+        # buffer of timesteps not yet written
+        self._t, self._y = [], []
+        self._n_written = 0
+
+    def _layout(self):
+        """ Returns the dimensions and coordinates of every dataset
+        """
+        layout = {f'states/{X}': (dimensions, self.coordinates) for X in self.stored_states}
+        for name, (state, dims) in self.aggregations.items():
+            layout[f'aggregations/{name}'] = (tuple(dims), _aggregation_coordinates(self.coordinates, dims))
+        return layout
+
+    def _reduce(self, Y):
+        """ Splits stacked states of shape (n_time, n_states, n_age, n_loc) into the arrays of every dataset
+        """
+        out = {f'states/{X}': Y[:, self.states.index(X)] for X in self.stored_states}
+        for name, (state, dims) in self.aggregations.items():
+            out[f'aggregations/{name}'] = aggregate_states(Y[:, self.states.index(state)], dims)
+        return out
+
+    def append(self, t, y):
+        """ Appends one timestep `t` of stacked states `y` (shape (n_states, n_age, n_loc)), written to disk per `time_chunk` timesteps
+        """
+        self._t.append(t)
+        self._y.append(np.array(y, np.float64))
+        if len(self._t) >= self.time_chunk:
+            self.flush()
+
+    def append_block(self, t, Y):
+        """ Appends the timesteps `t` (shape (n_time,)) of stacked states `Y` (shape (n_time, n_states, n_age, n_loc))
+        """
+        self.flush()
+        self._write_time(t)
+        n = self._n_written
+        for name, X in self._reduce(np.asarray(Y, np.float64)).items():
+            self.datasets[name].resize(n + len(t), axis=0)
+            self.datasets[name][n:] = X
+        self._n_written = n + len(t)
+
+    def flush(self):
+        """ Writes the buffered timesteps to disk
+        """
+        if self._t:
+            t, Y = self._t, np.stack(self._y)
+            self._t, self._y = [], []
+            self.append_block(t, Y)
+
+    def write_draw(self, draw, t, Y):
+        """ Writes realisation `draw` of an ensemble: timesteps `t` (shape (n_time,)) of stacked states `Y` (shape (n_time, n_states, n_age, n_loc))
+        """
+        time = self.file['coordinates/time']
+        if time.shape[0] == 0:
+            self._write_time(t)
+            for dset in self.datasets.values():
+                dset.resize(len(t), axis=1)
+        elif time.shape[0] != len(t):
+            raise ValueError(
+                f"realisation {draw} has {len(t)} timesteps, previous realisations have {time.shape[0]}"
+            )
+        for name, X in self._reduce(np.asarray(Y, np.float64)).items():
+            self.datasets[name][draw] = X
+
+    def _write_time(self, t):
+        time = self.file['coordinates/time']
+        n = time.shape[0]
+        time.resize(n + len(t), axis=0)
+        time[n:] = t
+
+    def close(self):
+        """ Flushes the buffer and closes the file
+        """
+        if self.file:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+################
+## Simulation ##
+################
+
+def simulate_to_sink(model, time, sink, block_length=28, **sim_kwargs):
+    """
+    Simulates a pySODM model and streams its output timesteps to `sink`, so the full trajectory is never held in memory.
+
+    ODE models integrated with a scipy solver (the default) are stepped by a single solver instance, as `scipy.integrate.solve_ivp` does, and the output equals that of `model.sim()`.
+    Other models are simulated in blocks of `block_length` days, every block restarting from the last state of the previous block:
+
+        - fixed-step methods ('rk4', 'euler'): the output equals that of `model.sim()` if `block_length` is a multiple of `dt`,
+        - stochastic models: pySODM reseeds its solver at the start of every `sim()`, so the realisation (not its distribution) depends on `block_length`.
+
+    The model's initial states are restored afterwards.
+
+    input
+    -----
+    model: pySODM.models.base.ODE or JumpProcess
+        Model with states of dimensions ['age', 'location'].
+
+    time: int/float, list of int/float or list of str/datetime
+        Start and stop of the simulation, as in pySODM's `sim()`.
+
+    sink: OutputSink
+        Output sink, with `sink.states` a subset of the model's states.
+
+    block_length: int/float
+        Length of a block (models simulated in blocks only). Must be a positive multiple of `output_timestep` (and of `dt` for the fixed-step methods).
+
+    sim_kwargs:
+        Passed on to `model.sim()`, f.i. `method`, `rtol` or `output_timestep`.
+
+    output
+    ------
+    sink: OutputSink
+        The output sink (not closed).
+    """
+    if isinstance(model, ODE) and not sim_kwargs.get('tau') and sim_kwargs.get('method', 'RK45') not in fixed_step_methods:
+        return _stream_ode(model, time, sink, **sim_kwargs)
+
+    # blocks must end on output timesteps (and integration steps)
+    for name, step in [('output_timestep', sim_kwargs.get('output_timestep', 1)), ('dt', sim_kwargs.get('dt'))]:
+        if step is not None and (block_length <= 0 or not np.isclose(round(block_length / step) * step, block_length)):
+            raise ValueError(
+                f"'block_length' ({block_length}) must be a positive multiple of '{name}' ({step})"
+            )
+    (t0, t1), actual_start_date = validate_simulation_time(time)
+    initial_states = {k: np.array(v) for k, v in model.initial_states.items()}
+    t = t0
+    try:
+        while t < t1:
+            t_end = min(t + block_length, t1)
+            if actual_start_date is not None:
+                out = model.sim([actual_start_date + timedelta(days=t), actual_start_date + timedelta(days=t_end)], **sim_kwargs)
+                t_out = t + (out['date'].values - out['date'].values[0]) / np.timedelta64(1, 'D')
+            else:
+                out = model.sim([t, t_end], **sim_kwargs)
+                t_out = out['time'].values
+            # the first timestep of a block is the last of the previous block
+            first = 0 if t == t0 else 1
+            sink.append_block(t_out[first:], np.stack([out[X].values[first:] for X in sink.states], axis=1))
+            model.initial_states.update({k: out[k].values[-1] for k in model.initial_states})
+            t = t_end
+    finally:
+        model.initial_states.update(initial_states)
+    return sink
+
+def _stream_ode(model, time, sink, method='RK45', rtol=1e-4, output_timestep=1):
+    """
+    Steps one scipy solver over the simulation time and appends the states at every output timestep to `sink`, evaluated from the solver's dense output (as `solve_ivp` does with `t_eval`).
+    Implicit solvers of models with an analytical Jacobian receive it (see `solvers.JacobianODE`).
+    """
+    (t0, t1), actual_start_date = validate_simulation_time(time)
+    t_eval = np.arange(start=t0, stop=t1 + output_timestep, step=output_timestep)
+    names = list(model.state_shapes.keys())
+    shape = (len(names),) + tuple(model.state_shapes[names[0]])
+    index = [names.index(X) for X in sink.states]
+
+    # solver on the flattened states (in the order of pySODM's `_create_fun`)
+    fun = model._create_fun(actual_start_date)
+    params = model.parameters
+    y0 = np.concatenate([np.ravel(model.initial_states[k]) for k in names]).astype(np.float64)
+    solver = (model.jacobian_solver(method) if hasattr(model, 'jacobian_solver') else None) or methods[method]
+    solver = solver(lambda t, y: fun(t, y, params), t0, y0, t1, rtol=rtol)
+
+    # step, append the output timesteps passed
+    i = 0
+    while i < len(t_eval):
+        if solver.status == 'running':
+            message = solver.step()
+            if solver.status == 'failed':
+                raise RuntimeError(f"integration failed: {message}")
+        i_new = np.searchsorted(t_eval, solver.t, side='right') if solver.status == 'running' else len(t_eval)
+        if i_new > i:
+            Y = solver.dense_output()(t_eval[i:i_new])
+            for k in range(i_new - i):
+                sink.append(t_eval[i + k], Y[:, k].reshape(shape)[index])
+            i = i_new
+    return sink
+
+#############
+## Reading ##
+#############
+
+def _labels_to_index(coordinate, labels):
+    """ Converts coordinate labels (or a slice of labels) into positions along a dimension
+    """
+    if isinstance(labels, slice):
+        idx = np.flatnonzero((coordinate >= (labels.start if labels.start is not None else coordinate.min())) & (coordinate <= (labels.stop if labels.stop is not None else coordinate.max())))
+        return slice(idx[0], idx[-1] + 1) if len(idx) else slice(0, 0)
+    labels = np.atleast_1d(labels)
+    lookup = {x: i for i, x in enumerate(coordinate.tolist())}
+    try:
+        return np.array([lookup[x] for x in labels.tolist()], np.int64)
+    except KeyError as e:
+        raise ValueError(
+            f"coordinate {e} not found"
+        )
+
+def read_output(path, name, **selection):
+    """
+    Reads (a slice of) a dataset written by `OutputSink`, only the bounding box of the selection is read from disk.
+
+    input
+    -----
+    path: str
+        Path of the HDF5 file.
+
+    name: str
+        Name of a state (f.i. 'I') or of an aggregation.
+
+    selection:
+        Labels to select along every dimension, f.i. `time=slice(0, 30)`, `location=[11001, 21004]` or `age='0-5'`. A single label keeps the dimension.
+        If the simulation was given dates, 'time' is selected in days since the start date.
+
+    output
+    ------
+    out: xarray.DataArray
+        Selected data. If the simulation was given dates, the time dimension is named 'date'.
+    """
+    with h5py.File(path, 'r') as f:
+        dset = f[f'states/{name}'] if f'states/{name}' in f else f[f'aggregations/{name}']
+        dims = [d.decode() if isinstance(d, bytes) else d for d in dset.attrs['dims']]
+        coords = {}
+        box, pick = [], []
+        for d in dims:
+            c = f[f'coordinates/{d}']
+            c = np.array(c.asstr()[...], dtype=str) if h5py.check_string_dtype(c.dtype) else c[...]
+            if d in selection:
+                idx = _labels_to_index(c, selection[d])
+            else:
+                idx = slice(None)
+            if isinstance(idx, slice):
+                box.append(idx)
+                pick.append(slice(None))
+                coords[d] = c[idx]
+            else:
+                box.append(slice(idx.min(), idx.max() + 1) if len(idx) else slice(0, 0))
+                pick.append(idx - idx.min() if len(idx) else idx)
+                coords[d] = c[idx]
+        data = dset[tuple(box)]
+        for axis, p in enumerate(pick):
+            if not isinstance(p, slice):
+                data = np.take(data, p, axis=axis)
+        start_date = f.attrs.get('start_date', None)
+    if start_date is not None:
+        dims = ['date' if d == 'time' else d for d in dims]
+        coords['date'] = pd.Timestamp(start_date) + pd.to_timedelta(coords.pop('time'), unit='D')
+    return xr.DataArray(data, dims=dims, coords=coords)
@@ -0,0 +1,253 @@
+"""
+This script contains an opt-in instrumentation of the age-stratified spatially-explicit SIR models: it records the number and duration of the calls to the right-hand side (rates),
+the duration of the stages of the force of infection, the memory allocated per call and the statistics of the solver steps, and reports them as JSON and as a human-readable summary.
+
+Instrumentation is attached to a model for the duration of a `with` block only: outside of it, the models run their original code and pay no overhead.
+
+usage:
+    profiler = Profiler(memory=True)
+    with profiler.instrument(model):
+        out = model.sim(120)
+    print(profiler.summary())
+    profiler.save('profile.json')
+"""
+
+__author__      = "Tijs Alleman"
+__copyright__   = "Copyright (c) 2024 by T.W. Alleman, IDD Group, Johns Hopkins Bloomberg School of Public Health. All Rights Reserved."
+
+import json
+import time
+import numpy as np
+import tracemalloc
+from contextlib import contextmanager
+from scipy.sparse import issparse
+
+import models
+import observation
+import pySODM.models.base as base
+from kernels import ForceOfInfection
+
+# methods of the models (pySODM models and dedicated engines) that are timed, if the model has them
+hot_paths = ['integrate', 'jacobian', 'compute_rates', 'apply_transitionings', '_transitioning_probabilities', '_apply_transitionings', '_leap']
+# stages of the force of infection (see `kernels.ForceOfInfection`)
+stages = ['_prevalence', '_contract_age', '_contract_space', '_mix']
+# scipy solvers by name (before instrumentation)
+solvers = dict(observation.methods)
+
+#############
+## Records ##
+#############
+
+class CallRecord:
+    """ Number of calls, total/minimum/maximum duration (s) and bytes allocated (peak traced memory above the memory at the start of the call) of a function
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.min = np.inf
+        self.max = 0.0
+        self.bytes = 0
+
+    def add(self, dt, nbytes=0):
+        self.calls += 1
+        self.total += dt
+        self.min = min(self.min, dt)
+        self.max = max(self.max, dt)
+        self.bytes += nbytes
+
+    def to_dict(self, wall_time):
+        calls = max(self.calls, 1)
+        return {'calls': self.calls, 'total_s': self.total, 'mean_us': self.total / calls * 1e6, 'min_us': self.min * 1e6 if self.calls else None,
+                'max_us': self.max * 1e6, 'share_of_wall_time': self.total / wall_time if wall_time else None, 'bytes_per_call': self.bytes / calls}
+
+class ProfiledForceOfInfection(ForceOfInfection):
+    """ Force of infection timing every stage of its computation, sharing the buffers of the instance it replaces
+    """
+
+    def __init__(self, profiler, foi):
+        self._buffers = foi._buffers
+        self._profiler = profiler
+        for name in stages:
+            setattr(self, name, profiler._timed(name, getattr(foi, name), records=profiler.stages))
+
+def counting_solver(profiler, solver):
+    """ Returns a subclass of a scipy `OdeSolver` recording the size of its (accepted) steps and, once it finishes, its number of steps, function evaluations, Jacobian evaluations and LU decompositions
+    """
+    if getattr(solver, 'counting', False):
+        return solver
+    class CountingSolver(solver):
+        counting = True
+        def step(self):
+            message = super().step()
+            if self.t_old is not None:
+                profiler.steps.append(self.t - self.t_old)
+                self.n_steps = getattr(self, 'n_steps', 0) + 1
+            if self.status != 'running':
+                profiler.solves.append({'method': solver.__name__, 'status': self.status, 'steps': getattr(self, 'n_steps', 0),
+                                        'nfev': int(self.nfev), 'njev': int(self.njev), 'nlu': int(self.nlu)})
+            return message
+    CountingSolver.__name__ = solver.__name__
+    return CountingSolver
+
+##############
+## Profiler ##
+##############
+
+class Profiler:
+    """
+    Collects the hot-path statistics of models simulated inside `instrument` blocks (cumulative over blocks).
+
+    input
+    -----
+    memory: bool
+        Trace the memory allocated per call of the right-hand side (rates) with `tracemalloc`. Slows down the simulation. Default: False.
+    """
+
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.calls = {}
+        self.stages = {}
+        self.steps = []
+        self.solves = []
+        self.wall_time = 0.0
+        self.models = []
+        self._depth = 0
+
+    def _timed(self, name, fn, records=None, memory=False):
+        """ Wraps `fn`, recording its duration (and allocated memory) under `name`
+        """
+        record = (self.calls if records is None else records).setdefault(name, CallRecord())
+        if not memory:
+            def wrapper(*args, **kwargs):
+                tic = time.perf_counter()
+                out = fn(*args, **kwargs)
+                record.add(time.perf_counter() - tic)
+                return out
+            return wrapper
+        def wrapper(*args, **kwargs):
+            # only the outermost timed call traces memory (resetting the peak inside a call would hide the allocations preceding it)
+            outermost = self._depth == 0
+            if outermost:
+                tracemalloc.reset_peak()
+                start = tracemalloc.get_traced_memory()[0]
+            self._depth += 1
+            tic = time.perf_counter()
+            try:
+                out = fn(*args, **kwargs)
+            finally:
+                self._depth -= 1
+            dt = time.perf_counter() - tic
+            record.add(dt, tracemalloc.get_traced_memory()[1] - start if outermost else 0)
+            return out
+        return wrapper
+
+    def _solve_ivp(self, fun, t_span, y0, method='RK45', **kwargs):
+        """ `scipy.integrate.solve_ivp` with a solver recording its steps (see `counting_solver`)
+        """
+        solver = solvers[method] if isinstance(method, str) else method
+        return self._solve_ivp_original(fun, t_span, y0, method=counting_solver(self, solver), **kwargs)
+
+    @contextmanager
+    def instrument(self, model):
+        """
+        Instruments a model (pySODM model or dedicated engine, see `engines.py`) for the duration of the `with` block, and restores it afterwards.
+
+        Times the model's right-hand side ('integrate') or rates ('compute_rates', 'apply_transitionings'; or the leaps of the dedicated engines), the stages of the shared force of infection,
+        and counts the steps of the scipy solvers used by `model.sim()` and `observation.simulate_weekly_ILI()`.
+        """
+        patched, missing = [], object()
+        def patch(owner, name, value):
+            patched.append((owner, name, vars(owner).get(name, missing)))
+            setattr(owner, name, value)
+
+        # hot paths of the model (instance attributes shadow the class' methods)
+        for name in hot_paths:
+            if hasattr(model, name):
+                patch(model, name, self._timed(name, getattr(model, name), memory=self.memory))
+        # stages of the force of infection: the models' shared instance and the engines' own instance
+        patch(models, 'compute_force_of_infection', ProfiledForceOfInfection(self, models.compute_force_of_infection))
+        if isinstance(getattr(model, '_foi', None), ForceOfInfection):
+            patch(model, '_foi', ProfiledForceOfInfection(self, model._foi))
+        # solvers
+        self._solve_ivp_original = base.solve_ivp
+        patch(base, 'solve_ivp', self._solve_ivp)
+        patch(observation, 'methods', {k: counting_solver(self, v) for k, v in solvers.items()})
+        if hasattr(model, 'jacobian_solver'):
+            def jacobian_solver(method, original=model.jacobian_solver):
+                solver = original(method)
+                return solver and counting_solver(self, solver)
+            patch(model, 'jacobian_solver', jacobian_solver)
+
+        tracing = self.memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        self.models.append(describe(model))
+        tic = time.perf_counter()
+        try:
+            yield self
+        finally:
+            self.wall_time += time.perf_counter() - tic
+            if tracing:
+                tracemalloc.stop()
+            for owner, name, original in reversed(patched):
+                if original is missing:
+                    delattr(owner, name)
+                else:
+                    setattr(owner, name, original)
+
+    ############
+    ## Report ##
+    ############
+
+    def report(self):
+        """
+        Returns the collected statistics.
+
+        output
+        ------
+        report: dict
+            Keys: 'models' (class, state shapes and mobility matrix of the instrumented models), 'wall_time_s' (inside the `instrument` blocks),
+            'calls' and 'stages' (per function: number of calls, total duration, mean/min/max duration per call, share of the wall time, bytes allocated per call),
+            'solver' (number of solves, accepted steps, minimum/mean/maximum step size, function and Jacobian evaluations, LU decompositions, and every solve).
+        """
+        steps = np.asarray(self.steps)
+        solver = {'solves': len(self.solves), 'steps': len(steps),
+                  'min_step': float(steps.min()) if len(steps) else None, 'mean_step': float(steps.mean()) if len(steps) else None, 'max_step': float(steps.max()) if len(steps) else None,
+                  **{k: sum(s[k] for s in self.solves) for k in ['nfev', 'njev', 'nlu']}, 'runs': self.solves}
+        return {'models': self.models, 'wall_time_s': self.wall_time,
+                'calls': {k: v.to_dict(self.wall_time) for k, v in self.calls.items() if v.calls},
+                'stages': {k.strip('_'): v.to_dict(self.wall_time) for k, v in self.stages.items() if v.calls},
+                'solver': solver}
+
+    def summary(self):
+        """ Returns the report as a human-readable table
+        """
+        report = self.report()
+        lines = [f"wall time: {report['wall_time_s']:.4g} s ({', '.join(m['class'] for m in report['models'])})",
+                 f"{'':<40}{'calls':>10}{'total (s)':>12}{'mean (us)':>12}{'min (us)':>12}{'max (us)':>12}{'wall (%)':>10}{'kB/call':>10}"]
+        for section in ['calls', 'stages']:
+            for name, r in report[section].items():
+                label = name if section == 'calls' else f"  force of infection: {name}"
+                lines.append(f"{label:<40}{r['calls']:>10}{r['total_s']:>12.4g}{r['mean_us']:>12.4g}{r['min_us']:>12.4g}{r['max_us']:>12.4g}"
+                             f"{100 * (r['share_of_wall_time'] or 0):>10.1f}{r['bytes_per_call'] / 1e3:>10.4g}")
+        s = report['solver']
+        if s['steps']:
+            lines.append(f"solver: {s['solves']} solve(s), {s['steps']} steps (size {s['min_step']:.3g} - {s['max_step']:.3g}, mean {s['mean_step']:.3g}), "
+                         f"{s['nfev']} function evaluations, {s['njev']} Jacobian evaluations, {s['nlu']} LU decompositions")
+        return '\n'.join(lines)
+
+    def save(self, path):
+        """ Writes the report to a JSON file
+        """
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=1)
+        return path
+
+def describe(model):
+    """ Returns the class, state shapes and mobility matrix (shape, density) of a model
+    """
+    M = getattr(model, 'parameters', {}).get('M')
+    shapes = getattr(model, 'state_shapes', None) or {'states': getattr(model, 'shape', None)}
+    return {'class': type(model).__name__, 'state_shapes': {k: list(v) for k, v in shapes.items() if v is not None},
+            'M': None if M is None else {'shape': list(np.shape(M)), 'sparse': issparse(M), 'nnz': int(M.nnz) if issparse(M) else int(np.count_nonzero(M))}}
@@ -0,0 +1,140 @@
+"""
+This script contains a parallel, in-memory rendering pipeline for animations of the age-stratified spatially-explicit SIR models on a (rasterized) Belgian map
+"""
+
+__author__      = "Tijs Alleman"
+__copyright__   = "Copyright (c) 2024 by T.W. Alleman, IDD Group, Johns Hopkins Bloomberg School of Public Health. All Rights Reserved."
+
+import numpy as np
+from PIL import Image
+from multiprocessing import get_context
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+# colours of the national totals
+colours = {'S': 'green', 'I': 'red', 'R': 'black'}
+
+############
+## Frames ##
+############
+
+# every worker inherits the inputs from the parent process and draws the static part of the figure once, frames only redraw the artists that change
+_worker = {}
+
+def _init_worker(raster, values, totals, time, title, dpi, plot_kwargs):
+    """ Draws the figure shared by all frames: the map (coloured by the first timestep), the municipality borders and empty curves of the national totals
+    """
+    fig = Figure(figsize=(8.3/2,11.7/3), dpi=dpi)
+    FigureCanvasAgg(fig)
+    ax = fig.subplots(nrows=2, height_ratios=[3, 1])
+
+    # make map: pixels outside Belgium have location index -1, which picks the trailing NaN (transparent) of every row of `values`
+    kwargs = dict(plot_kwargs)
+    linewidth, edgecolor = kwargs.pop('linewidth', 0.5), kwargs.pop('edgecolor', 'black')
+    image = ax[0].imshow(values[0][raster['index']], extent=raster['extent'], interpolation='nearest', **kwargs)
+    borders, = ax[0].plot(raster['outline'][:, 0], raster['outline'][:, 1], color=edgecolor, linewidth=linewidth)
+    ax[0].set_title(title.format(t=time[0]))
+    ax[0].set_aspect(raster['aspect'])
+    ax[0].set_axis_off()
+
+    # plot the normalised states
+    lines = {X: ax[1].plot([], [], color=colours.get(X), label=X)[0] for X in totals}
+    ax[1].set_xlim([time[0], time[-1]])
+    ax[1].set_ylim([0,100])
+    ax[1].set_xlabel('time (days)', fontsize=8)
+    ax[1].set_ylabel('population (%)', fontsize=8)
+    ax[1].spines['top'].set_visible(False)
+    ax[1].spines['right'].set_visible(False)
+    legend = ax[1].legend(loc=1, framealpha=1, prop={'size': 8})
+    ax[1].tick_params(axis='both', which='major', labelsize=8)
+    fig.tight_layout()
+
+    # draw everything but the animated artists (in drawing order) and keep it as the background of every frame
+    animated = [image, borders, ax[0].title, *lines.values(), legend]
+    for artist in animated:
+        artist.set_animated(True)
+    fig.canvas.draw()
+
+    _worker.update({'fig': fig, 'background': fig.canvas.copy_from_bbox(fig.bbox), 'animated': animated,
+                    'map': image, 'title': ax[0].title, 'index': raster['index'], 'lines': lines,
+                    'values': values, 'totals': totals, 'time': time, 'format': title})
+
+def _render(k):
+    """ Renders the k-th frame, returns it as a palette image (quantized by the worker, so the parent process only writes the animation)
+    """
+    w = _worker
+    w['map'].set_data(w['values'][k][w['index']])
+    for X, line in w['lines'].items():
+        line.set_data(w['time'][:k+1], w['totals'][X][:k+1])
+    w['title'].set_text(w['format'].format(t=w['time'][k]))
+    w['fig'].canvas.restore_region(w['background'])
+    for artist in w['animated']:
+        w['fig'].draw_artist(artist)
+    return Image.fromarray(np.asarray(w['fig'].canvas.buffer_rgba())[..., :3]).quantize(256, method=Image.Quantize.FASTOCTREE)
+
+###############
+## Animation ##
+###############
+
+def render_animation(path, raster, X_location, totals, time, population=None, title='SIR model with commuter mobility\nt = {t:g} days',
+                        processes=None, dpi=150, duration=100, plot_kwargs={'cmap': 'OrRd', 'linewidth': 0.5, 'edgecolor': 'black', 'vmin': 0, 'vmax': 5}):
+    """
+    Renders an animation of a model state on a Belgian map (log10 scale) above the national totals, and encodes it from memory (no frames are written to disk).
+
+    input
+    -----
+    path: str
+        Path of the animation, f.i. 'simulation.gif'.
+
+    raster: dict
+        Rasterized municipalities, in the order of the model's 'location' coordinate (see `utils.load_municipality_raster`).
+
+    X_location: np.ndarray or xarray.DataArray
+        Model state per municipality, f.i. `output.read_output(path, 'I_location')`. Shape (n_time, n_loc).
+
+    totals: dict
+        National totals per state, f.i. {'S': S_total, 'I': I_total, 'R': R_total}. Shape (n_time,).
+
+    time: np.ndarray
+        Simulated timesteps. Shape (n_time,).
+
+    population: float or None
+        Total population, the totals are plotted as a percentage of it. Default: S + I + R at the first timestep.
+
+    title: str
+        Title of the map, formatted with the timestep `t`.
+
+    processes: int or None
+        Number of worker processes rendering frames. If None, frames are rendered in the current process.
+
+    dpi: int
+        Resolution of the frames.
+
+    duration: int
+        Duration of a frame, in milliseconds.
+
+    plot_kwargs: dict
+        Colour map ('cmap', 'vmin', 'vmax', see `matplotlib.pyplot.imshow`), width ('linewidth') and colour ('edgecolor') of the borders.
+    """
+
+    # precompute the (log) state per municipality, followed by a NaN for the pixels outside Belgium, and the normalised totals once
+    values = np.log10(np.asarray(X_location, np.float64) + 1e-9)
+    values = np.concatenate([values, np.full((len(values), 1), np.nan)], axis=1)
+    time = np.asarray(time)
+    totals = {X: np.asarray(v, np.float64) for X, v in totals.items()}
+    if population is None:
+        population = sum(v[0] for v in totals.values())
+    totals = {X: v / population * 100 for X, v in totals.items()}
+
+    initargs = (raster, values, totals, time, title, dpi, plot_kwargs)
+    if processes:
+        # frames are returned in order, the animation is written while the workers render the next frames
+        with get_context("fork").Pool(processes, initializer=_init_worker, initargs=initargs) as pool:
+            frames = pool.imap(_render, range(len(time)), chunksize=max(1, len(time) // (4 * processes)))
+            next(frames).save(path, save_all=True, append_images=frames, duration=duration, loop=0)
+    else:
+        _init_worker(*initargs)
+        frames = (_render(k) for k in range(len(time)))
+        next(frames).save(path, save_all=True, append_images=frames, duration=duration, loop=0)
+    _worker.clear()
+    return path
@@ -0,0 +1,107 @@
+"""
+This script reports the accuracy cost, speed and memory footprint of the float32 models (float32 storage, float64 accumulation) against their float64 counterparts, on the reference Aarlen seeding scenario
+"""
+
+__author__      = "Tijs Alleman"
+__copyright__   = "Copyright (c) 2024 by T.W. Alleman, IDD Group, Johns Hopkins Bloomberg School of Public Health. All Rights Reserved."
+
+import argparse
+import time
+import timeit
+import numpy as np
+import pandas as pd
+
+from utils import construct_initial_infected, \
+                    construct_coordinates_dictionary, \
+                        construct_initial_susceptible, \
+                            get_contact_matrix, get_mobility_matrix, broadcast_to_draws
+from models import spatial_ODE_SIR, spatial_ODE_SIR_float32, \
+                    spatial_ODE_SIR_ensemble, spatial_ODE_SIR_ensemble_float32, \
+                        spatial_TL_SIR, spatial_TL_SIR_float32
+from kernels import compute_force_of_infection
+from kernels_numba import force_of_infection_float32
+from cache import data_path
+
+############################
+## Command-line arguments ##
+############################
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-o", "--output", help="Path of the CSV report of the float32 models against their float64 counterparts", default=data_path('interim', 'report_precision.csv'))
+args = parser.parse_args()
+
+# number of draws of the ensembles and number of realisations of the stochastic models
+n_draws = 64
+n_realisations = 20
+
+#################
+## Setup model ##
+#################
+
+coordinates = construct_coordinates_dictionary()
+params = {'beta': 0.03, 'gamma': 5, 'f_v': 0.1, 'N': get_contact_matrix(), 'M': get_mobility_matrix(sparse=True)}
+# deterministic seeding so all runs are comparable
+I0 = construct_initial_infected(loc='Aarlen', n=1, agedist='uniform')
+S0 = construct_initial_susceptible(I0)
+init_states = {'S': S0, 'I': I0}
+# ensemble: spread of the infectivity
+ensemble_coordinates = construct_coordinates_dictionary(n_draws=n_draws)
+ensemble_params = {**params, 'beta': np.linspace(0.025, 0.035, n_draws), 'gamma': np.full(n_draws, 5.0), 'f_v': np.full(n_draws, 0.1)}
+ensemble_states = {'S': broadcast_to_draws(S0, n_draws), 'I': broadcast_to_draws(I0, n_draws)}
+
+##############
+## Simulate ##
+##############
+
+# (scenario, float64 model, float32 model, initial states, parameters, coordinates, sim() keyword arguments)
+scenarios = [
+    ('ODE (RK45)', spatial_ODE_SIR, spatial_ODE_SIR_float32, init_states, params, coordinates, {'method': 'RK45'}),
+    ('ODE (rk4, dt=1)', spatial_ODE_SIR, spatial_ODE_SIR_float32, init_states, params, coordinates, {'method': 'rk4', 'dt': 1.0}),
+    (f'ODE ensemble of {n_draws} (rk4, dt=1)', spatial_ODE_SIR_ensemble, spatial_ODE_SIR_ensemble_float32, ensemble_states, ensemble_params, ensemble_coordinates, {'method': 'rk4', 'dt': 1.0}),
+    (f'TL, mean of {n_realisations} (tau=1)', spatial_TL_SIR, spatial_TL_SIR_float32, init_states, params, coordinates, {'N': n_realisations, 'tau': 1}),
+]
+
+results = []
+for scenario, *classes, states, parameters, coords, kwargs in scenarios:
+    for model_class in classes:
+        model = model_class(states=states, parameters=parameters, coordinates=coords)
+        # the stochastic models draw from the global random state
+        np.random.seed(0)
+        tic = time.perf_counter()
+        out = model.sim(120, **kwargs)
+        elapsed = time.perf_counter() - tic
+        output_MB = sum(out[X].nbytes for X in out.data_vars) / 1e6
+        # average over the realisations/draws
+        out = out.mean(dim=[d for d in ['draws', 'draw'] if d in out.dims])
+        results.append({'scenario': scenario, 'model': model_class.__name__, 'precision': getattr(model_class, 'precision', 'float64'),
+                        'time_s': elapsed, 'output_MB': output_MB, 'out': out,
+                        'I': out['I'].sum(dim='age').values, 'R_end': out['R'].isel(time=-1).sum(dim='age').values})
+
+# time the force of infection (single run and ensemble, mid-epidemic states of the reference)
+S, I, R = [results[0]['out'][X].isel(time=60).values for X in ['S', 'I', 'R']]
+foi_time = lambda f: min(timeit.repeat(f, number=20, repeat=5))/20*1e6
+p = params
+foi = {'float64': foi_time(lambda: compute_force_of_infection(S, I, R, p['beta'], p['f_v'], p['N'], p['M'])),
+       'float32': foi_time(lambda: force_of_infection_float32(S, I, R, p['beta'], p['f_v'], p['N'], p['M']))}
+S_e, I_e, R_e = (broadcast_to_draws(X, n_draws) for X in (S, I, R))
+S_e32, I_e32, R_e32 = (X.astype(np.float32) for X in (S_e, I_e, R_e))
+foi_ensemble = {'float64': foi_time(lambda: compute_force_of_infection(S_e, I_e, R_e, ensemble_params['beta'], ensemble_params['f_v'], p['N'], p['M'])),
+                'float32': foi_time(lambda: force_of_infection_float32(S_e32, I_e32, R_e32, ensemble_params['beta'], ensemble_params['f_v'], p['N'], p['M']))}
+
+##########################
+## Compare to reference ##
+##########################
+
+for ref, r in zip(results[::2], results[1::2]):
+    for x in [ref, r]:
+        I_nat, I_nat_ref = x['I'].sum(axis=1), ref['I'].sum(axis=1)
+        x['peak_rel_error'] = abs(I_nat.max() - I_nat_ref.max()) / I_nat_ref.max()
+        x['peak_day_shift'] = int(np.argmax(I_nat) - np.argmax(I_nat_ref))
+        x['final_size_rel_error'] = abs(x['R_end'].sum() - ref['R_end'].sum()) / ref['R_end'].sum()
+        x['max_loc_final_size_rel_error'] = np.max(np.abs(x['R_end'] - ref['R_end']) / ref['R_end'])
+        x['max_loc_peak_day_shift'] = int(np.max(np.abs(np.argmax(x['I'], axis=0) - np.argmax(ref['I'], axis=0))))
+        x['foi_time_us'] = (foi_ensemble if 'ensemble' in x['model'] else foi)[x['precision']]
+
+report = pd.DataFrame(results).drop(columns=['out', 'I', 'R_end']).set_index(['scenario', 'precision'])
+print(report.to_string())
+report.to_csv(args.output)
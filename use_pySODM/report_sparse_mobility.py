@@ -0,0 +1,75 @@
+"""
+This script reports the accuracy cost and speed gain of pruning negligible flows from the sparse mobility matrix
+"""
+
+__author__      = "Tijs Alleman"
+__copyright__   = "Copyright (c) 2024 by T.W. Alleman, IDD Group, Johns Hopkins Bloomberg School of Public Health. All Rights Reserved."
+
+import argparse
+import timeit
+import numpy as np
+import pandas as pd
+
+from utils import construct_initial_infected, \
+                    construct_coordinates_dictionary, \
+                        construct_initial_susceptible, \
+                            get_contact_matrix, get_mobility_matrix
+from models import spatial_ODE_SIR as my_model
+from kernels import compute_force_of_infection
+from cache import data_path
+
+############################
+## Command-line arguments ##
+############################
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-o", "--output", help="Path of the CSV report of the accuracy cost and speed gain of pruning the mobility matrix", default=data_path('interim', 'report_sparse_mobility.csv'))
+args = parser.parse_args()
+
+# pruning thresholds (fraction of the inhabitants traveling from origin to destination)
+thresholds = [None, 1e-5, 1e-4, 1e-3, 1e-2]
+
+#################
+## Setup model ##
+#################
+
+coordinates = construct_coordinates_dictionary()
+params = {'beta': 0.03, 'gamma': 5, 'f_v': 0.1, 'N': get_contact_matrix()}
+# deterministic seeding so all runs are comparable
+I0 = construct_initial_infected(loc='Aarlen', n=1, agedist='uniform')
+S0 = construct_initial_susceptible(I0)
+init_states = {'S': S0, 'I': I0}
+
+##########################
+## Simulate every level ##
+##########################
+
+results = []
+for threshold in thresholds:
+    M = get_mobility_matrix(sparse=True, threshold=threshold)
+    params.update({'M': M})
+    model = my_model(states=init_states, parameters=params, coordinates=coordinates)
+    out = model.sim(120)
+    # time the force of infection
+    S, I, R = [out[X].isel(time=60).values for X in ['S', 'I', 'R']]
+    t_foi = min(timeit.repeat(lambda: compute_force_of_infection(S, I, R, params['beta'], params['f_v'], params['N'], M), number=100, repeat=5))/100
+    results.append({'threshold': threshold, 'nnz': M.nnz, 'density': M.nnz/np.prod(M.shape),
+                    'max_rowsum_error': np.max(np.abs(M.sum(axis=1) - 1)), 'foi_time_us': t_foi*1e6,
+                    'I': out['I'].sum(dim='age').values, 'R_end': out['R'].isel(time=-1).sum(dim='age').values})
+
+##########################
+## Compare to reference ##
+##########################
+
+ref = results[0]
+for r in results:
+    I_nat, I_nat_ref = r['I'].sum(axis=1), ref['I'].sum(axis=1)
+    r['peak_rel_error'] = abs(I_nat.max() - I_nat_ref.max()) / I_nat_ref.max()
+    r['peak_day_shift'] = int(np.argmax(I_nat) - np.argmax(I_nat_ref))
+    r['final_size_rel_error'] = abs(r['R_end'].sum() - ref['R_end'].sum()) / ref['R_end'].sum()
+    r['max_loc_final_size_rel_error'] = np.max(np.abs(r['R_end'] - ref['R_end']) / ref['R_end'])
+    r['max_loc_peak_day_shift'] = int(np.max(np.abs(np.argmax(r['I'], axis=0) - np.argmax(ref['I'], axis=0))))
+
+report = pd.DataFrame(results).drop(columns=['I', 'R_end']).set_index('threshold')
+print(report.to_string())
+report.to_csv(args.output)
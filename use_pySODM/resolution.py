@@ -0,0 +1,107 @@
+"""
+This script contains the multi-resolution layer of the age-stratified spatially-explicit SIR models: it collapses the model inputs of the 581 municipalities to the arrondissements, provinces or regions,
+conserving populations and travelers, and refines coarse states back to the municipalities (coarse-to-fine runs).
+"""
+
+__author__      = "Tijs Alleman"
+__copyright__   = "Copyright (c) 2024 by T.W. Alleman, IDD Group, Johns Hopkins Bloomberg School of Public Health. All Rights Reserved."
+
+import numpy as np
+from geography import get_geography
+
+# spatial resolutions, from fine to coarse
+levels = ['municipality', 'arrondissement', 'province', 'region']
+
+def validate_level(level):
+    if level not in levels:
+        raise ValueError(
+            f"invalid level '{level}'. valid levels are: {levels}"
+        )
+    return level
+
+def validate_locations(coordinates):
+    """ Checks the model's 'location' coordinate lists the municipalities in the order of the geography registry (see `utils.construct_coordinates_dictionary`)
+    """
+    if not np.array_equal(np.asarray(coordinates['location']), get_geography().NIS):
+        raise ValueError(
+            "the 'location' coordinate must list the NIS codes of the 581 municipalities in the order of `geography.get_geography().NIS`"
+        )
+
+############
+## Coarse ##
+############
+
+def coarsen(initial_states, parameters, coordinates, level):
+    """
+    Collapses the model inputs of the municipalities to the arrondissements, provinces or regions.
+
+    The initial states are summed over the units, so every unit holds the population of its municipalities. The mobility matrix 'M' is aggregated conserving the number of travelers,
+    weighted by the initial population (see `geography.Geography.aggregate_mobility`). All other parameters have no spatial dimension and are passed unchanged.
+
+    input
+    -----
+    initial_states: dict
+        Initial states per municipality, f.i. {'S': S0, 'I': I0}. Shape (n_age, n_loc) or (n_draw, n_age, n_loc).
+
+    parameters: dict
+        Model parameters, including the mobility matrix 'M' (dense or sparse). Shape (n_loc, n_loc).
+
+    coordinates: dict
+        Model coordinates, with the municipalities' NIS codes as 'location' (see `utils.construct_coordinates_dictionary`).
+
+    level: str
+        'municipality' (inputs are returned unchanged), 'arrondissement' (43 units), 'province' (11 units) or 'region' (3 units).
+
+    output
+    ------
+    initial_states, parameters, coordinates: dict
+        Model inputs at `level`. The 'location' coordinate lists the NIS codes of the arrondissements, or the names of the provinces or regions.
+    """
+    if validate_level(level) == 'municipality':
+        return initial_states, parameters, coordinates
+    validate_locations(coordinates)
+    geography = get_geography()
+
+    # population per municipality (first draw if batched)
+    population = sum(np.asarray(v, np.float64) for v in initial_states.values())
+    population = population.reshape(-1, *population.shape[-2:])[0].sum(axis=0)
+
+    initial_states = {k: geography.aggregate(v, level) for k, v in initial_states.items()}
+    parameters = dict(parameters, M=geography.aggregate_mobility(parameters['M'], population, level))
+    coordinates = dict(coordinates, location=list(geography.units[level]))
+    return initial_states, parameters, coordinates
+
+def coarse_model(model_class, initial_states, parameters, coordinates, level):
+    """ Initialises a model with the inputs of the municipalities collapsed to `level` (see `coarsen`)
+    """
+    initial_states, parameters, coordinates = coarsen(initial_states, parameters, coordinates, level)
+    return model_class(states=initial_states, parameters=parameters, coordinates=coordinates)
+
+############
+## Refine ##
+############
+
+def refine(states, level, population):
+    """
+    Distributes the states of a coarse model over the municipalities, in proportion to their number of inhabitants per age group, f.i. to continue a coarse simulation at municipality level.
+
+    input
+    -----
+    states: dict
+        States per unit, f.i. the last timestep of a coarse simulation {'S': S, 'I': I, 'R': R}. Shape (..., n_age, n_units).
+
+    level: str
+        Level of the coarse model.
+
+    population: np.ndarray
+        Number of inhabitants per age group and municipality, f.i. `utils.load_demography_2017()['population']`. Shape (n_age, n_loc).
+
+    output
+    ------
+    states: dict
+        States per municipality. Shape (..., n_age, n_loc). Summing them over the units returns `states`.
+    """
+    if validate_level(level) == 'municipality':
+        return states
+    geography = get_geography()
+    return {k: geography.disaggregate(np.asarray(v), level, population) for k, v in states.items()}
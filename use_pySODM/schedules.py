@@ -0,0 +1,210 @@
+"""
+This script contains a schedule of the contacts and mobility of the age-stratified spatially-explicit SIR models (f.i. school holidays, Christmas, weekends).
+
+Instead of time-dependent parameter functions rebuilding the contact matrix N or the mobility matrix M on every call of the right-hand side,
+the schedule is compiled once into a table of the distinct regimes (combinations of N, M and f_v) and an index of the regime of every day.
+Every regime stores its mobility operator pre-factorised as A = (1 - f_v) * Id + f_v * M, so that the force of infection reads l = beta * (N @ x) @ A^T (see `kernels.ForceOfInfection.scheduled`).
+A call of the right-hand side only looks up the regime of the current day.
+
+usage:
+    schedule = Schedule('2017-10-02', '2018-05-01', N=N, M=M, f_v=0.1)
+    schedule.add(school_holidays['2017-2018'], N=N_holidays)
+    schedule.add(weekdays=[5, 6], f_v=0.02)
+    model = spatial_ODE_SIR_scheduled(states=..., parameters={'beta': 0.03, 'gamma': 5, 'schedule': schedule}, coordinates=...)
+    out = model.sim(['2017-10-02', '2018-05-01'])
+"""
+
+__author__      = "Tijs Alleman"
+__copyright__   = "Copyright (c) 2024 by T.W. Alleman, IDD Group, Johns Hopkins Bloomberg School of Public Health. All Rights Reserved."
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import issparse, csr_array, eye_array
+
+# keys of a regime
+regime_keys = ['N', 'M', 'f_v']
+
+# school holidays in Belgium (first and last day, inclusive)
+school_holidays = {
+    '2017-2018': [('2017-10-30', '2017-11-05'),     # autumn
+                  ('2017-12-25', '2018-01-07'),     # Christmas
+                  ('2018-02-12', '2018-02-18'),     # carnival
+                  ('2018-04-02', '2018-04-15')],    # Easter
+}
+
+# Christmas and New Year's period (first and last day, inclusive)
+christmas_holidays = {
+    '2017-2018': [('2017-12-24', '2018-01-01')],
+}
+
+##############
+## Schedule ##
+##############
+
+class Schedule:
+    """
+    Schedule of the contact matrix, mobility matrix and fraction of contacts on the visited patch, compiled into a table of regimes and a day -> regime index.
+
+    input
+    -----
+    start_date: str or datetime
+        Date corresponding to time 0 of the simulation.
+
+    end_date: str or datetime
+        Last day of the schedule. Times past its end use the regime of the last day (times before 0 that of the first day).
+
+    N: np.ndarray
+        Default contact matrix. Shape (n_age, n_age).
+
+    M: np.ndarray or scipy.sparse array
+        Default origin-destination mobility matrix. Shape (n_loc, n_loc).
+
+    f_v: float
+        Default fraction of the total contacts made on the visited patch.
+    """
+
+    def __init__(self, start_date, end_date, N, M, f_v):
+        self.start_date = pd.Timestamp(start_date).normalize()
+        self.dates = pd.date_range(self.start_date, pd.Timestamp(end_date).normalize(), freq='D')
+        if len(self.dates) == 0:
+            raise ValueError(
+                f"'end_date' ({end_date}) of the schedule precedes its 'start_date' ({start_date})"
+            )
+        self.rules = []
+        self.values = {'N': [N,], 'M': [M,], 'f_v': [f_v,]}
+        self._table = None
+
+    def add(self, periods=None, weekdays=None, **regime):
+        """
+        Overrides the contacts and/or mobility on the days within `periods` (all days if None) falling on `weekdays` (all weekdays if None). Later rules take precedence over earlier ones.
+
+        input
+        -----
+        periods: list of tuple
+            First and last day (inclusive) of every period, f.i. `school_holidays['2017-2018']`.
+
+        weekdays: list of int
+            Days of the week (Monday = 0, Sunday = 6), f.i. [5, 6] for weekends.
+
+        regime: keyword arguments
+            New value of 'N', 'M' and/or 'f_v'.
+
+        output
+        ------
+        self: Schedule
+        """
+        if not regime:
+            raise ValueError(
+                f"a rule of the schedule must override at least one of {regime_keys}"
+            )
+        unknown = set(regime) - set(regime_keys)
+        if unknown:
+            raise ValueError(
+                f"unknown key(s) {sorted(unknown)} in rule of schedule, valid keys are {regime_keys}"
+            )
+        # days on which the rule applies
+        days = np.ones(len(self.dates), dtype=bool)
+        if periods is not None:
+            days = np.zeros(len(self.dates), dtype=bool)
+            for start, stop in periods:
+                days |= (self.dates >= pd.Timestamp(start)) & (self.dates <= pd.Timestamp(stop))
+        if weekdays is not None:
+            days &= np.isin(self.dates.weekday, weekdays)
+        # position of the new values
+        options = {}
+        for k, v in regime.items():
+            self.values[k].append(v)
+            options[k] = len(self.values[k]) - 1
+        self.rules.append((days, options))
+        self._table = None
+        return self
+
+    def compile(self):
+        """
+        Builds the table of distinct regimes, their pre-factorised mobility operators and the index of the regime of every day.
+
+        output
+        ------
+        self: Schedule
+        """
+        # value of every key on every day, as positions in `self.values`
+        choice = np.zeros((len(self.dates), len(regime_keys)), dtype=np.int64)
+        for days, options in self.rules:
+            for k, option in options.items():
+                choice[days, regime_keys.index(k)] = option
+        combinations, index = np.unique(choice, axis=0, return_inverse=True)
+
+        # contact matrix and mobility operator of every regime (operators are shared between regimes with the same M and f_v)
+        N, A, operators = [], [], {}
+        for n, m, f in combinations:
+            N.append(np.asarray(self.values['N'][n], dtype=np.float64))
+            if (m, f) not in operators:
+                operators[(m, f)] = mobility_operator(self.values['M'][m], self.values['f_v'][f])
+            A.append(operators[(m, f)])
+        self.regimes = [dict(zip(regime_keys, map(int, c))) for c in combinations]
+        self.index = np.ascontiguousarray(np.ravel(index), dtype=np.int64)
+        self._table = (N, A)
+        self._last = len(self.index) - 1
+        return self
+
+    def __call__(self, t):
+        """
+        Returns the contact matrix and pre-factorised mobility operator of the day containing time `t`.
+
+        input
+        -----
+        t: float
+            Time, in days since `start_date`.
+
+        output
+        ------
+        N: np.ndarray
+            Contact matrix. Shape (n_age, n_age).
+
+        A: np.ndarray or scipy.sparse.csr_array
+            Mobility operator (1 - f_v) * Id + f_v * M. Shape (n_loc, n_loc).
+        """
+        if self._table is None:
+            self.compile()
+        r = self.index[min(max(int(t), 0), self._last)]
+        return self._table[0][r], self._table[1][r]
+
+    @property
+    def operators(self):
+        """ Returns the (contact matrix, mobility operator) of every regime
+        """
+        if self._table is None:
+            self.compile()
+        return list(zip(*self._table))
+
+    def to_series(self):
+        """ Returns the regime of every day, indexed by date
+        """
+        if self._table is None:
+            self.compile()
+        return pd.Series(self.index, index=self.dates, name='regime')
+
+def mobility_operator(M, f_v):
+    """
+    Returns the mobility operator A = (1 - f_v) * Id + f_v * M mixing the contacts on the home and visited patches, in the format of M (sparse matrices as CSR).
+
+    input
+    -----
+    M: np.ndarray or scipy.sparse array
+        Origin-destination mobility matrix. Shape (n_loc, n_loc).
+
+    f_v: float
+        Fraction of the total contacts made on the visited patch.
+
+    output
+    ------
+    A: np.ndarray or scipy.sparse.csr_array
+        Mobility operator. Shape (n_loc, n_loc).
+    """
+    if np.ndim(M) != 2 or M.shape[0] != M.shape[1]:
+        raise ValueError(
+            f"mobility matrix 'M' must be square, found shape {np.shape(M)}"
+        )
+    if issparse(M):
+        return csr_array((1 - f_v) * eye_array(M.shape[0]) + f_v * csr_array(M))
+    return np.ascontiguousarray((1 - f_v) * np.eye(M.shape[0]) + f_v * np.asarray(M, dtype=np.float64))
@@ -14,8 +14,9 @@ from utils import name2NIS, \
                         construct_coordinates_dictionary, \
                             construct_initial_susceptible, \
                                 get_contact_matrix, get_mobility_matrix, \
-                                    visualise_logstate_on_map, \
-                                        load_shapefiles
+                                    load_municipality_raster
+from output import OutputSink, simulate_to_sink, read_output
+from rendering import render_animation
 
 #################
 ## Setup model ##
@@ -46,7 +47,12 @@ model = my_model(states=init_states, parameters=params, coordinates=coordinates)
 ## simulate model ##
 ####################
 
-out = model.sim(120)
+# stream the output to disk: the infected per age group and municipality, the national totals and the infected per municipality
+output_path = 'simulation.h5'
+aggregations = {'S_total': ('S', ()), 'I_total': ('I', ()), 'R_total': ('R', ()), 'I_location': ('I', ('location',))}
+with OutputSink(output_path, coordinates, aggregations=aggregations, store_states=['I']) as sink:
+    simulate_to_sink(model, 120, sink)
+totals = {X: read_output(output_path, f'{X}_total') for X in ['S', 'I', 'R']}
 
 #######################
 ## visualise results ##
@@ -55,22 +61,26 @@ out = model.sim(120)
 fig,ax=plt.subplots(nrows=3, figsize=(8.3,11.7/2))
 
 ax[0].set_title('Overall')
-ax[0].plot(out['time'], out['S'].sum(dim=['age', 'location']), color='green', alpha=0.8, label='S')
-ax[0].plot(out['time'], out['I'].sum(dim=['age', 'location']), color='red', alpha=0.8, label='I')
-ax[0].plot(out['time'], out['R'].sum(dim=['age', 'location']), color='black', alpha=0.8, label='R')
+ax[0].plot(totals['S']['time'], totals['S'], color='green', alpha=0.8, label='S')
+ax[0].plot(totals['I']['time'], totals['I'], color='red', alpha=0.8, label='I')
+ax[0].plot(totals['R']['time'], totals['R'], color='black', alpha=0.8, label='R')
 ax[0].legend(loc=1, framealpha=1)
 
 ax[1].set_title('Infected')
-ax[1].plot(out['time'], out['I'].sum(dim='age').sel({'location': name2NIS('Aarlen')}), linestyle = '-', color='red', alpha=0.8, label='Aarlen')
-ax[1].plot(out['time'], out['I'].sum(dim='age').sel({'location': name2NIS('Chimay')}), linestyle = ':', color='red', alpha=0.8, label='Chimay')
-ax[1].plot(out['time'], out['I'].sum(dim='age').sel({'location': name2NIS('De Panne')}), linestyle = '--', color='red', alpha=0.8, label='De Panne')
+I = read_output(output_path, 'I_location', location=name2NIS('Aarlen')).squeeze()
+ax[1].plot(I['time'], I, linestyle = '-', color='red', alpha=0.8, label='Aarlen')
+I = read_output(output_path, 'I_location', location=name2NIS('Chimay')).squeeze()
+ax[1].plot(I['time'], I, linestyle = ':', color='red', alpha=0.8, label='Chimay')
+I = read_output(output_path, 'I_location', location=name2NIS('De Panne')).squeeze()
+ax[1].plot(I['time'], I, linestyle = '--', color='red', alpha=0.8, label='De Panne')
 ax[1].legend(loc=1, framealpha=1)
 
 ax[2].set_title('Infected per age group (Aarlen)')
-ax[2].plot(out['time'], out['I'].sel({'age': '0-5', 'location': name2NIS('Aarlen')}), linestyle = '-', color='red', alpha=0.8, label='0-5')
-ax[2].plot(out['time'], out['I'].sel({'age': '5-15', 'location': name2NIS('Aarlen')}), linestyle = ':', color='red', alpha=0.8, label='5-15')
-ax[2].plot(out['time'], out['I'].sel({'age': '15-65', 'location': name2NIS('Aarlen')}), linestyle = '--', color='red', alpha=0.8, label='15-65')
-ax[2].plot(out['time'], out['I'].sel({'age': '65+', 'location': name2NIS('Aarlen')}), linestyle = '-', color='black', alpha=0.8, label='65+')
+I = read_output(output_path, 'I', location=name2NIS('Aarlen')).squeeze()
+ax[2].plot(I['time'], I.sel({'age': '0-5'}), linestyle = '-', color='red', alpha=0.8, label='0-5')
+ax[2].plot(I['time'], I.sel({'age': '5-15'}), linestyle = ':', color='red', alpha=0.8, label='5-15')
+ax[2].plot(I['time'], I.sel({'age': '15-65'}), linestyle = '--', color='red', alpha=0.8, label='15-65')
+ax[2].plot(I['time'], I.sel({'age': '65+'}), linestyle = '-', color='black', alpha=0.8, label='65+')
 ax[2].legend(loc=1, framealpha=1)
 
 plt.tight_layout()
@@ -81,47 +91,6 @@ plt.close()
 ## Make a GIF ##
 ################
 
-gdf = load_shapefiles()
-frames = []
-# loop over timesteps and make frames
-for t in out['time'].values:
-
-    fig,ax = plt.subplots(nrows=2, figsize=(8.3/2,11.7/3), height_ratios=[3, 1])
-
-    # make map
-    ax[0] = visualise_logstate_on_map(ax[0], gdf, out, t, 'I')
-    ax[0].set_title(f'SIR model with commuter mobility\nt = {t} days')
-    
-    # plot the normalised states
-    ax[1].plot(out.sel(time=range(t)).sum(dim=['age','location'])['S']/11.5e6*100, color='green', label='S')
-    ax[1].plot(out.sel(time=range(t)).sum(dim=['age','location'])['I']/11.5e6*100, color='red', label='I')
-    ax[1].plot(out.sel(time=range(t)).sum(dim=['age','location'])['R']/11.5e6*100, color='black', label='R')
-    ax[1].set_xlim([0,120])
-    ax[1].set_ylim([0,100])
-    ax[1].set_xlabel('time (days)', fontsize=8)
-    ax[1].set_ylabel('population (%)', fontsize=8)
-    ax[1].spines['top'].set_visible(False)
-    ax[1].spines['right'].set_visible(False)
-    ax[1].legend(loc=1, framealpha=1, prop={'size': 8})
-    ax[1].tick_params(axis='both', which='major', labelsize=8)
-
-    # save frame
-    output_dir = 'frames'
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-    frame_path = os.path.join(output_dir, f'frame_{t:03d}.png')
-    frames.append(frame_path)
-    plt.savefig(frame_path, bbox_inches='tight', dpi=150)
-    plt.close()
-
-# compile in a gif
-import imageio
-with imageio.get_writer('simulation.gif', mode='I', duration=1) as writer:
-    for frame_path in frames:
-        image = imageio.imread(frame_path)
-        writer.append_data(image)
-
-# remove the frames after creating the GIF
-for frame_path in frames:
-    os.remove(frame_path)
-os.rmdir(output_dir)
\ No newline at end of file
+# render the frames on a pool of worker processes and encode the gif from memory
+raster = load_municipality_raster()
+render_animation('simulation.gif', raster, read_output(output_path, 'I_location'), totals, totals['I']['time'].values, processes=os.cpu_count())
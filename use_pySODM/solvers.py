@@ -0,0 +1,89 @@
+"""
+This script contains the pySODM ODE base classes of the age-stratified spatially-explicit SIR models (`models.py`, `models_legacy.py`): a fixed-step integration mode and
+the analytical Jacobian handed to the implicit solvers. It does not import the models, so the legacy reference models do not depend on `models.py`.
+"""
+
+__author__      = "Tijs Alleman"
+__copyright__   = "Copyright (c) 2024 by T.W. Alleman, IDD Group, Johns Hopkins Bloomberg School of Public Health. All Rights Reserved."
+
+import numpy as np
+from scipy.integrate import BDF, Radau
+from pySODM.models.base import ODE
+from kernels_numba import precisions
+from engines import fixed_step_methods, integrate_fixed_step
+
+################
+## Fixed step ##
+################
+
+class FixedStepODE(ODE):
+    """
+    pySODM ODE model with a fixed-step integration mode: `sim(time, method='rk4', dt=1.0)` (or 'euler') integrates with preallocated buffers (see `engines.integrate_fixed_step`),
+    with the semantics of flepiMoP's `seir.integration` block (see `engines.read_integration_config`). All other methods are passed on to pySODM.
+    The fixed-step states are stored in the model's `precision` (see `kernels_numba.precisions`).
+    """
+
+    precision = 'float64'
+
+    def sim(self, time, N=1, draw_function=None, draw_function_kwargs={}, processes=None, method='RK45', rtol=1e-4, tau=None, output_timestep=1, dt=1.0):
+        if method not in fixed_step_methods:
+            return super().sim(time, N=N, draw_function=draw_function, draw_function_kwargs=draw_function_kwargs, processes=processes,
+                               method=method, rtol=rtol, tau=tau, output_timestep=output_timestep)
+        if N != 1 or draw_function:
+            raise ValueError(
+                f"fixed-step method '{method}' simulates a single realisation, draw ensembles with `spatial_ODE_SIR_ensemble` or `ensemble.simulate_ensemble`"
+            )
+        return integrate_fixed_step(self, time, method=method, dt=dt, output_timestep=output_timestep, dtype=precisions[self.precision])
+
+##############
+## Jacobian ##
+##############
+
+# implicit scipy solvers receiving the analytical Jacobian (LSODA only accepts dense or banded Jacobians, it keeps estimating them by finite differences)
+implicit_methods = {'BDF': BDF, 'Radau': Radau}
+# above this fraction of non-zero elements, the Jacobian is passed as a dense array (the fill-in of a sparse LU decomposition makes it slower than a dense one)
+dense_jacobian_density = 0.1
+
+def with_jacobian(solver, jac, jac_sparsity):
+    """ Returns a subclass of a scipy `OdeSolver` constructed with an analytical Jacobian and its sparsity pattern (pySODM's `sim()` does not forward them to `solve_ivp`)
+    """
+    class JacobianSolver(solver):
+        def __init__(self, fun, t0, y0, t_bound, **kwargs):
+            super().__init__(fun, t0, y0, t_bound, jac=jac, jac_sparsity=jac_sparsity, **kwargs)
+    JacobianSolver.__name__ = solver.__name__
+    return JacobianSolver
+
+class JacobianODE(FixedStepODE):
+    """
+    pySODM ODE model passing an analytical Jacobian to the implicit solvers ('BDF', 'Radau').
+
+    Subclasses define `jacobian`, with the signature of `integrate`, returning the (sparse) Jacobian of the flattened differentials with respect to the flattened states,
+    and `jacobian_sparsity()`, returning its sparsity pattern (or None if the Jacobian is not available for the model's parameters). Jacobians denser than `dense_jacobian_density` are converted to dense arrays.
+    Models with time-dependent parameters fall back to finite differences.
+    """
+
+    def jacobian_solver(self, method):
+        """ Returns the scipy solver of `method` constructed with the model's analytical Jacobian, or None if `method` is explicit (or the model has time-dependent parameters)
+        """
+        if method not in implicit_methods or self.time_dependent_parameters:
+            return None
+        names = list(self.state_shapes.keys())
+        shapes = list(self.state_shapes.values())
+        offsets = np.cumsum([0,] + [int(np.prod(s)) for s in shapes])
+        params = {k: self.parameters[k] for k in self.parameters_names_modeldeclaration}
+        sparsity = self.jacobian_sparsity()
+        if sparsity is None:
+            return None
+        dense = sparsity.nnz > dense_jacobian_density * sparsity.shape[0] * sparsity.shape[1]
+
+        def jac(t, y):
+            states = {k: y[o0:o1].reshape(s) for k, s, o0, o1 in zip(names, shapes, offsets[:-1], offsets[1:])}
+            J = self.jacobian(t, **states, **params)
+            return J.toarray() if dense else J
+
+        return with_jacobian(implicit_methods[method], jac, sparsity)
+
+    def _sim_single(self, time, actual_start_date=None, method='RK23', rtol=5e-3, output_timestep=1, tau=None):
+        if not tau:
+            method = self.jacobian_solver(method) or method
+        return super()._sim_single(time, actual_start_date, method, rtol, output_timestep, tau)
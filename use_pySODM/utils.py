@@ -5,23 +5,96 @@ This script contains usefull functions for the pySODM-based Belgian Influenza mo
 __author__      = "Tijs Alleman"
 __copyright__   = "Copyright (c) 2024 by T.W. Alleman, IDD Group, Johns Hopkins Bloomberg School of Public Health. All Rights Reserved."
 
-import os
 import numpy as np
 import pandas as pd
+from scipy.sparse import csr_array
+from cache import cached_arrays, data_path
+from geography import get_geography
+
+############################
+## Cached source datasets ##
+############################
+
+def load_demography_2011():
+    """ A function returning the NIS codes, names and number of inhabitants of the 581 municipalities in the 2011 census (cached)
+
+    output
+    ------
+    demography: dict
+        Keys: 'NIS' (int), 'name' (str) and 'inhabitants' (float). Shape (581,).
+    """
+    source = data_path('interim', 'census_2011', 'demography_municipalities_2011_sorted.csv')
+    def build():
+        data = pd.read_csv(source)
+        return {'NIS': data['NIS'].values.astype(np.int64), 'name': np.asarray(data['name'], dtype=str), 'inhabitants': data['inhabitants'].values.astype(np.float64)}
+    return cached_arrays('demography_2011', [source], build)
+
+def load_demography_2017():
+    """ A function returning the number of inhabitants per age group of the 581 municipalities on Jan 1, 2017 (cached)
+
+    output
+    ------
+    demography: dict
+        Keys: 'NIS' (int, shape (581,)) and 'population' (float, shape (4, 581)).
+    """
+    source = data_path('interim', 'demography', 'demography_municipalities_2017.csv')
+    def build():
+        # the age groups are not listed in the same order for every municipality: pivot on their labels, sorted by lower bound
+        data = pd.read_csv(source).pivot(index='age', columns='NIS', values='population')
+        data = data.loc[sorted(data.index, key=lambda age: float(age.strip('[(').split(',')[0]))]
+        return {'NIS': data.columns.values.astype(np.int64), 'population': data.values.astype(np.float64)}
+    return cached_arrays('demography_2017_by_age', [source], build)
+
+def load_mobility_2011():
+    """ A function returning the number of commuters between the 581 municipalities in the 2011 census (cached)
+
+    output
+    ------
+    mobility: np.ndarray
+        Number of inhabitants of municipality i working in municipality j. Shape (581, 581).
+    """
+    source = data_path('interim', 'census_2011', 'mobility_municipalities_2011_sorted.csv')
+    def build():
+        return {'mobility': pd.read_csv(source, index_col=0).values.astype(np.float64)}
+    return cached_arrays('mobility_2011', [source], build)['mobility']
+
+def load_contacts_2010():
+    """ A function returning the integrated social contact matrix of Belgium 2010 (cached)
+
+    output
+    ------
+    contacts: np.ndarray
+        Contact matrix. Shape (4, 4).
+    """
+    source = data_path('raw', 'contacts', 'belgium_2010_all.xlsx')
+    def build():
+        return {'contacts': pd.read_excel(source, sheet_name='integrated', index_col=0, header=0).values.astype(np.float64)}
+    return cached_arrays('contacts_2010', [source], build)['contacts']
+
+def load_ILI_2017_2018():
+    """ A function returning the weekly number of GP consultations for influenza-like illness per age group during the 2017-2018 season (cached)
+
+    output
+    ------
+    ILI: dict
+        Keys: 'date' (datetime64, midpoint of the week, shape (n_weeks,)) and 'cases' (float, shape (n_weeks, 4)). Age groups ordered as in the model.
+    """
+    source = data_path('interim', 'cases', '2017-2018', 'ILI_weekly_ABS.csv')
+    def build():
+        data = pd.read_csv(source, parse_dates=['DATE']).pivot(index='DATE', columns='AGE', values='CASES_100K')
+        # order age groups on their lower bound
+        data = data[sorted(data.columns, key=lambda x: int(x.strip('[)').split(',')[0]))]
+        return {'date': data.index.values.astype('datetime64[s]'), 'cases': data.values.astype(np.float64)}
+    return cached_arrays('ILI_2017_2018', [source], build)
+
+#############
+## Helpers ##
+#############
 
 def name2NIS(name):
-    """ A function to convert a Belgian municipality name into a NIS code
+    """ A function to convert a (list of) Belgian municipality name(s) into NIS code(s)
     """
-    # load NIS/name list 
-    rel_dir = '../data/interim/census_2011/demography_municipalities_2011_sorted.csv'
-    data = pd.read_csv(os.path.join(os.getcwd(),rel_dir))[['NIS','name']]
-    # check if name is valid
-    if name not in data['name'].values:
-        raise ValueError(
-            f"name '{name}' is not a valid Belgian municipality name"
-        )
-    # return NIS code 
-    return data['NIS'][data['name'] == name].values[0]
+    return get_geography().name2NIS(name)
 
 import random
 def construct_initial_infected(loc='random', n=1, agedist='demographic'):
@@ -45,17 +118,17 @@ def construct_initial_infected(loc='random', n=1, agedist='demographic'):
     """
 
     # load 2017 demography
-    rel_dir = '../data/interim/demography/demography_municipalities_2017.csv'
-    demography = pd.read_csv(os.path.join(os.getcwd(),rel_dir))
+    demography = load_demography_2017()
 
     # select a spatial patch
     if loc == 'random':
-        init_NIS = random.choice(demography['NIS'].unique().values)
+        init_NIS = random.choice(list(demography['NIS']))
     else:
         init_NIS = name2NIS(loc)
+    idx = get_geography().NIS2index(init_NIS)
 
     # distribute over age groups
-    demography_NIS = demography[demography['NIS'] == init_NIS]['population'].values
+    demography_NIS = demography['population'][:, idx]
     if agedist == 'demographic':
         agedist_n = np.random.multinomial(n, demography_NIS / sum(demography_NIS))
     elif agedist == 'uniform':
@@ -69,76 +142,150 @@ def construct_initial_infected(loc='random', n=1, agedist='demographic'):
         )
 
     # build initial infected
-    I0 = demography.set_index(['NIS', 'age'])
-    I0['population'] = 0.0
-    I0.loc[(init_NIS, slice(None)), 'population'] = agedist_n
-
-    # convert to numpy array
-    n_age = len(demography['age'].unique())
-    n_NIS = len(demography['NIS'].unique())
+    I0 = np.zeros(demography['population'].shape)
+    I0[:, idx] = agedist_n
 
-    return np.transpose(I0.values.reshape(n_NIS, n_age))
+    return I0
 
 def construct_initial_susceptible(I0):
     """ A function to construct the initial number of susceptible individuals
     """
     # load 2017 demography
-    rel_dir = '../data/interim/demography/demography_municipalities_2017.csv'
-    demography = pd.read_csv(os.path.join(os.getcwd(),rel_dir))
-
-    # convert to numpy array
-    n_age = len(demography['age'].unique())
-    n_NIS = len(demography['NIS'].unique())
-    S0 = demography.set_index(['NIS', 'age'])
-    S0 = np.transpose(S0.values.reshape(n_NIS, n_age))
+    S0 = load_demography_2017()['population']
 
     # subtract initial infected
     S0 = S0 - I0
 
     return S0
 
-def get_mobility_matrix():
+def get_mobility_matrix(sparse=False, threshold=None):
     """ A function to extract the mobility matrix and normalise it with the size of the active population
+
+    input
+    -----
+    sparse: bool
+        If True, return the mobility matrix as a `scipy.sparse.csr_array`. Default: False.
+
+    threshold: float or None
+        If provided, off-diagonal fractions of travelers below `threshold` are pruned (set to zero) before the on-diagonal elements are computed.
+        Pruned travelers stay in their home patch, so the rows of the mobility matrix keep summing to one. Default: None (no pruning).
+
+    output
+    ------
+    mobility: np.ndarray or scipy.sparse.csr_array
+        Origin-destination mobility matrix. Shape (581, 581).
     """
-    # get data and convert to np.array
-    rel_dir = '../data/interim/census_2011/mobility_municipalities_2011_sorted.csv'
-    mobility = pd.read_csv(os.path.join(os.getcwd(),rel_dir), index_col=0).values
+    # get data (copy of the cached array)
+    mobility = np.array(load_mobility_2011())
 
     # get 2011 demography and normalise to obtain the fraction traveling
-    rel_dir = '../data/interim/census_2011/demography_municipalities_2011_sorted.csv'
-    demography = pd.read_csv(os.path.join(os.getcwd(),rel_dir), index_col=0)['inhabitants'].values
+    demography = load_demography_2011()['inhabitants']
 
     # normalise mobility matrix
     mobility /= demography[:, None]
     
     # assume on-diagonal = 1 - traveling to match flepi implementation
     np.fill_diagonal(mobility, 0)
+    if threshold:
+        mobility[mobility < threshold] = 0
     rowsum = mobility.sum(axis=1)
     np.fill_diagonal(mobility, 1-rowsum)
 
+    if sparse:
+        return csr_array(mobility)
     return mobility
 
 def get_contact_matrix():
-    rel_dir = '../data/raw/contacts/belgium_2010_all.xlsx'
-    contacts = pd.read_excel(os.path.join(os.getcwd(),rel_dir), sheet_name='integrated', index_col=0, header=0)
-    return contacts.values
+    return np.array(load_contacts_2010())
 
-def construct_coordinates_dictionary():
+def construct_coordinates_dictionary(n_draws=None):
     """A function returning the model's coordinates
+
+    input
+    -----
+    n_draws: int or None
+        If provided, a leading 'draw' dimension with coordinates 0, ..., n_draws-1 is added (for use with `spatial_ODE_SIR_ensemble`). Default: None.
     """
     coordinates = {'age': ['0-5', '5-15', '15-65', '65+'],
-                   'location': list(pd.read_csv(os.path.join(os.getcwd(),'../data/interim/census_2011/demography_municipalities_2011_sorted.csv'))['NIS'].values)
+                   'location': get_geography().NIS.tolist()
                     }
+    if n_draws:
+        coordinates = {'draw': list(range(n_draws)), **coordinates}
     return coordinates
 
+def broadcast_to_draws(X, n_draws):
+    """ A function to repeat an initial state of shape (4, 581) over a leading 'draw' dimension
+
+    output
+    ------
+    X: np.ndarray
+        Initial state. Shape (n_draws, 4, 581).
+    """
+    return np.repeat(np.asarray(X, np.float64)[np.newaxis, ...], n_draws, axis=0)
+
+import shapely
 import geopandas as gpd
 
+shapefile = data_path('raw', 'shape', 'georef-belgium-municipality-millesime.shp')
+
 def load_shapefiles():
-    gdf = gpd.read_file('../data/raw/shape/georef-belgium-municipality-millesime.shp')
-    gdf = gdf[gdf['year'] == '2021']
+    """ A function returning the 2021 municipalities, sorted by NIS code (only the 2021 records are read from the multi-year shapefile)
+    """
+    gdf = gpd.read_file(shapefile, where="year = '2021'")
     gdf = gdf.sort_values(by='mun_code')
     return gdf
 
+def rasterize_municipalities(gdf, width=600):
+    """
+    A function rasterizing municipalities into a pixel -> location index array, and simplifying their borders into an outline layer
+
+    input
+    -----
+    gdf: geopandas.GeoDataFrame
+        Municipalities (WGS84), in the order of the model's 'location' coordinate.
+
+    width: int
+        Number of pixels along the longitude. Pixels are square on the map (the latitude is scaled by 1/cos(latitude), as geopandas does).
+
+    output
+    ------
+    raster: dict
+        Keys: 'index' (int32, shape (height, width), -1 outside Belgium), 'extent' (left, right, bottom, top), 'aspect' (of the map) and 'outline' (simplified borders, shape (n, 2), polylines separated by rows of NaN).
+    """
+    xmin, ymin, xmax, ymax = gdf.total_bounds
+    aspect = 1 / np.cos(np.deg2rad((ymin + ymax) / 2))
+    dx = (xmax - xmin) / width
+    dy = dx / aspect
+    height = int(np.ceil((ymax - ymin) / dy))
+
+    # pixel centres inside every polygon get its location index, largest first so enclaves overwrite the municipality surrounding them
+    index = np.full((height, width), -1, np.int32)
+    x = xmin + (np.arange(width) + 0.5) * dx
+    y = ymax - (np.arange(height) + 0.5) * dy
+    geometries = np.asarray(gdf.geometry)
+    shapely.prepare(geometries)
+    for k in np.argsort(-shapely.area(geometries), kind='stable'):
+        left, bottom, right, top = geometries[k].bounds
+        columns = slice(np.searchsorted(x, left), np.searchsorted(x, right))
+        rows = slice(np.searchsorted(-y, -top), np.searchsorted(-y, -bottom))
+        inside = shapely.contains_xy(geometries[k], *np.meshgrid(x[columns], y[rows]))
+        index[rows, columns][inside] = k
+
+    # borders simplified to the size of a pixel
+    outline = []
+    for geometry in gdf.geometry.simplify(dx, preserve_topology=True).boundary:
+        for line in getattr(geometry, 'geoms', [geometry]):
+            outline += [np.asarray(line.coords)[:, :2], np.full((1, 2), np.nan)]
+
+    return {'index': index, 'extent': np.array([xmin, xmax, ymin, ymax]),
+            'aspect': np.float64(aspect), 'outline': np.concatenate(outline)}
+
+def load_municipality_raster(width=600):
+    """ A function returning the rasterized 2021 municipalities and their simplified outline (cached, see `rasterize_municipalities`)
+    """
+    sources = [shapefile] + [shapefile.replace('.shp', extension) for extension in ['.shx', '.dbf']]
+    return cached_arrays(f'municipality_raster_{width}', sources, lambda: rasterize_municipalities(load_shapefiles(), width))
+
 def visualise_logstate_on_map(ax, gdf, simout, t, X, time_dimension_name='time', spatial_dimension_name='location',
                            plot_kwargs={'cmap': 'OrRd', 'linewidth': 0.5, 'edgecolor': 'black', 'legend': False, 'vmin': 0, 'vmax': 5}):
     """ Use geopandas to plot a model state on a Belgian map